@@ -14,6 +14,7 @@
 # Copyright 2018 SerialLab Corp.  All rights reserved.
 from django.contrib import admin
 from quartet_capture import models
+from quartet_capture.counts import ApproximateCountPaginator
 from django.conf import settings
 from django.utils.safestring import mark_safe
 
@@ -42,7 +43,8 @@ class RuleAdmin(admin.ModelAdmin):
     inlines = [
         StepInline
     ]
-    list_display = ('name', 'description')
+    list_display = ('name', 'description', 'max_concurrency',
+                    'bypass_admission_control')
 
 class StepParameterInline(admin.StackedInline):
     model = models.StepParameter
@@ -65,6 +67,12 @@ class TaskHistoryInline(admin.TabularInline):
     model = models.TaskHistory
     extra = 0
 
+class TaskDependencyInline(admin.TabularInline):
+    model = models.TaskDependency
+    fk_name = 'task'
+    extra = 0
+    raw_id_fields = ('depends_on_task',)
+
 class TaskParameterInline(admin.TabularInline):
     model = models.TaskParameter
     extra = 0
@@ -74,6 +82,7 @@ class TaskParameterInline(admin.TabularInline):
 class TaskAdmin(admin.ModelAdmin):
     inlines = [
         TaskParameterInline,
+        TaskDependencyInline,
         TaskHistoryInline,
         TaskMessageInline,
     ]
@@ -82,7 +91,11 @@ class TaskAdmin(admin.ModelAdmin):
 
     search_fields = ['rule__name', 'name', 'status', 'status_changed']
     list_display = ('status_changed', 'name', 'rule', 'status', 'execution_time', url)
-    ordering = ('-status_changed',)
+    list_select_related = ('rule',)
+    ordering = ('-status_changed', '-name')
+    # avoid COUNT(*) over the whole task table on every changelist page
+    paginator = ApproximateCountPaginator
+    show_full_result_count = False
 
 def register_to_site(admin_site):
     admin_site.register(models.RuleFilter, RuleFilterAdmin)
@@ -0,0 +1,143 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+'''
+Admission control for the capture endpoints.  When the backlog of queued
+tasks for a rule is deeper or older than the configured limits, new
+messages for the rule are turned away (the capture views return a 503
+with a Retry-After header) until the workers catch up.
+
+The queue depth and age of every rule are read with a single grouped query
+over the (status, status_changed) index rather than kept as counters, since
+tasks enter and leave the QUEUED state through many bulk updates that
+counters would drift from.  The result is kept in the Django cache and
+refreshed by one process at a time, at most once every
+QUARTET_CAPTURE_QUEUE_STATS_INTERVAL seconds, so a busy endpoint does not
+run a query per request.  This needs a cache shared by all web processes;
+with a per-process cache every process runs the query.
+'''
+import time
+from logging import getLogger
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Min
+from quartet_capture.models import Rule, Task
+
+logger = getLogger('quartet_capture')
+
+# the maximum number of QUEUED tasks per rule, zero is unlimited
+MAX_QUEUE_DEPTH = getattr(settings, 'QUARTET_CAPTURE_MAX_QUEUE_DEPTH', 0)
+# the maximum age in seconds of a rule's oldest QUEUED task, zero is
+# unlimited
+MAX_QUEUE_AGE = getattr(settings, 'QUARTET_CAPTURE_MAX_QUEUE_AGE', 0)
+# how long, in seconds, the queue statistics are cached
+QUEUE_STATS_INTERVAL = getattr(
+    settings, 'QUARTET_CAPTURE_QUEUE_STATS_INTERVAL', 10)
+# the Retry-After value, in seconds, sent with a rejection
+RETRY_AFTER = getattr(settings, 'QUARTET_CAPTURE_RETRY_AFTER', 60)
+
+QUEUE_STATS_CACHE_KEY = 'quartet_capture:queue_stats'
+QUEUE_STATS_LOCK_KEY = 'quartet_capture:queue_stats_lock'
+# how long, in seconds, a process waits for another to query the missing
+# statistics before it admits the message
+QUEUE_STATS_WAIT = 0.5
+# cache backends that are not shared between processes
+LOCAL_CACHES = ('django.core.cache.backends.locmem.LocMemCache',
+                'django.core.cache.backends.dummy.DummyCache')
+_warned = False
+
+
+def get_queue_stats() -> dict:
+    '''
+    Returns the number of QUEUED tasks and the time (as a timestamp) the
+    oldest of them was queued for each rule with queued tasks.  Once the
+    cached statistics are due for a refresh, the process that wins the
+    refresh lock queries them while the others keep using the cached ones.
+    When there are no cached statistics at all the others wait briefly for
+    the winner and otherwise admit the message.
+    :return: A dictionary of (depth, oldest) tuples by rule id.
+    '''
+    cached = cache.get(QUEUE_STATS_CACHE_KEY)
+    if cached is not None:
+        refreshed, stats = cached
+        if time.time() - refreshed < QUEUE_STATS_INTERVAL or \
+            not cache.add(QUEUE_STATS_LOCK_KEY, True, QUEUE_STATS_INTERVAL):
+            return stats
+    elif not cache.add(QUEUE_STATS_LOCK_KEY, True, QUEUE_STATS_INTERVAL):
+        return _wait_for_stats()
+    try:
+        stats = {
+            row['rule_id']: (row['depth'], row['oldest'].timestamp())
+            for row in Task.objects.filter(status='QUEUED').values(
+                'rule_id').annotate(depth=Count('name'),
+                                    oldest=Min('status_changed'))
+        }
+        # kept past the interval so stale statistics can be served while
+        # one process refreshes them
+        cache.set(QUEUE_STATS_CACHE_KEY, (time.time(), stats),
+                  QUEUE_STATS_INTERVAL * 3)
+    finally:
+        cache.delete(QUEUE_STATS_LOCK_KEY)
+    return stats
+
+
+def _wait_for_stats() -> dict:
+    '''
+    Waits up to QUEUE_STATS_WAIT seconds for another process to store the
+    statistics.
+    :return: The statistics, or no statistics (every rule is admitted) if
+    they were not stored in time.
+    '''
+    deadline = time.time() + QUEUE_STATS_WAIT
+    while time.time() < deadline:
+        time.sleep(0.05)
+        cached = cache.get(QUEUE_STATS_CACHE_KEY)
+        if cached is not None:
+            return cached[1]
+    return {}
+
+
+def _warn_local_cache():
+    global _warned
+    if not _warned and settings.CACHES.get('default', {}).get(
+        'BACKEND') in LOCAL_CACHES:
+        logger.warning('Capture admission control is enabled with a cache '
+                       'that is not shared between processes, every process '
+                       'will query the queue statistics.  Configure a '
+                       'shared cache such as Redis or Memcached.')
+    _warned = True
+
+
+def check_admission(rule: Rule) -> int:
+    '''
+    Checks whether a new message for the rule should be accepted.
+    :param rule: The rule that would process the message.
+    :return: None if the message should be accepted, otherwise the number
+    of seconds the client should wait before retrying.
+    '''
+    if rule.bypass_admission_control or not (MAX_QUEUE_DEPTH or
+                                             MAX_QUEUE_AGE):
+        return None
+    _warn_local_cache()
+    depth, oldest = get_queue_stats().get(rule.id, (0, None))
+    if MAX_QUEUE_DEPTH and depth >= MAX_QUEUE_DEPTH:
+        logger.warning('Rejecting a message for rule %s, %s tasks are '
+                       'queued.', rule.name, depth)
+        return RETRY_AFTER
+    if MAX_QUEUE_AGE and oldest and time.time() - oldest > MAX_QUEUE_AGE:
+        logger.warning('Rejecting a message for rule %s, its oldest queued '
+                       'task has waited %d seconds.', rule.name,
+                       time.time() - oldest)
+        return RETRY_AFTER
+    return None
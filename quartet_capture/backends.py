@@ -0,0 +1,244 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+'''
+Execution backends decide how queued tasks reach a worker.  The Celery
+backend (the default) sends each task to the broker.  The database backend
+needs no broker; the tasks are left QUEUED in the database and are claimed
+by the workers started with the `run_task_workers` management command.
+Set QUARTET_CAPTURE_EXECUTION_BACKEND to `celery`, `database` or the
+dotted path of a class implementing `dispatch` and `run_in_background`.
+'''
+import threading
+from logging import getLogger
+from typing import List
+from django.conf import settings
+from django.db import connection, connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from quartet_capture.models import Task as DBTask, Rule as DBRule, \
+    TaskHistory
+
+logger = getLogger('quartet_capture')
+
+BACKENDS = {
+    'celery': 'quartet_capture.backends.CeleryBackend',
+    'database': 'quartet_capture.backends.DatabaseBackend',
+}
+EXECUTION_BACKEND = getattr(settings, 'QUARTET_CAPTURE_EXECUTION_BACKEND',
+                            'celery')
+# the number of tasks a database worker claims at once
+WORKER_BATCH_SIZE = getattr(settings, 'QUARTET_CAPTURE_WORKER_BATCH_SIZE', 10)
+# the number of seconds an idle database worker waits before polling again
+WORKER_POLL_INTERVAL = getattr(settings,
+                               'QUARTET_CAPTURE_WORKER_POLL_INTERVAL', 1.0)
+_backend = None
+
+
+def get_backend():
+    '''
+    Returns the configured execution backend.
+    '''
+    global _backend
+    if _backend is None:
+        _backend = import_string(
+            BACKENDS.get(EXECUTION_BACKEND, EXECUTION_BACKEND))()
+    return _backend
+
+
+class CeleryBackend:
+    '''
+    Sends tasks to Celery.
+    '''
+
+    def dispatch(self, task_names: List[str], user_id: int = None,
+                 priority: int = None):
+        '''
+        Sends the tasks to the broker, a batch as a single group.
+        :param task_names: The names of the queued tasks.
+        :param user_id: The user that queued the tasks (optional).
+        :param priority: The Celery message priority (optional).
+        '''
+        from celery import group
+        from quartet_capture.tasks import execute_queued_task
+        if len(task_names) == 1 and priority is None:
+            execute_queued_task.delay(task_name=task_names[0],
+                                      user_id=user_id)
+        else:
+            group(
+                execute_queued_task.si(task_name=task_name, user_id=user_id)
+                for task_name in task_names
+            ).apply_async(priority=priority)
+
+    def run_in_background(self, celery_task, **kwargs):
+        '''
+        Runs one of the quartet_capture Celery tasks on a worker.
+        '''
+        celery_task.delay(**kwargs)
+
+
+class DatabaseBackend:
+    '''
+    Leaves the tasks QUEUED in the database for the database workers.
+    There is no message priority, tasks are claimed oldest first.
+    '''
+
+    def dispatch(self, task_names: List[str], user_id: int = None,
+                 priority: int = None):
+        # the user can not travel with the task so it is recorded now
+        if user_id:
+            TaskHistory.objects.bulk_create([
+                TaskHistory(task=task, user_id=user_id)
+                for task in DBTask.objects.filter(name__in=task_names)
+            ])
+
+    def run_in_background(self, celery_task, **kwargs):
+        '''
+        Runs the function of one of the quartet_capture Celery tasks on a
+        background thread.
+        '''
+        def run():
+            try:
+                celery_task(**kwargs)
+            except Exception:
+                logger.exception('Background task %s failed.',
+                                 celery_task.name)
+            finally:
+                connections.close_all()
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+def claim_tasks(batch_size: int = None) -> List[DBTask]:
+    '''
+    Claims the oldest QUEUED tasks for a database worker.  The tasks stay
+    QUEUED, so they do not count against their rule's concurrency limit
+    until they start, but are given a lease that keeps other workers from
+    claiming them.  The lease is the claim: `run_task` only starts a task
+    whose lease is still the one it was claimed with, so a task whose
+    claim expired while it waited behind a long running task and was
+    claimed by another worker is skipped rather than run twice.  The rows
+    are selected with `FOR UPDATE SKIP LOCKED` so concurrent workers claim
+    different tasks without waiting on each other.  On databases without
+    SKIP LOCKED each task is claimed with a conditional update instead.
+    :param batch_size: The maximum number of tasks to claim.  Defaults to
+    the QUARTET_CAPTURE_WORKER_BATCH_SIZE setting.
+    :return: A list of Task instances holding their claimed lease.
+    '''
+    from quartet_capture.tasks import TaskLease
+    batch_size = batch_size or WORKER_BATCH_SIZE
+    skip_locked = connection.features.has_select_for_update_skip_locked
+    now = timezone.now()
+    claim = {'dispatched': now, 'lease_expires': TaskLease.expiry()}
+    unclaimed = Q(lease_expires__isnull=True) | Q(lease_expires__lt=now)
+    with transaction.atomic():
+        tasks = DBTask.objects.filter(unclaimed, status='QUEUED').order_by(
+            'status_changed')
+        if skip_locked:
+            tasks = list(tasks.select_for_update(
+                skip_locked=True)[:batch_size])
+            DBTask.objects.filter(
+                name__in=[task.name for task in tasks]).update(**claim)
+        else:
+            tasks = [
+                task for task in tasks[:batch_size]
+                if DBTask.objects.filter(
+                    unclaimed, name=task.name, status='QUEUED'
+                ).update(**claim)
+            ]
+    rules = DBRule.objects.in_bulk({task.rule_id for task in tasks})
+    for task in tasks:
+        task.rule = rules[task.rule_id]
+        task.dispatched = claim['dispatched']
+        task.lease_expires = claim['lease_expires']
+    return tasks
+
+
+def start_claimed_task(db_task: DBTask) -> bool:
+    '''
+    Checks that a task claimed by `claim_tasks` is still claimed by this
+    worker and renews its lease for the run.
+    :param db_task: The claimed task.
+    :return: False if the claim expired and another worker claimed the
+    task or it is no longer QUEUED.
+    '''
+    from quartet_capture.tasks import TaskLease
+    expiry = TaskLease.expiry()
+    started = DBTask.objects.filter(
+        name=db_task.name, status='QUEUED',
+        lease_expires=db_task.lease_expires
+    ).update(lease_expires=expiry)
+    if started:
+        db_task.lease_expires = expiry
+    return bool(started)
+
+
+def release_tasks(tasks: List[DBTask]):
+    '''
+    Returns claimed tasks that were not started to the queue.
+    :param tasks: The claimed tasks.
+    '''
+    for task in tasks:
+        DBTask.objects.filter(
+            name=task.name, status='QUEUED', lease_expires=task.lease_expires
+        ).update(lease_expires=None, dispatched=None)
+
+
+def run_worker(stop: threading.Event, batch_size: int = None,
+               poll_interval: float = None,
+               exit_when_idle: bool = False) -> int:
+    '''
+    Claims and runs QUEUED tasks until `stop` is set.  The worker only
+    sleeps when the queue is empty.  When stopped the task being run is
+    finished and the rest of the batch is returned to the queue.
+    :param stop: An event that stops the worker.
+    :param batch_size: The number of tasks claimed at once.  Defaults to
+    the QUARTET_CAPTURE_WORKER_BATCH_SIZE setting.
+    :param poll_interval: The number of seconds to wait when the queue is
+    empty.  Defaults to the QUARTET_CAPTURE_WORKER_POLL_INTERVAL setting.
+    :param exit_when_idle: Return as soon as the queue is empty.
+    :return: The number of tasks run.
+    '''
+    from quartet_capture.tasks import run_task
+    poll_interval = WORKER_POLL_INTERVAL if poll_interval is None \
+        else poll_interval
+    count = 0
+    try:
+        while not stop.is_set():
+            try:
+                tasks = claim_tasks(batch_size)
+            except Exception:
+                logger.exception('Could not claim tasks.')
+                connections.close_all()
+                stop.wait(poll_interval)
+                continue
+            if not tasks:
+                if exit_when_idle:
+                    break
+                stop.wait(poll_interval)
+                continue
+            for number, task in enumerate(tasks):
+                if stop.is_set():
+                    release_tasks(tasks[number:])
+                    break
+                try:
+                    if run_task(task, claimed=True):
+                        count += 1
+                except Exception:
+                    logger.exception('Could not run task %s.', task.name)
+                    count += 1
+    finally:
+        connections.close_all()
+    return count
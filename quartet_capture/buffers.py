@@ -0,0 +1,166 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+'''
+Managed buffers for the intermediate data steps pass to one another.  A
+step can return a DataBuffer instead of bytes; the rule hands the same
+buffer to the next step without copying it and closes it, removing any
+temporary file, when the rule completes.
+'''
+import io
+import mmap
+import tempfile
+from django.conf import settings
+
+# buffers larger than this many bytes are moved to a temporary file
+SPILL_THRESHOLD = getattr(settings, 'QUARTET_CAPTURE_SPILL_THRESHOLD',
+                          8 * 1024 * 1024)
+# the directory the temporary files are created in (None is the system's
+# temporary directory)
+SPILL_DIRECTORY = getattr(settings, 'QUARTET_CAPTURE_SPILL_DIRECTORY', None)
+
+
+class DataBuffer:
+    '''
+    A binary file-like buffer that is kept in memory until it grows past
+    the spill threshold and is then moved to an anonymous temporary file.
+    Once on disk, `getbuffer` memory maps the file so large payloads can be
+    parsed or sliced without reading them onto the heap.
+    :param data: Optional initial contents.
+    :param threshold: The spill threshold in bytes, defaults to the
+    QUARTET_CAPTURE_SPILL_THRESHOLD setting.
+    '''
+
+    def __init__(self, data: bytes = None, threshold: int = None):
+        self.threshold = SPILL_THRESHOLD if threshold is None else threshold
+        self._file = io.BytesIO()
+        self._maps = []
+        if data:
+            self.write(data)
+            self.seek(0)
+
+    @property
+    def spilled(self) -> bool:
+        '''
+        True once the buffer has been moved to a temporary file.
+        '''
+        return not isinstance(self._file, io.BytesIO)
+
+    @property
+    def size(self) -> int:
+        position = self._file.tell()
+        size = self._file.seek(0, io.SEEK_END)
+        self._file.seek(position)
+        return size
+
+    @property
+    def closed(self) -> bool:
+        return self._file.closed
+
+    def write(self, data) -> int:
+        written = self._file.write(data)
+        if not self.spilled and self._file.tell() > self.threshold:
+            self.spill()
+        return written
+
+    def read(self, size: int = -1) -> bytes:
+        return self._file.read(size)
+
+    def readline(self, size: int = -1) -> bytes:
+        return self._file.readline(size)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        return self._file.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self._file.tell()
+
+    def readable(self) -> bool:
+        return True
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def flush(self):
+        self._file.flush()
+
+    def fileno(self) -> int:
+        '''
+        Spills the buffer, if it has not been already, so that it has a
+        file descriptor.
+        '''
+        self.spill()
+        return self._file.fileno()
+
+    def spill(self):
+        '''
+        Moves the buffer to a temporary file.  The file has no name on
+        POSIX systems and is removed when the buffer is closed.
+        '''
+        if self.spilled:
+            return
+        position = self._file.tell()
+        temp_file = tempfile.TemporaryFile(dir=SPILL_DIRECTORY)
+        temp_file.write(self._file.getbuffer())
+        temp_file.seek(position)
+        self._file.close()
+        self._file = temp_file
+
+    def getbuffer(self) -> memoryview:
+        '''
+        Returns a read-only view of the whole buffer without copying it.
+        Release the view before writing to the buffer again.
+        '''
+        if not self.spilled:
+            return self._file.getbuffer().toreadonly()
+        self._file.flush()
+        if not self.size:
+            return memoryview(b'')
+        mapped = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        return memoryview(mapped)
+
+    def getvalue(self) -> bytes:
+        '''
+        Returns a copy of the whole buffer as bytes.
+        '''
+        if not self.spilled:
+            return self._file.getvalue()
+        position = self._file.tell()
+        self._file.seek(0)
+        ret = self._file.read()
+        self._file.seek(position)
+        return ret
+
+    def close(self):
+        for mapped in self._maps:
+            try:
+                mapped.close()
+            except BufferError:
+                # a view is still exported, the map is freed with it
+                pass
+        self._maps = []
+        self._file.close()
+
+    def __len__(self):
+        return self.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
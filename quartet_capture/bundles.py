@@ -0,0 +1,243 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+'''
+Exports and imports rules, along with their parameters, steps and step
+parameters, as a compact, JSON serializable *bundle* so that rule sets can
+be copied between environments.  A bundle looks like this:
+
+    {
+        "version": 1,
+        "rules": [{
+            "name": "EPCIS",
+            "description": "Parses EPCIS.",
+            "max_concurrency": 0,
+            "bypass_admission_control": false,
+            "parameters": [["name", "value", "description"]],
+            "steps": [{
+                "name": "Parse",
+                "description": "Parse the EPCIS data.",
+                "step_class": "quartet_epcis.parsing.steps.EPCISParsingStep",
+                "order": 1,
+                "stage": null,
+                "parameters": [["name", "value", "description"]]
+            }]
+        }]
+    }
+
+Rule filters, tasks and task history are not part of a bundle.
+'''
+from logging import getLogger
+from typing import Iterable, List
+from django.db import transaction
+from django.db.models import Q
+from quartet_capture import models
+from quartet_capture.errors import RuleBundleError
+
+logger = getLogger('quartet_capture')
+
+BUNDLE_VERSION = 1
+
+
+def export_rules(rule_names: Iterable[str] = None) -> dict:
+    '''
+    Exports rules as a bundle using three queries regardless of the number
+    of rules.
+    :param rule_names: The names of the rules to export.  All rules are
+    exported if omitted.
+    :return: The bundle dictionary.
+    '''
+    rules = models.Rule.objects.prefetch_related(
+        'ruleparameter_set', 'step_set__stepparameter_set'
+    ).order_by('name')
+    if rule_names is not None:
+        rule_names = list(rule_names)
+        rules = rules.filter(name__in=rule_names)
+        missing = set(rule_names) - set(rule.name for rule in rules)
+        if missing:
+            raise models.Rule.DoesNotExist(
+                'Rules %s do not exist.' % ', '.join(sorted(missing)))
+    return {
+        'version': BUNDLE_VERSION,
+        'rules': [{
+            'name': rule.name,
+            'description': rule.description,
+            'max_concurrency': rule.max_concurrency,
+            'bypass_admission_control': rule.bypass_admission_control,
+            'parameters': _export_parameters(rule.ruleparameter_set.all()),
+            'steps': [{
+                'name': step.name,
+                'description': step.description,
+                'step_class': step.step_class,
+                'order': step.order,
+                'stage': step.stage,
+                'parameters': _export_parameters(
+                    step.stepparameter_set.all()),
+            } for step in rule.step_set.all()]
+        } for rule in rules]
+    }
+
+
+def import_rules(bundle: dict, replace: bool = True) -> List[models.Rule]:
+    '''
+    Imports the rules in a bundle in a single transaction with a fixed
+    number of bulk queries.  Rules that do not exist are created.  Rules
+    that already exist are updated in place, so their rule filters and
+    tasks are kept.  Their steps (by name and order) and parameters (by
+    name) are updated in place as well, the ones that are not in the bundle
+    are deleted and the new ones are created.  Importing the same bundle
+    twice therefore leaves the database unchanged, primary keys included.
+    :param bundle: The bundle dictionary (see `export_rules`).
+    :param replace: If False, a RuleBundleError is raised if any of the
+    rules in the bundle already exists.
+    :return: The imported rules in bundle order.
+    '''
+    rule_data = _validate(bundle)
+    names = [data['name'] for data in rule_data]
+    with transaction.atomic():
+        existing = {rule.name: rule for rule in
+                    models.Rule.objects.select_for_update().filter(
+                        name__in=names)}
+        if existing and not replace:
+            raise RuleBundleError(
+                'Rules %s already exist.', ', '.join(sorted(existing)))
+        new_rules = []
+        for data in rule_data:
+            rule = existing.get(data['name']) or models.Rule(
+                name=data['name'])
+            rule.description = data.get('description')
+            rule.max_concurrency = data.get('max_concurrency', 0)
+            rule.bypass_admission_control = data.get(
+                'bypass_admission_control', False)
+            if rule.pk is None:
+                new_rules.append(rule)
+        models.Rule.objects.bulk_update(
+            existing.values(), ['description', 'max_concurrency',
+                                'bypass_admission_control'])
+        models.Rule.objects.bulk_create(new_rules)
+        # not all databases return the primary keys of bulk created rows
+        rules = {rule.name: rule for rule in
+                 models.Rule.objects.filter(name__in=names)}
+        rule_parameters = {}
+        steps = {}
+        for data in rule_data:
+            rule = rules[data['name']]
+            for name, value, description in data.get('parameters', []):
+                rule_parameters[(rule.id, name)] = models.RuleParameter(
+                    rule=rule, name=name, value=value,
+                    description=description)
+            for step in data.get('steps', []):
+                steps[(rule.id, step['name'], step['order'])] = models.Step(
+                    rule=rule, name=step['name'],
+                    description=step.get('description'),
+                    step_class=step['step_class'],
+                    order=step['order'], stage=step.get('stage'))
+        _sync_rows(models.RuleParameter, {
+            (parameter.rule_id, parameter.name): parameter
+            for parameter in models.RuleParameter.objects.filter(
+                rule__in=rules.values())
+        }, rule_parameters, ['value', 'description'])
+        # the parameters of deleted steps are removed by the cascade
+        _sync_rows(models.Step, {
+            (step.rule_id, step.name, step.order): step
+            for step in models.Step.objects.filter(rule__in=rules.values())
+        }, steps, ['description', 'step_class', 'stage'])
+        step_ids = {(step.rule_id, step.name, step.order): step.id
+                    for step in models.Step.objects.filter(
+                rule__in=rules.values()).only('id', 'rule', 'name', 'order')}
+        step_parameters = {}
+        for data in rule_data:
+            rule = rules[data['name']]
+            for step in data.get('steps', []):
+                step_id = step_ids[(rule.id, step['name'], step['order'])]
+                for name, value, description in step.get('parameters', []):
+                    step_parameters[(step_id, name)] = models.StepParameter(
+                        step_id=step_id, name=name, value=value,
+                        description=description)
+        _sync_rows(models.StepParameter, {
+            (parameter.step_id, parameter.name): parameter
+            for parameter in models.StepParameter.objects.filter(
+                step__rule__in=rules.values())
+        }, step_parameters, ['value', 'description'])
+    logger.debug('Imported %s rules (%s new).', len(rules), len(new_rules))
+    return [rules[name] for name in names]
+
+
+def _sync_rows(model_type, existing: dict, wanted: dict, fields: list):
+    '''
+    Makes the stored rows match the wanted ones with at most one delete,
+    one update and one insert query.  Both dictionaries are keyed by the
+    rows' natural keys.
+    :param model_type: The model class.
+    :param existing: The stored rows.
+    :param wanted: The unsaved instances the rows should match.
+    :param fields: The fields to update on rows that are kept.
+    '''
+    stale = [row.pk for key, row in existing.items() if key not in wanted]
+    if stale:
+        model_type.objects.filter(pk__in=stale).delete()
+    changed = []
+    for key, row in wanted.items():
+        current = existing.get(key)
+        if current is not None and any(
+            getattr(current, field) != getattr(row, field)
+            for field in fields):
+            for field in fields:
+                setattr(current, field, getattr(row, field))
+            changed.append(current)
+    if changed:
+        model_type.objects.bulk_update(changed, fields)
+    model_type.objects.bulk_create(
+        [row for key, row in wanted.items() if key not in existing])
+
+
+def unique_name(model_type, base_name: str, new_name: str = None) -> str:
+    '''
+    Returns `new_name` if no instance of the model type has that name, or
+    else the first free `[base_name]_copy_[n]` name.  The names in use are
+    read with a single query.
+    :param model_type: A model class with a unique `name` field.
+    :param base_name: The name the copy names are derived from.
+    :param new_name: The preferred name (optional).
+    :return: A name that is not in use.
+    '''
+    prefix = '%s_copy_' % base_name
+    taken = set(model_type.objects.filter(
+        Q(name=new_name or prefix) | Q(name__startswith=prefix)
+    ).values_list('name', flat=True))
+    if new_name and new_name not in taken:
+        return new_name
+    i = 1
+    while '%s%s' % (prefix, i) in taken:
+        i += 1
+    return '%s%s' % (prefix, i)
+
+
+def _export_parameters(parameters) -> list:
+    return [[parameter.name, parameter.value, parameter.description]
+            for parameter in parameters]
+
+
+def _validate(bundle: dict) -> list:
+    if not isinstance(bundle, dict) or 'rules' not in bundle:
+        raise RuleBundleError('The rule bundle has no rules.')
+    if bundle.get('version') != BUNDLE_VERSION:
+        raise RuleBundleError('Unsupported rule bundle version %s.',
+                              bundle.get('version'))
+    names = [data.get('name') for data in bundle['rules']]
+    if not all(names):
+        raise RuleBundleError('Every rule in the bundle needs a name.')
+    if len(set(names)) != len(names):
+        raise RuleBundleError('The rule bundle contains duplicate rules.')
+    return bundle['rules']
@@ -0,0 +1,91 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+'''
+Fast row counts for the large, append-mostly tables (Task, TaskHistory)
+where exact `COUNT(*)` queries get slow as the tables grow.  This module
+does not depend on the Django Rest Framework so the admin can use it.
+'''
+import json
+from logging import getLogger
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import QuerySet
+from django.utils.functional import cached_property
+
+logger = getLogger('quartet_capture')
+
+# Estimates below this value are replaced by an exact count since small
+# counts are cheap and users notice when they are off.
+APPROXIMATE_COUNT_THRESHOLD = getattr(
+    settings, 'QUARTET_CAPTURE_APPROXIMATE_COUNT_THRESHOLD', 10000)
+
+
+def approximate_count(queryset: QuerySet) -> int:
+    '''
+    Returns a fast, approximate row count for the queryset.  On PostgreSQL
+    the planner's estimate is used (the `pg_class` statistics for
+    unfiltered querysets and an `EXPLAIN` estimate for filtered ones).  If
+    the estimate is unavailable, below the
+    `QUARTET_CAPTURE_APPROXIMATE_COUNT_THRESHOLD` or the database is not
+    PostgreSQL, an exact `count()` is returned instead.
+    :param queryset: The queryset to count.
+    :return: The (approximate) number of rows.
+    '''
+    connection = connections[queryset.db]
+    if connection.vendor == 'postgresql':
+        try:
+            estimate = _postgres_estimate(queryset, connection)
+        except Exception:
+            logger.exception('Could not estimate the row count.')
+            estimate = None
+        if estimate is not None and estimate >= APPROXIMATE_COUNT_THRESHOLD:
+            return estimate
+    return queryset.count()
+
+
+def _postgres_estimate(queryset: QuerySet, connection):
+    '''
+    Asks the PostgreSQL planner how many rows the queryset will return.
+    :return: The estimate or None if the table has never been analyzed.
+    '''
+    with connection.cursor() as cursor:
+        if not queryset.query.where:
+            cursor.execute(
+                'SELECT reltuples::bigint FROM pg_class WHERE relname = %s',
+                [queryset.model._meta.db_table]
+            )
+            row = cursor.fetchone()
+            # reltuples is -1 (or 0) for tables that were never analyzed
+            return row[0] if row and row[0] > 0 else None
+        sql, params = queryset.query.sql_with_params()
+        cursor.execute('EXPLAIN (FORMAT JSON) %s' % sql, params)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
+
+class ApproximateCountPaginator(Paginator):
+    '''
+    A django Paginator for the admin changelists that uses
+    `approximate_count` instead of `COUNT(*)`.
+    '''
+
+    @cached_property
+    def count(self):
+        if isinstance(self.object_list, QuerySet):
+            return approximate_count(self.object_list)
+        return super().count
@@ -47,3 +47,31 @@ class TaskExecutionError(BaseCaptureError):
     Thrown when a task fails.
     """
     pass
+
+
+class TaskDependencyError(BaseCaptureError):
+    """
+    Thrown when a task declares a dependency on a task or rule that
+    does not exist.
+    """
+    pass
+
+
+class RuleBundleError(BaseCaptureError):
+    """
+    Thrown when a rule bundle is malformed or of an unsupported version.
+    """
+    pass
+
+
+class TaskDeferred(BaseCaptureError):
+    """
+    Thrown when a task that was to be run immediately was parked in the
+    WAITING state instead, because its rule is at its concurrency limit or
+    the task has outstanding dependencies.  The task runs once it is
+    released; it is available as the `task` attribute.
+    """
+
+    def __init__(self, task, *args: object) -> None:
+        super().__init__(*args)
+        self.task = task
@@ -0,0 +1,148 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+'''
+Idempotent capture.  A client that retries a capture request with the
+same `Idempotency-Key` header (or, if QUARTET_CAPTURE_IDEMPOTENCY_BODY_HASH
+is set, the same message) within QUARTET_CAPTURE_IDEMPOTENCY_TTL seconds
+gets the task created by the original request back and nothing is stored
+or queued again.  Keys are kept in the IdempotencyKey table rather than
+the Django cache so that they are shared by every web process without
+any cache configuration.
+'''
+import hashlib
+from datetime import timedelta
+from logging import getLogger
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from quartet_capture.models import IdempotencyKey, Task
+
+logger = getLogger('quartet_capture')
+
+# how long, in seconds, a key is remembered
+IDEMPOTENCY_TTL = getattr(settings, 'QUARTET_CAPTURE_IDEMPOTENCY_TTL',
+                          86400)
+# whether requests without a key are de-duplicated by their message
+IDEMPOTENCY_BODY_HASH = getattr(settings,
+                                'QUARTET_CAPTURE_IDEMPOTENCY_BODY_HASH',
+                                False)
+# how long, in seconds, a claimed key that has no task yet is held for the
+# request processing it before a retry may take it over
+IDEMPOTENCY_LEASE = getattr(settings, 'QUARTET_CAPTURE_IDEMPOTENCY_LEASE',
+                            300)
+IDEMPOTENCY_HEADER = 'HTTP_IDEMPOTENCY_KEY'
+
+
+class KeyInUse(Exception):
+    '''
+    Raised when a request with the same key is still being processed.
+    '''
+    pass
+
+
+def get_key(request, message, scope: str = '') -> str:
+    '''
+    Returns the key identifying the request or None if the request should
+    not be de-duplicated.  Keys are scoped to the user and to the query
+    string (the rule or filter) so different clients can not collide.
+    :param request: The capture request.
+    :param message: The captured message (a string or uploaded file).
+    :param scope: Extra text to scope the key by.
+    :return: A hex digest or None.
+    '''
+    header = request.META.get(IDEMPOTENCY_HEADER)
+    digest = hashlib.sha256()
+    user = getattr(request, 'user', None)
+    digest.update(('%s\n%s\n%s\n' % (getattr(user, 'id', None),
+                                     request.META.get('QUERY_STRING', ''),
+                                     scope)).encode('utf-8'))
+    if header:
+        digest.update(b'key\n' + header.encode('utf-8'))
+    elif IDEMPOTENCY_BODY_HASH:
+        digest.update(b'body\n')
+        if hasattr(message, 'chunks'):
+            for chunk in message.chunks():
+                digest.update(chunk)
+            message.seek(0)
+        elif isinstance(message, bytes):
+            digest.update(message)
+        else:
+            digest.update(str(message).encode('utf-8'))
+    else:
+        return None
+    return digest.hexdigest()
+
+
+def claim(key: str) -> Task:
+    '''
+    Claims the key for the current request.  A key whose original request
+    has not recorded a task within QUARTET_CAPTURE_IDEMPOTENCY_LEASE
+    seconds is assumed to have lost its process (for example to a worker
+    timeout) and is taken over.
+    :param key: The key from `get_key`.
+    :return: None if the key was claimed, in which case `complete` or
+    `release` must be called, or the task of the original request.
+    :raises KeyInUse: If the original request is still being processed.
+    '''
+    cutoff = timezone.now() - timedelta(seconds=IDEMPOTENCY_TTL)
+    IdempotencyKey.objects.filter(key=key, created__lt=cutoff).delete()
+    try:
+        with transaction.atomic():
+            IdempotencyKey.objects.create(key=key)
+        return None
+    except IntegrityError:
+        existing = IdempotencyKey.objects.select_related('task').filter(
+            key=key).first()
+        if existing is None:
+            # the original request failed and released the key
+            return claim(key)
+        if existing.task is None:
+            now = timezone.now()
+            # only one retry can take over a stale claim
+            taken = IdempotencyKey.objects.filter(
+                key=key, task__isnull=True,
+                created__lt=now - timedelta(seconds=IDEMPOTENCY_LEASE)
+            ).update(created=now)
+            if not taken:
+                raise KeyInUse()
+            logger.warning('Taking over the idempotency key of a capture '
+                           'request that did not complete.')
+            return None
+        logger.info('Returning task %s for a repeated capture request.',
+                    existing.task_id)
+        return existing.task
+
+
+def complete(key: str, task: Task):
+    '''
+    Records the task created for a claimed key.
+    '''
+    IdempotencyKey.objects.filter(key=key).update(task=task)
+
+
+def release(key: str):
+    '''
+    Releases a claimed key after the request failed so it can be retried.
+    '''
+    IdempotencyKey.objects.filter(key=key, task__isnull=True).delete()
+
+
+def remove_expired() -> int:
+    '''
+    Deletes the keys older than QUARTET_CAPTURE_IDEMPOTENCY_TTL.
+    :return: The number of keys deleted.
+    '''
+    cutoff = timezone.now() - timedelta(seconds=IDEMPOTENCY_TTL)
+    return IdempotencyKey.objects.filter(created__lt=cutoff).delete()[0]
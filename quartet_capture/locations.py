@@ -0,0 +1,235 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+'''
+Builds the storage keys of task messages.  A message used to always be
+stored as `<task name>.dat` at the root of the storage, which puts
+millions of files in a single directory.  The configured layout shards
+the keys by date and/or by a hash prefix of the task name and the key is
+recorded in `Task.location`.  Tasks without a location use the old flat
+key.
+'''
+import hashlib
+import time
+from datetime import datetime
+from logging import getLogger
+from django.conf import settings
+from django.core.files.storage import get_storage_class
+from django.utils import timezone
+from quartet_capture.models import Task as DBTask
+
+logger = getLogger('quartet_capture')
+
+# the storage key formats, {name} is the task name, {hash} the first hash
+# levels and the date fields are those of the date the message was stored
+LAYOUTS = {
+    'flat': '{name}.dat',
+    'date': '{year}/{month}/{day}/{name}.dat',
+    'hash': '{hash}/{name}.dat',
+    'date-hash': '{year}/{month}/{day}/{hash}/{name}.dat',
+}
+STORAGE_LAYOUT = getattr(settings, 'QUARTET_CAPTURE_STORAGE_LAYOUT', 'flat')
+# the number of two character directory levels of the hash layouts
+HASH_LEVELS = getattr(settings, 'QUARTET_CAPTURE_STORAGE_HASH_LEVELS', 2)
+# the dotted path of the storage class of task messages, by default the
+# default file storage
+MESSAGE_STORAGE = getattr(settings, 'QUARTET_CAPTURE_MESSAGE_STORAGE', None)
+# how long, in seconds, the old copy of a moved message is kept so that a
+# worker that loaded the task before the move can still read it
+DELETE_GRACE = getattr(settings, 'QUARTET_CAPTURE_STORAGE_DELETE_GRACE', 60)
+
+
+def build_location(task_name: str, date: datetime = None,
+                   layout: str = None) -> str:
+    '''
+    Returns the storage key of a task's message.
+    :param task_name: The name of the task.
+    :param date: The date the message is stored.  Defaults to now.
+    :param layout: One of the LAYOUTS or a format string using the same
+    fields.  Defaults to the QUARTET_CAPTURE_STORAGE_LAYOUT setting.
+    :return: The storage key.
+    '''
+    layout = layout or STORAGE_LAYOUT
+    date = date or timezone.now()
+    digest = hashlib.md5(task_name.encode('utf-8')).hexdigest()
+    return LAYOUTS.get(layout, layout).format(
+        name=task_name,
+        hash='/'.join(digest[level * 2:level * 2 + 2]
+                      for level in range(HASH_LEVELS)),
+        year='%04d' % date.year, month='%02d' % date.month,
+        day='%02d' % date.day)
+
+
+def get_message_storage():
+    '''
+    Returns an instance of the storage of task messages.
+    '''
+    return get_storage_class(MESSAGE_STORAGE)()
+
+
+def open_message(location: str):
+    '''
+    Opens a stored message from whichever storage tier holds it.
+    :param location: The storage key of the message.
+    '''
+    if location.startswith('archive:'):
+        from quartet_capture.tiers import ArchiveStorage
+        return ArchiveStorage().open(location)
+    return get_message_storage().open(location)
+
+
+def get_location(db_task: DBTask) -> str:
+    '''
+    Returns the storage key of the task's message.
+    :param db_task: The task.
+    '''
+    return db_task.location or '{0}.dat'.format(db_task.name)
+
+
+def open_task_message(db_task: DBTask):
+    '''
+    Opens the stored message of a task.  If the message was moved, and its
+    old copy deleted, since the task was loaded, the task's location is
+    reloaded and the message is opened from there.
+    :param db_task: The task.
+    '''
+    location = get_location(db_task)
+    try:
+        return open_message(location)
+    except OSError:
+        db_task.refresh_from_db(fields=['location'])
+        if get_location(db_task) == location:
+            raise
+        logger.debug('The message of task %s was moved while it was read.',
+                     db_task.name)
+        return open_message(get_location(db_task))
+
+
+class DeferredDeletes:
+    '''
+    Deletes the old copies of moved messages once they are older than the
+    grace period.
+    :param delete: A callable that deletes a location.
+    :param grace: The grace period in seconds.  Defaults to the
+    QUARTET_CAPTURE_STORAGE_DELETE_GRACE setting.
+    '''
+
+    def __init__(self, delete, grace: float = None):
+        self.delete = delete
+        self.grace = DELETE_GRACE if grace is None else grace
+        # (time moved, location) tuples, oldest first
+        self.pending = []
+
+    def add(self, location: str):
+        self.pending.append((time.time(), location))
+        self.run()
+
+    def run(self, wait: bool = False):
+        '''
+        Deletes the locations whose grace period has passed.
+        :param wait: Wait for the grace period of every pending location.
+        '''
+        while self.pending:
+            moved, location = self.pending[0]
+            delay = moved + self.grace - time.time()
+            if delay > 0:
+                if not wait:
+                    return
+                time.sleep(delay)
+            self.pending.pop(0)
+            try:
+                self.delete(location)
+            except Exception:
+                logger.exception('Could not delete %s.', location)
+
+
+def reshard_tasks(layout: str = None, batch_size: int = 500,
+                  rate: float = 0, limit: int = None, progress=None,
+                  grace: float = None) -> int:
+    '''
+    Moves the stored messages of existing tasks to the keys of a layout.
+    Each message is copied to its new key and the task's location is
+    updated.  The old file is only deleted once the grace period has
+    passed, so a worker that loaded the task before the move can still
+    read it, and readers that find it gone reload the task's location.  An
+    interrupted run can simply be started again.  Messages already at their
+    key are skipped.
+    :param layout: The target layout.  Defaults to the
+    QUARTET_CAPTURE_STORAGE_LAYOUT setting.
+    :param batch_size: The number of tasks loaded per query.
+    :param rate: The maximum number of messages moved per second so that
+    resharding does not starve the capture traffic.  Zero is unlimited.
+    :param limit: The maximum number of messages to move.
+    :param progress: An optional callable that is passed the number of
+    messages moved and the number of tasks checked so far.
+    :param grace: The number of seconds the old files are kept.  Defaults
+    to the QUARTET_CAPTURE_STORAGE_DELETE_GRACE setting.  The function
+    waits for the grace period of the last files before returning.
+    :return: The number of messages moved.
+    '''
+    storage = get_message_storage()
+    deletes = DeferredDeletes(storage.delete, grace)
+    moved = checked = 0
+    start = time.time()
+    last_name = ''
+    while limit is None or moved < limit:
+        tasks = list(DBTask.objects.filter(name__gt=last_name).order_by(
+            'name').only('name', 'location', 'status_changed')[
+                     :batch_size])
+        if not tasks:
+            break
+        last_name = tasks[-1].name
+        for db_task in tasks:
+            if limit is not None and moved >= limit:
+                break
+            checked += 1
+            old_location = get_location(db_task)
+            new_location = build_location(
+                db_task.name, db_task.status_changed, layout)
+            # records of segment files are moved by compact_segments
+            if old_location == new_location or '@' in old_location:
+                continue
+            if rate:
+                delay = start + moved / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            try:
+                if _move(storage, db_task, old_location, new_location):
+                    deletes.add(old_location)
+                    moved += 1
+            except Exception:
+                logger.exception('Could not reshard the message of task %s.',
+                                 db_task.name)
+        if progress:
+            progress(moved, checked)
+    deletes.run(wait=True)
+    return moved
+
+
+def _move(storage, db_task: DBTask, old_location: str,
+          new_location: str) -> bool:
+    if not storage.exists(old_location):
+        return False
+    if storage.exists(new_location):
+        # left behind by an interrupted run, the task does not point to it
+        storage.delete(new_location)
+    with storage.open(old_location) as message_file:
+        new_location = storage.save(new_location, message_file)
+    # only switch the task over if nothing else moved it in the meantime
+    updated = DBTask.objects.filter(
+        name=db_task.name, location=db_task.location
+    ).update(location=new_location)
+    if not updated:
+        storage.delete(new_location)
+    return bool(updated)
@@ -0,0 +1,48 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+from quartet_capture.tiers import archive_tasks
+
+
+class Command(BaseCommand):
+    help = _('Moves the messages of completed tasks to the compressed '
+             'archive tier.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=float,
+                            help='Archive tasks whose status changed more '
+                                 'than this many days ago.  Defaults to '
+                                 'QUARTET_CAPTURE_ARCHIVE_AFTER_DAYS.')
+        parser.add_argument('--status', action='append',
+                            help='Archive tasks with this status.  May be '
+                                 'repeated.  Defaults to '
+                                 'QUARTET_CAPTURE_ARCHIVE_STATUSES.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='The number of tasks loaded per query.')
+        parser.add_argument('--limit', type=int,
+                            help='The maximum number of messages to archive.')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='The maximum number of messages archived '
+                                 'per second.  Zero is unlimited.')
+
+    def handle(self, *args, **options):
+        archived = archive_tasks(
+            days=options['days'], statuses=options['status'],
+            batch_size=options['batch_size'], limit=options['limit'],
+            rate=options['rate'],
+            progress=lambda archived: self.stdout.write(
+                'Archived %s messages.' % archived))
+        self.stdout.write('Archived %s messages in total.' % archived)
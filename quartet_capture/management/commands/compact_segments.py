@@ -0,0 +1,50 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+from quartet_capture.locations import get_message_storage
+from quartet_capture.tiers import ArchiveStorage
+from quartet_capture.segments import SegmentStorage, compact_segments, \
+    recover_segments
+
+
+class Command(BaseCommand):
+    help = _('Truncates the records torn by a crash from the message '
+             'segment files and rewrites the segments whose messages have '
+             'mostly been purged.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threshold', type=float, default=0.5,
+                            help='Rewrite segments whose live messages make '
+                                 'up less than this fraction of the file.')
+        parser.add_argument('--archive', action='store_true',
+                            help='Compact the archive packs instead of the '
+                                 'message segments.')
+        parser.add_argument('--recover-only', action='store_true',
+                            help='Only truncate damaged segment tails.')
+
+    def handle(self, *args, **options):
+        if options['archive']:
+            storage = ArchiveStorage()
+        else:
+            storage = get_message_storage()
+            if not isinstance(storage, SegmentStorage):
+                storage = SegmentStorage()
+        if options['recover_only']:
+            self.stdout.write(
+                'Truncated %s bytes.' % recover_segments(storage))
+        else:
+            self.stdout.write('Reclaimed %s bytes.' % compact_segments(
+                options['threshold'], storage))
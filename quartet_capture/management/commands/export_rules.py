@@ -0,0 +1,44 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import gettext as _
+from quartet_capture.bundles import export_rules
+from quartet_capture.models import Rule
+
+
+class Command(BaseCommand):
+    help = _('Exports rules, with their parameters and steps, as a JSON '
+             'rule bundle that can be loaded with the import_rules '
+             'command.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('rules', nargs='*',
+                            help='The names of the rules to export.  All '
+                                 'rules are exported if none are given.')
+        parser.add_argument('--output', '-o',
+                            help='The file to write the bundle to.  '
+                                 'Defaults to standard output.')
+
+    def handle(self, *args, **options):
+        try:
+            bundle = export_rules(options['rules'] or None)
+        except Rule.DoesNotExist as e:
+            raise CommandError(str(e))
+        if options['output']:
+            with open(options['output'], 'w') as bundle_file:
+                json.dump(bundle, bundle_file, indent=1)
+        else:
+            self.stdout.write(json.dumps(bundle, indent=1))
@@ -0,0 +1,40 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import json
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.translation import gettext as _
+from quartet_capture.bundles import import_rules
+from quartet_capture.errors import RuleBundleError
+
+
+class Command(BaseCommand):
+    help = _('Imports the rules in a JSON rule bundle created by the '
+             'export_rules command.  Existing rules are updated in place.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('bundle',
+                            help='The path of the rule bundle file.')
+        parser.add_argument('--no-replace', action='store_true',
+                            help='Fail, without importing anything, if any '
+                                 'of the rules already exists.')
+
+    def handle(self, *args, **options):
+        try:
+            with open(options['bundle']) as bundle_file:
+                bundle = json.load(bundle_file)
+            rules = import_rules(bundle, replace=not options['no_replace'])
+        except (OSError, ValueError, RuleBundleError) as e:
+            raise CommandError(str(e))
+        self.stdout.write('Imported %s rules.' % len(rules))
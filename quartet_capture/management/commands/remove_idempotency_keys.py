@@ -0,0 +1,27 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+from quartet_capture.idempotency import remove_expired
+
+
+class Command(BaseCommand):
+    help = _('Removes the capture idempotency keys older than the '
+             'QUARTET_CAPTURE_IDEMPOTENCY_TTL setting.  Schedule this to '
+             'keep the idempotency key table small.')
+
+    def handle(self, *args, **options):
+        self.stdout.write('Removed %s expired idempotency keys.' %
+                          remove_expired())
@@ -0,0 +1,267 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import inspect
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from pydoc import locate
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.translation import gettext as _
+from quartet_capture.models import Rule as DBRule, Task, TaskParameter
+from quartet_capture.rules import Rule, Step, step_pool
+from quartet_capture.tasks import read_task_data
+
+
+class StubStep(Step):
+    '''
+    Stands in for a side-effecting step during a replay.  The data is
+    passed through to the next step unchanged.
+    '''
+
+    def execute(self, data, rule_context):
+        return data
+
+    @property
+    def declared_parameters(self):
+        return {}
+
+    def on_failure(self):
+        pass
+
+
+class Command(BaseCommand):
+    help = _('Replays stored task payloads through a rule for load testing '
+             'and regression timing and reports throughput, latency and '
+             'per-step timings.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rule',
+                            help='Only replay tasks of this rule.')
+        parser.add_argument('--status',
+                            help='Only replay tasks with this status.')
+        parser.add_argument('--since',
+                            help='Only replay tasks whose status changed on '
+                                 'or after this ISO date/time.')
+        parser.add_argument('--until',
+                            help='Only replay tasks whose status changed '
+                                 'before this ISO date/time.')
+        parser.add_argument('--limit', type=int, default=100,
+                            help='The maximum number of tasks to replay.')
+        parser.add_argument('--target-rule',
+                            help='Replay the payloads through this rule '
+                                 'instead of each task\'s own rule.')
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='The number of tasks to replay at once.')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='The maximum number of tasks started per '
+                                 'second.  Zero is unlimited.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Roll back all database changes made by '
+                                 'each replay, including the replay task.  '
+                                 'Not available with --concurrency or rules '
+                                 'with concurrent stages or async steps.')
+        parser.add_argument('--stub', action='append', default=[],
+                            help='The name or class path of a step to '
+                                 'replace with a pass-through step, for '
+                                 'example a step that sends data to a '
+                                 'partner.  May be repeated.')
+
+    def handle(self, *args, **options):
+        target_rule = None
+        if options['target_rule']:
+            try:
+                target_rule = DBRule.objects.get(name=options['target_rule'])
+            except DBRule.DoesNotExist:
+                raise CommandError('Rule %s does not exist.' %
+                                   options['target_rule'])
+        tasks = list(self.get_tasks(options))
+        if options['dry_run']:
+            self.check_dry_run(tasks, target_rule, options)
+        self.stdout.write('Replaying %s tasks.' % len(tasks))
+        results = []
+        start = time.perf_counter()
+        interval = 1 / options['rate'] if options['rate'] else 0
+        replay_args = (target_rule, options['dry_run'], options['stub'])
+        if options['concurrency'] > 1:
+            with ThreadPoolExecutor(
+                max_workers=options['concurrency']) as pool:
+                futures = []
+                for number, task in enumerate(tasks):
+                    self.wait_for_slot(start, number, interval)
+                    futures.append(pool.submit(self.replay_in_thread, task,
+                                               *replay_args))
+                results = [future.result() for future in futures]
+        else:
+            for number, task in enumerate(tasks):
+                self.wait_for_slot(start, number, interval)
+                results.append(self.replay(task, *replay_args))
+        self.report(results, time.perf_counter() - start)
+
+    def get_tasks(self, options):
+        tasks = Task.objects.select_related('rule').exclude(type='Replay')
+        if options['rule']:
+            tasks = tasks.filter(rule__name=options['rule'])
+        if options['status']:
+            tasks = tasks.filter(status=options['status'])
+        if options['since']:
+            tasks = tasks.filter(
+                status_changed__gte=self.parse_time(options['since']))
+        if options['until']:
+            tasks = tasks.filter(
+                status_changed__lt=self.parse_time(options['until']))
+        return tasks.order_by('status_changed')[:options['limit']]
+
+    def check_dry_run(self, tasks: list, target_rule: DBRule, options):
+        '''
+        A dry run can only roll back the changes made on the connection of
+        the thread running the replay.  Refuses the dry run if the replays
+        would write through other threads' connections: concurrent replays,
+        steps sharing an execution stage or async steps.
+        '''
+        if options['concurrency'] > 1:
+            raise CommandError('--dry-run can not be combined with '
+                               '--concurrency, the changes made by other '
+                               'threads can not be rolled back.')
+        db_rules = {target_rule} if target_rule else {task.rule
+                                                       for task in tasks}
+        for db_rule in db_rules:
+            previous = None
+            for db_step in db_rule.step_set.order_by('order'):
+                concurrent = db_step.stage is not None and \
+                             db_step.stage == previous
+                previous = db_step.stage
+                stubbed = db_step.name in options['stub'] or \
+                          db_step.step_class in options['stub']
+                if concurrent or not stubbed and inspect.iscoroutinefunction(
+                    getattr(locate(db_step.step_class), 'execute', None)):
+                    raise CommandError(
+                        '--dry-run can not be used with rule %s, step %s '
+                        'runs on another thread and its changes can not be '
+                        'rolled back.' % (db_rule.name, db_step.name))
+
+    def parse_time(self, value: str):
+        ret = parse_datetime(value) or parse_date(value)
+        if ret is None:
+            raise CommandError('%s is not a valid ISO date/time.' % value)
+        return ret
+
+    def wait_for_slot(self, start: float, number: int, interval: float):
+        '''
+        Paces the replays so that no more than `rate` start per second.
+        '''
+        if interval:
+            delay = start + number * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    def replay_in_thread(self, task: Task, *args):
+        try:
+            return self.replay(task, *args)
+        finally:
+            connections.close_all()
+
+    def replay(self, task: Task, target_rule: DBRule, dry_run: bool,
+               stubs: list):
+        '''
+        Executes the stored payload of the task through the target rule.
+        :return: A tuple of (success, seconds, {step name: seconds}).
+        '''
+        data = read_task_data(task)
+        if dry_run:
+            with transaction.atomic():
+                result = self.run_rule(task, data, target_rule, stubs,
+                                       savepoint=True)
+                transaction.set_rollback(True)
+            return result
+        return self.run_rule(task, data, target_rule, stubs)
+
+    def run_rule(self, task: Task, data, target_rule: DBRule, stubs: list,
+                 savepoint: bool = False):
+        '''
+        :param savepoint: Run the rule in a savepoint so that a database
+        error in a step does not break the enclosing dry run transaction.
+        '''
+        db_rule = target_rule or task.rule
+        replay_task = Task.objects.create(rule=db_rule, type='Replay',
+                                          status='RUNNING')
+        TaskParameter.objects.bulk_create([
+            TaskParameter(task=replay_task, name=param.name,
+                          value=param.value, description=param.description)
+            for param in task.taskparameter_set.all()
+        ])
+        start = time.perf_counter()
+        success = True
+        rule = None
+        try:
+            with transaction.atomic() if savepoint else nullcontext():
+                rule = Rule(db_rule, replay_task)
+                self.stub_steps(rule, replay_task, stubs)
+                rule.execute(data)
+            replay_task.status = 'FINISHED'
+        except Exception as e:
+            self.stderr.write('Replay of task %s failed: %s' % (task.name, e))
+            replay_task.status = 'FAILED'
+            success = False
+        elapsed = time.perf_counter() - start
+        replay_task.execution_time = elapsed
+        replay_task.save()
+        step_times = {}
+        if rule:
+            step_times = {rule.steps[number].db_step.name: seconds
+                          for number, seconds in rule.step_times.items()}
+        return success, elapsed, step_times
+
+    def stub_steps(self, rule: Rule, db_task: Task, stubs: list):
+        for number, step in list(rule.steps.items()):
+            db_step = step.db_step
+            if db_step.name in stubs or db_step.step_class in stubs:
+                if step.reusable:
+                    step_pool.release(step)
+                else:
+                    step.teardown()
+                stub = StubStep(db_task)
+                stub.db_step = db_step
+                rule.steps[number] = stub
+
+    def report(self, results: list, elapsed: float):
+        if not results:
+            return
+        latencies = sorted(seconds for success, seconds, steps in results)
+        failures = len([success for success, seconds, steps in results
+                        if not success])
+        self.stdout.write(
+            'Replayed %s tasks in %.3fs (%.2f tasks/s), %s failed.' % (
+                len(results), elapsed, len(results) / elapsed, failures))
+        self.stdout.write(
+            'Latency: p50 %.1fms, p95 %.1fms, max %.1fms' % (
+                self.percentile(latencies, 50) * 1000,
+                self.percentile(latencies, 95) * 1000,
+                latencies[-1] * 1000))
+        step_times = defaultdict(list)
+        for success, seconds, steps in results:
+            for name, step_seconds in steps.items():
+                step_times[name].append(step_seconds)
+        self.stdout.write('Step timings (mean / max):')
+        for name, times in step_times.items():
+            self.stdout.write('  %s: %.1fms / %.1fms' % (
+                name, sum(times) / len(times) * 1000, max(times) * 1000))
+
+    @staticmethod
+    def percentile(values: list, percent: int):
+        index = max(0, int(round(percent / 100 * len(values))) - 1)
+        return values[index]
@@ -0,0 +1,72 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.translation import gettext as _
+from quartet_capture.tasks import requeue_tasks, select_tasks
+
+
+class Command(BaseCommand):
+    help = _('Re-queues the tasks matching a query for execution in '
+             'rate limited batches.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rule',
+                            help='Only requeue tasks of this rule.')
+        parser.add_argument('--status', default='FAILED',
+                            help='Only requeue tasks with this status. '
+                                 'Defaults to FAILED.')
+        parser.add_argument('--since',
+                            help='Only requeue tasks whose status changed '
+                                 'on or after this ISO date/time.')
+        parser.add_argument('--until',
+                            help='Only requeue tasks whose status changed '
+                                 'before this ISO date/time.')
+        parser.add_argument('--limit', type=int,
+                            help='The maximum number of tasks to requeue.')
+        parser.add_argument('--batch-size', type=int,
+                            help='The number of tasks sent to Celery as '
+                                 'one group.')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='The maximum number of tasks requeued per '
+                                 'second.  Zero is unlimited.')
+        parser.add_argument('--priority', type=int,
+                            help='The Celery message priority of the '
+                                 'requeued tasks.')
+
+    def handle(self, *args, **options):
+        tasks = select_tasks(options['rule'], options['status'],
+                             self.parse_time(options['since']),
+                             self.parse_time(options['until']))
+        task_names = tasks.values_list('name', flat=True)
+        if options['limit']:
+            task_names = task_names[:options['limit']]
+        requeued = requeue_tasks(task_names,
+                                 batch_size=options['batch_size'],
+                                 rate=options['rate'],
+                                 priority=options['priority'],
+                                 progress=self.progress)
+        self.stdout.write('Requeued %s tasks.' % requeued)
+
+    def progress(self, requeued: int, total: int):
+        self.stdout.write('%s of %s tasks requeued.' % (requeued, total))
+
+    def parse_time(self, value: str):
+        if not value:
+            return None
+        ret = parse_datetime(value) or parse_date(value)
+        if ret is None:
+            raise CommandError('%s is not a valid ISO date/time.' % value)
+        return ret
@@ -0,0 +1,44 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+from quartet_capture.locations import reshard_tasks
+
+
+class Command(BaseCommand):
+    help = _('Moves the stored messages of existing tasks to the storage '
+             'layout set by QUARTET_CAPTURE_STORAGE_LAYOUT.  Safe to run '
+             'while tasks are being captured and to restart.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--layout',
+                            help='The target layout (flat, date, hash, '
+                                 'date-hash or a format string).  Defaults '
+                                 'to the configured layout.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='The number of tasks loaded per query.')
+        parser.add_argument('--rate', type=float, default=0,
+                            help='The maximum number of messages moved per '
+                                 'second.  Zero is unlimited.')
+        parser.add_argument('--limit', type=int,
+                            help='The maximum number of messages to move.')
+
+    def handle(self, *args, **options):
+        moved = reshard_tasks(
+            layout=options['layout'], batch_size=options['batch_size'],
+            rate=options['rate'], limit=options['limit'],
+            progress=lambda moved, checked: self.stdout.write(
+                'Moved %s messages of %s tasks checked.' % (moved, checked)))
+        self.stdout.write('Resharded %s messages.' % moved)
@@ -0,0 +1,111 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import multiprocessing
+import os
+import signal
+import threading
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils.translation import gettext as _
+from quartet_capture.backends import run_worker
+from quartet_capture.tasks import warm_up_worker, teardown_step_pool, \
+    start_metrics_exporter, remove_process_metrics
+
+
+class Command(BaseCommand):
+    help = _('Runs workers that claim and execute the tasks queued in the '
+             'database when QUARTET_CAPTURE_EXECUTION_BACKEND is set to '
+             '"database".  Stop them with SIGINT or SIGTERM; the running '
+             'tasks are finished first.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=1,
+                            help='The number of worker processes.')
+        parser.add_argument('--threads', type=int, default=1,
+                            help='The number of worker threads per process.')
+        parser.add_argument('--batch-size', type=int,
+                            help='The number of tasks a worker claims at '
+                                 'once.')
+        parser.add_argument('--poll-interval', type=float,
+                            help='The number of seconds an idle worker waits '
+                                 'before checking for tasks again.')
+        parser.add_argument('--once', action='store_true',
+                            help='Stop once the queue is empty.')
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda *args: stop.set())
+        warm_up_worker()
+        if options['processes'] > 1:
+            count = self.run_processes(stop, options)
+        else:
+            start_metrics_exporter()
+            count = self.run_threads(stop, options)
+        self.stdout.write('Ran %s tasks.' % count)
+
+    def run_processes(self, stop: threading.Event, options: dict):
+        # the forked children must not share the parent's connections
+        connections.close_all()
+        # the children inherit the warmed up steps and the stop event
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        processes = [
+            context.Process(target=self.run_child,
+                                    args=(stop, options, results))
+            for i in range(options['processes'])
+        ]
+        for process in processes:
+            process.start()
+        stopping = False
+        for process in processes:
+            while process.is_alive():
+                process.join(0.5)
+                if stop.is_set() and not stopping:
+                    # ask the children to finish their running tasks
+                    stopping = True
+                    for child in processes:
+                        if child.is_alive():
+                            os.kill(child.pid, signal.SIGTERM)
+            remove_process_metrics(pid=process.pid)
+        count = 0
+        while not results.empty():
+            count += results.get()
+        return count
+
+    def run_child(self, stop: threading.Event, options: dict,
+                  results: multiprocessing.Queue):
+        results.put(self.run_threads(stop, options))
+
+    def run_threads(self, stop: threading.Event, options: dict):
+        counts = []
+
+        def run():
+            counts.append(run_worker(
+                stop, batch_size=options['batch_size'],
+                poll_interval=options['poll_interval'],
+                exit_when_idle=options['once']))
+
+        threads = [threading.Thread(target=run, name='quartet_worker_%s' % i)
+                   for i in range(options['threads'])]
+        for thread in threads:
+            thread.start()
+        # join with a timeout so the main thread still handles signals
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.5)
+        teardown_step_pool()
+        return sum(counts)
+
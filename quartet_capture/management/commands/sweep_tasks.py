@@ -0,0 +1,43 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import time
+from django.core.management.base import BaseCommand
+from django.utils.translation import gettext as _
+from quartet_capture.tasks import sweep_tasks
+
+
+class Command(BaseCommand):
+    help = _('Re-dispatches queued tasks that were never dispatched and '
+             're-queues running tasks whose worker has stopped.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', type=float,
+                            help='Keep sweeping, waiting this many seconds '
+                                 'between sweeps.')
+        parser.add_argument('--limit', type=int,
+                            help='The maximum number of tasks of each kind '
+                                 'to recover per sweep.')
+        parser.add_argument('--rate', type=float,
+                            help='The maximum number of tasks dispatched '
+                                 'per second.')
+
+    def handle(self, *args, **options):
+        while True:
+            recovered = sweep_tasks(limit=options['limit'],
+                                    rate=options['rate'])
+            self.stdout.write('Recovered %s tasks.' % recovered)
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
@@ -0,0 +1,141 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+'''
+Prometheus metrics for capture and rule execution.  The metrics are kept
+in memory by each process so that recording and scraping them never
+touches the database.  When the `PROMETHEUS_MULTIPROC_DIR` environment
+variable is set (required for multi-process web servers and prefork
+Celery workers) the `prometheus_client` library keeps the values in
+memory mapped files in that directory and a scrape aggregates the values
+of every process.
+
+`prometheus_client` is an optional dependency; without it the record
+functions do nothing and the metrics endpoint returns a 404.
+'''
+import os
+from logging import getLogger
+from django.conf import settings
+
+try:
+    import prometheus_client
+except ImportError:
+    prometheus_client = None
+
+logger = getLogger('quartet_capture')
+
+# the port the Celery-side exporter listens on, None disables it
+METRICS_PORT = getattr(settings, 'QUARTET_CAPTURE_METRICS_PORT', None)
+
+_PREFIX = 'quartet_capture_'
+
+if prometheus_client:
+    CAPTURE_MESSAGES = prometheus_client.Counter(
+        _PREFIX + 'capture_messages', 'Messages captured.', ['rule'])
+    CAPTURE_BYTES = prometheus_client.Counter(
+        _PREFIX + 'capture_bytes', 'Bytes of messages captured.', ['rule'])
+    FILTER_ROUTING_SECONDS = prometheus_client.Histogram(
+        _PREFIX + 'filter_routing_seconds',
+        'Time spent matching messages against a filter.', ['filter'])
+    QUEUE_WAIT_SECONDS = prometheus_client.Histogram(
+        _PREFIX + 'queue_wait_seconds',
+        'Time tasks spent queued before they started.', ['rule'],
+        buckets=(.1, .5, 1, 5, 15, 60, 300, 900, 3600, 14400, float('inf')))
+    RULE_SECONDS = prometheus_client.Histogram(
+        _PREFIX + 'rule_execution_seconds', 'Rule execution time.',
+        ['rule'])
+    STEP_SECONDS = prometheus_client.Histogram(
+        _PREFIX + 'step_execution_seconds', 'Step execution time.',
+        ['rule', 'step'])
+    TASKS = prometheus_client.Counter(
+        _PREFIX + 'tasks', 'Tasks executed by outcome.', ['rule', 'status'])
+    TASK_MESSAGES = prometheus_client.Counter(
+        _PREFIX + 'task_messages', 'Task messages created.', ['level'])
+
+
+def record_capture(rule_name: str, size: int):
+    if prometheus_client:
+        CAPTURE_MESSAGES.labels(rule_name).inc()
+        CAPTURE_BYTES.labels(rule_name).inc(size or 0)
+
+
+def record_filter_routing(filter_name: str, seconds: float):
+    if prometheus_client:
+        FILTER_ROUTING_SECONDS.labels(filter_name).observe(seconds)
+
+
+def record_queue_wait(rule_name: str, seconds: float):
+    if prometheus_client:
+        QUEUE_WAIT_SECONDS.labels(rule_name).observe(max(seconds, 0))
+
+
+def record_task(rule_name: str, status: str, seconds: float,
+                step_times: dict = None):
+    '''
+    Records the outcome and execution time of a task.
+    :param rule_name: The name of the task's rule.
+    :param status: The task's final status.
+    :param seconds: The rule's execution time.
+    :param step_times: The execution time of each step by step name.
+    '''
+    if prometheus_client:
+        TASKS.labels(rule_name, status).inc()
+        RULE_SECONDS.labels(rule_name).observe(seconds)
+        for step_name, step_seconds in (step_times or {}).items():
+            STEP_SECONDS.labels(rule_name, step_name).observe(step_seconds)
+
+
+def record_task_message(level: str):
+    if prometheus_client:
+        TASK_MESSAGES.labels(level).inc()
+
+
+def get_registry():
+    '''
+    Returns the registry to export, aggregating the values of all processes
+    in multiprocess mode.
+    '''
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        from prometheus_client import multiprocess
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return prometheus_client.REGISTRY
+
+
+def generate_latest() -> bytes:
+    '''
+    Returns the metrics in the Prometheus text format.
+    '''
+    return prometheus_client.generate_latest(get_registry())
+
+
+def start_exporter():
+    '''
+    Starts the HTTP exporter of a Celery worker on QUARTET_CAPTURE_METRICS_PORT
+    if it is set.
+    '''
+    if prometheus_client and METRICS_PORT:
+        prometheus_client.start_http_server(int(METRICS_PORT),
+                                            registry=get_registry())
+        logger.info('Serving metrics on port %s.', METRICS_PORT)
+
+
+def mark_process_dead(pid: int):
+    '''
+    Removes the live values of a stopped process in multiprocess mode.
+    '''
+    if prometheus_client and 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-19 02:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quartet_capture', '0011_auto_20210303_1604'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['status_changed', 'name'], name='task_status_changed_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='taskhistory',
+            index=models.Index(fields=['created', 'id'], name='taskhistory_created_id_idx'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-19 02:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quartet_capture', '0012_auto_20261019_0242'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaskDependency',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depends_on_rule', models.ForeignKey(blank=True, help_text='The rule whose queued and running tasks must complete before the waiting task can run.', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='dependents', to='quartet_capture.rule', verbose_name='Depends on Rule')),
+                ('depends_on_task', models.ForeignKey(blank=True, help_text='The task that must complete before the waiting task can run.', null=True, on_delete=django.db.models.deletion.CASCADE, related_name='dependents', to='quartet_capture.task', verbose_name='Depends on Task')),
+                ('task', models.ForeignKey(help_text='The waiting task.', on_delete=django.db.models.deletion.CASCADE, related_name='dependencies', to='quartet_capture.task', verbose_name='Task')),
+            ],
+            options={
+                'verbose_name': 'Task Dependency',
+                'verbose_name_plural': 'Task Dependencies',
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 02:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quartet_capture', '0013_auto_20261019_0243'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rule',
+            name='max_concurrency',
+            field=models.PositiveIntegerField(default=0, help_text='The maximum number of tasks for this rule that may run at the same time across all workers.  Tasks over the limit wait until a running task completes.  Zero means no limit.', verbose_name='Max Concurrency'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 02:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quartet_capture', '0014_auto_20261019_0251'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='step',
+            name='stage',
+            field=models.IntegerField(blank=True, help_text='Consecutive steps (by order) that share a stage are independent of one another and are executed concurrently.  Each receives the same inbound data.  Leave blank to run the step on its own.', null=True, verbose_name='Execution Stage'),
+        ),
+    ]
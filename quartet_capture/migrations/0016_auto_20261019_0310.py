@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-19 03:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quartet_capture', '0015_auto_20261019_0257'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('key', models.CharField(help_text='A hash of the requesting user and the idempotency key or message body.', max_length=64, primary_key=True, serialize=False, verbose_name='Key')),
+                ('created', models.DateTimeField(auto_now_add=True, db_index=True, help_text='When the original request was received.', verbose_name='Created')),
+                ('task', models.ForeignKey(blank=True, help_text='The task created for the original request.', null=True, on_delete=django.db.models.deletion.CASCADE, to='quartet_capture.task', verbose_name='Task')),
+            ],
+            options={
+                'verbose_name': 'Idempotency Key',
+                'verbose_name_plural': 'Idempotency Keys',
+            },
+        ),
+    ]
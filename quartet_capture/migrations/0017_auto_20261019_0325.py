@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 03:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quartet_capture', '0016_auto_20261019_0310'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='rule',
+            name='bypass_admission_control',
+            field=models.BooleanField(default=False, help_text='Messages for critical rules are always accepted, even when the task queue is over the capture admission limits.', verbose_name='Bypass Admission Control'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 4.2.30 on 2026-10-19 03:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quartet_capture', '0017_auto_20261019_0325'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='dispatched',
+            field=models.DateTimeField(blank=True, help_text='When the task was last handed to the task queue.  Queued tasks that were never dispatched are re-dispatched by the task sweeper.', null=True, verbose_name='Dispatched'),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='lease_expires',
+            field=models.DateTimeField(blank=True, help_text='While a task is running its worker renews this lease.  Running tasks with an expired lease are assumed to have lost their worker and are re-queued by the task sweeper.', null=True, verbose_name='Lease Expires'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['status', 'status_changed'], name='task_status_status_changed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['status', 'lease_expires'], name='task_status_lease_expires_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 03:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quartet_capture', '0018_auto_20261019_0341'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='location',
+            field=models.CharField(blank=True, help_text="The storage key of the task's message.", max_length=255, null=True, verbose_name='Location'),
+        ),
+    ]
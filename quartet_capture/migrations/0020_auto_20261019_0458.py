@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 03:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quartet_capture', '0019_auto_20261019_0412'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='rulefilter',
+            name='search_type',
+            field=models.CharField(choices=[('regex', 'Regular Expression'), ('search', 'Text Search'), ('path', 'Element Path')], default='search', help_text='Regular Expression (regex), Text Search (text) or Element Path (path). A regular expression that matches something in the inbound data, a plain text search value containing a string that can be matched within the inbound data or an element path that matches an element of inbound XML data.', max_length=10, verbose_name='Search Type'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-19 03:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('quartet_capture', '0020_auto_20261019_0458'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='task',
+            name='location',
+            field=models.CharField(blank=True, db_index=True, help_text="The storage key of the task's message.", max_length=255, null=True, verbose_name='Location'),
+        ),
+    ]
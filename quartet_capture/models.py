@@ -15,12 +15,13 @@
 # Copyright 2018 SerialLab Corp.  All rights reserved.
 
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.utils.translation import gettext_lazy as _
 from model_utils import Choices
 from model_utils import models as utils
-from haikunator import Haikunator
-from quartet_capture.haiku import adjectives, nouns
+from quartet_capture.paths import compile_path, ElementPathError
+from quartet_capture.patterns import validate_pattern
 
 
 def haikunate():
@@ -43,9 +44,10 @@ SEVERITY_CHOICES = (
 class Task(utils.StatusModel):
     '''
     Keeps track of the processing of a message.  When messages are stored
-    and queued for later processing, the file name of the inbound message
-    is the same as the `name` field of this model with `.dat` applied
-    to the end.
+    and queued for later processing, the storage key of the inbound message
+    is kept in the `location` field.  Tasks stored before the field existed
+    have no location and their message is the `name` field of this model
+    with `.dat` applied to the end.
     '''
     name = models.CharField(
         max_length=50,
@@ -76,6 +78,31 @@ class Task(utils.StatusModel):
         help_text=_('The time (in seconds) it took for this task to execute.'),
         verbose_name=_('Execution Time'),
     )
+    dispatched = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text=_('When the task was last handed to the task queue.  '
+                    'Queued tasks that were never dispatched are '
+                    're-dispatched by the task sweeper.'),
+        verbose_name=_('Dispatched')
+    )
+    location = models.CharField(
+        max_length=255,
+        null=True,
+        blank=True,
+        db_index=True,
+        help_text=_('The storage key of the task\'s message.'),
+        verbose_name=_('Location')
+    )
+    lease_expires = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text=_('While a task is running its worker renews this lease.  '
+                    'Running tasks with an expired lease are assumed to have '
+                    'lost their worker and are re-queued by the task '
+                    'sweeper.'),
+        verbose_name=_('Lease Expires')
+    )
 
     def save(self, *args, **kwargs):
         if not self.name:
@@ -88,10 +115,108 @@ class Task(utils.StatusModel):
         it could not be used directly as a default callable for
         a django field...hence this function.
         '''
+        from haikunator import Haikunator
+        from quartet_capture.haiku import adjectives, nouns
         haiku = Haikunator(adjectives=adjectives, nouns=nouns)
         return haiku.haikunate(token_length=16, token_hex=True,
                                delimiter='-')
 
+    class Meta:
+        indexes = [
+            # supports the keyset pagination of the task API and admin
+            models.Index(fields=['status_changed', 'name'],
+                         name='task_status_changed_name_idx'),
+            # support the task sweeper
+            models.Index(fields=['status', 'status_changed'],
+                         name='task_status_status_changed_idx'),
+            models.Index(fields=['status', 'lease_expires'],
+                         name='task_status_lease_expires_idx'),
+        ]
+
+class TaskDependency(models.Model):
+    '''
+    Declares that a task can not be executed until another task has
+    completed or until there are no more outstanding (queued or running)
+    tasks for a given rule.  Tasks with outstanding dependencies are parked
+    with a status of WAITING and are released by the task completion hook
+    once all of their dependencies have been met.
+    '''
+    task = models.ForeignKey(
+        Task,
+        on_delete=models.CASCADE,
+        related_name='dependencies',
+        verbose_name=_("Task"),
+        help_text=_("The waiting task."),
+        null=False
+    )
+    depends_on_task = models.ForeignKey(
+        Task,
+        on_delete=models.CASCADE,
+        related_name='dependents',
+        verbose_name=_("Depends on Task"),
+        help_text=_("The task that must complete before the waiting task "
+                    "can run."),
+        null=True,
+        blank=True
+    )
+    depends_on_rule = models.ForeignKey(
+        'quartet_capture.Rule',
+        on_delete=models.CASCADE,
+        related_name='dependents',
+        verbose_name=_("Depends on Rule"),
+        help_text=_("The rule whose queued and running tasks must complete "
+                    "before the waiting task can run."),
+        null=True,
+        blank=True
+    )
+
+    def __str__(self):
+        return '%s -> %s' % (self.task_id,
+                             self.depends_on_task_id or self.depends_on_rule)
+
+    class Meta:
+        verbose_name = _('Task Dependency')
+        verbose_name_plural = _('Task Dependencies')
+
+
+class IdempotencyKey(models.Model):
+    '''
+    Remembers the task created for a capture request that carried an
+    `Idempotency-Key` header (or, if enabled, for a message body) so that
+    a retry of the request returns the original task instead of capturing
+    the message again.  The task is empty while the original request is
+    still being processed.
+    '''
+    key = models.CharField(
+        max_length=64,
+        primary_key=True,
+        help_text=_('A hash of the requesting user and the idempotency key '
+                    'or message body.'),
+        verbose_name=_('Key')
+    )
+    task = models.ForeignKey(
+        Task,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        help_text=_('The task created for the original request.'),
+        verbose_name=_('Task')
+    )
+    created = models.DateTimeField(
+        auto_now_add=True,
+        db_index=True,
+        help_text=_('When the original request was received.'),
+        verbose_name=_('Created')
+    )
+
+    def __str__(self):
+        return self.key
+
+    class Meta:
+        verbose_name = _('Idempotency Key')
+        verbose_name_plural = _('Idempotency Keys')
+
+
 class TaskMessage(models.Model):
     '''
     A message relative to the execution of a specific task.
@@ -197,6 +322,10 @@ class TaskHistory(utils.TimeStampedModel):
 
     class Meta:
         ordering = ['created']
+        indexes = [
+            models.Index(fields=['created', 'id'],
+                         name='taskhistory_created_id_idx'),
+        ]
         verbose_name = _('Task History')
         verbose_name_plural = _('Task History')
 
@@ -219,6 +348,21 @@ class Rule(models.Model):
         help_text=_('A short description.'),
         verbose_name=_('Description')
     )
+    max_concurrency = models.PositiveIntegerField(
+        default=0,
+        help_text=_('The maximum number of tasks for this rule that may run '
+                    'at the same time across all workers.  Tasks over the '
+                    'limit wait until a running task completes.  Zero '
+                    'means no limit.'),
+        verbose_name=_('Max Concurrency')
+    )
+    bypass_admission_control = models.BooleanField(
+        default=False,
+        help_text=_('Messages for critical rules are always accepted, even '
+                    'when the task queue is over the capture admission '
+                    'limits.'),
+        verbose_name=_('Bypass Admission Control')
+    )
 
     def __str__(self):
         return self.name
@@ -282,6 +426,15 @@ class Step(models.Model):
                     ' are executed in numerical order.'),
         verbose_name=_('Execution Order'),
     )
+    stage = models.IntegerField(
+        null=True,
+        blank=True,
+        help_text=_('Consecutive steps (by order) that share a stage are '
+                    'independent of one another and are executed '
+                    'concurrently.  Each receives the same inbound data.  '
+                    'Leave blank to run the step on its own.'),
+        verbose_name=_('Execution Stage'),
+    )
     rule = models.ForeignKey(
         Rule,
         null=False,
@@ -322,7 +475,8 @@ class StepParameter(Field):
 
 RULE_FILTER_CHOICES = (
     ('regex', 'Regular Expression'),
-    ('search', 'Text Search')
+    ('search', 'Text Search'),
+    ('path', 'Element Path')
 )
 
 
@@ -398,10 +552,13 @@ class RuleFilter(models.Model):
     search_type = models.CharField(
         max_length=10,
         verbose_name=_("Search Type"),
-        help_text=_("Regular Expression (regex) or Text Search (text). "
+        help_text=_("Regular Expression (regex), Text Search (text) or "
+                    "Element Path (path). "
                     "A regular expression that matches something in the "
-                    "inbound data or a plain text search value containing "
-                    "a string that can be matched within the inbound data."),
+                    "inbound data, a plain text search value containing "
+                    "a string that can be matched within the inbound data "
+                    "or an element path that matches an element of inbound "
+                    "XML data."),
         choices=RULE_FILTER_CHOICES,
         null=False,
         default='search'
@@ -439,6 +596,18 @@ class RuleFilter(models.Model):
         null=False
     )
 
+    def clean(self):
+        if self.search_type == 'path':
+            try:
+                compile_path(self.search_value)
+            except ElementPathError as e:
+                raise ValidationError({'search_value': str(e)})
+        elif self.search_type == 'regex':
+            try:
+                validate_pattern(self.search_value)
+            except ValueError as e:
+                raise ValidationError({'search_value': str(e)})
+
     def __str__(self):
         return self.name or "%s:%s" % (self.rule, self.search_value)
 
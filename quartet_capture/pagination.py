@@ -0,0 +1,64 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+'''
+Pagination helpers for the large, append-mostly tables (Task, TaskHistory)
+where offset pagination and exact `COUNT(*)` queries get slow as the
+tables grow.
+'''
+from django.conf import settings
+from rest_framework.pagination import CursorPagination
+from rest_framework.settings import api_settings
+from quartet_capture.counts import approximate_count
+
+
+class ApproximateCountCursorPagination(CursorPagination):
+    '''
+    Keyset (cursor) pagination that will optionally add an approximate
+    `count` to the response when the `count` query parameter is set to
+    `true`.  Cursor pagination does not need the count so it is only
+    computed when asked for.
+    '''
+    page_size = getattr(settings, 'QUARTET_CAPTURE_PAGE_SIZE',
+                        None) or api_settings.PAGE_SIZE or 50
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    count_query_param = 'count'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = None
+        if request.query_params.get(
+            self.count_query_param, '').lower() in ['true', '1']:
+            self.count = approximate_count(queryset)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.count is not None:
+            response.data['count'] = self.count
+        return response
+
+
+class TaskCursorPagination(ApproximateCountCursorPagination):
+    '''
+    Orders tasks newest first using the (status_changed, name) index.
+    '''
+    ordering = ('-status_changed', '-name')
+
+
+class TaskHistoryCursorPagination(ApproximateCountCursorPagination):
+    '''
+    Orders task history newest first using the (created, id) index.
+    '''
+    ordering = ('-created', '-id')
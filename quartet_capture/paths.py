@@ -0,0 +1,246 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+'''
+Element path expressions for the `path` RuleFilter search type.  A path is
+evaluated with an incremental XML parser while the message is fed to it
+in chunks and the parsing stops as soon as the outcome is known, usually
+well before the end of a large document.
+
+The supported syntax is a subset of XPath:
+
+* `/` selects a child and `//` a descendant, `*` matches any element.
+* Element names match the local name of an element whatever its
+  namespace; `prefix:name` ignores the prefix and `{uri}name` also matches
+  the namespace.
+* Any step may have attribute predicates: `[@type]`, `[@type='value']` or
+  `[@type!='value']`.
+* The last step may have a text predicate: `[.='value']`,
+  `[text()='value']`, `[. != 'value']` or `[contains(., 'value')]`.  The
+  element's own text is compared with surrounding white space removed.
+
+For example `//bizStep[.='urn:epcglobal:cbv:bizstep:shipping']` or
+`/EPCISDocument/EPCISHeader//Sender/Identifier[@Authority='SGLN']`.  A
+path matches when any element matches it.
+'''
+import re
+from functools import lru_cache
+from logging import getLogger
+from xml.etree.ElementTree import XMLPullParser, ParseError
+
+logger = getLogger('quartet_capture')
+
+# the number of characters fed to the parser at a time
+CHUNK_SIZE = 64 * 1024
+
+_STEP = re.compile(r'''
+    (?P<axis>//|/)
+    (?P<name>\{[^}]*\}[\w.\-]+|[\w.\-]+:[\w.\-]+|[\w.\-]+|\*)
+    (?P<predicates>(?:\[[^\]]*\])*)
+''', re.VERBOSE)
+_PREDICATE = re.compile(r'\[\s*([^\]]*?)\s*\]')
+_VALUE = r'''(?:'(?P<{0}1>[^']*)'|"(?P<{0}2>[^"]*)")'''
+_ATTRIBUTE = re.compile(
+    r'@(?P<attr>[\w.\-:{}/]+)\s*(?:(?P<op>!?=)\s*' + _VALUE.format('v') +
+    r')?$')
+_TEXT = re.compile(
+    r'(?:\.|text\(\))\s*(?P<op>!?=)\s*' + _VALUE.format('v') + '$')
+_CONTAINS = re.compile(
+    r'contains\(\s*(?:\.|text\(\))\s*,\s*' + _VALUE.format('v') + r'\s*\)$')
+
+
+class ElementPathError(ValueError):
+    '''
+    Raised when an element path expression can not be compiled.
+    '''
+    pass
+
+
+class _Step:
+    def __init__(self, axis: str, name: str):
+        self.descendant = axis == '//'
+        self.namespace = None
+        if name.startswith('{'):
+            self.namespace, name = name[1:].split('}', 1)
+        self.name = name.split(':')[-1]
+        # (attribute name, operator, value) tuples
+        self.attributes = []
+
+    def matches(self, tag: str, attributes: dict) -> bool:
+        namespace, local_name = None, tag
+        if tag.startswith('{'):
+            namespace, local_name = tag[1:].split('}', 1)
+        if self.name != '*' and self.name != local_name:
+            return False
+        if self.namespace is not None and self.namespace != namespace:
+            return False
+        for name, op, value in self.attributes:
+            actual = _get_attribute(attributes, name)
+            if actual is None or not _compare(actual, op, value):
+                return False
+        return True
+
+
+def _get_attribute(attributes: dict, name: str):
+    if name in attributes:
+        return attributes[name]
+    local_name = name.split(':')[-1]
+    for key, value in attributes.items():
+        if key.rsplit('}', 1)[-1] == local_name:
+            return value
+
+
+def _compare(actual: str, op: str, value: str) -> bool:
+    if op is None:
+        return True
+    if op == '=':
+        return actual == value
+    if op == '!=':
+        return actual != value
+    return value in actual
+
+
+def _value(match) -> str:
+    value = match.group('v1')
+    return value if value is not None else match.group('v2')
+
+
+class ElementPath:
+    '''
+    A compiled element path expression.  Use `compile_path` to get one.
+    '''
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        self.steps = []
+        # the (operator, value) of the text predicate of the last step
+        self.text = None
+        position = 0
+        expression = expression.strip()
+        while position < len(expression):
+            match = _STEP.match(expression, position)
+            if not match:
+                raise ElementPathError(
+                    'Invalid element path %r at position %s.' % (
+                        self.expression, position))
+            if self.text:
+                raise ElementPathError(
+                    'Only the last step of element path %r may have a text '
+                    'predicate.' % self.expression)
+            step = _Step(match.group('axis'), match.group('name'))
+            for predicate in _PREDICATE.findall(match.group('predicates')):
+                self._add_predicate(step, predicate)
+            self.steps.append(step)
+            position = match.end()
+        if not self.steps:
+            raise ElementPathError('The element path is empty.')
+
+    def _add_predicate(self, step: _Step, predicate: str):
+        attribute = _ATTRIBUTE.match(predicate)
+        text = _TEXT.match(predicate)
+        contains = _CONTAINS.match(predicate)
+        if attribute:
+            step.attributes.append((
+                attribute.group('attr'), attribute.group('op'),
+                _value(attribute) if attribute.group('op') else None))
+        elif text:
+            self.text = (text.group('op'), _value(text))
+        elif contains:
+            self.text = ('contains', _value(contains))
+        else:
+            raise ElementPathError(
+                'Unsupported predicate [%s] in element path %r.' % (
+                    predicate, self.expression))
+
+    def _advance(self, states: frozenset, tag: str,
+                 attributes: dict) -> frozenset:
+        '''
+        Returns the steps that remain to be matched below an element given
+        those that remained below its parent.
+        '''
+        advanced = set()
+        last = len(self.steps)
+        for state in states:
+            if state == last:
+                continue
+            step = self.steps[state]
+            if step.matches(tag, attributes):
+                advanced.add(state + 1)
+            if step.descendant:
+                advanced.add(state)
+        return frozenset(advanced)
+
+    def search(self, message) -> bool:
+        '''
+        Returns True if an element of the message matches the path.
+        :param message: The message as a str, bytes or a file-like object.
+        Messages that are not well formed XML do not match.
+        '''
+        parser = XMLPullParser(events=('start', 'end'))
+        last = len(self.steps)
+        # the remaining steps below each open element
+        states = [frozenset([0])]
+        elements = []
+        try:
+            for chunk in _chunks(message):
+                parser.feed(chunk)
+                for event, element in parser.read_events():
+                    if event == 'start':
+                        current = self._advance(states[-1], element.tag,
+                                                element.attrib)
+                        if last in current and self.text is None:
+                            return True
+                        if not current and not elements:
+                            # the root element rules out any match
+                            return False
+                        states.append(current)
+                        elements.append(element)
+                    else:
+                        current = states.pop()
+                        elements.pop()
+                        if last in current and _compare(
+                            (element.text or '').strip(), *self.text):
+                            return True
+                        # keep memory flat on large documents
+                        element.clear()
+                        if elements and len(elements[-1]) and \
+                            elements[-1][-1] is element:
+                            del elements[-1][-1]
+            parser.close()
+        except ParseError:
+            logger.debug('Could not parse the message for element path %s.',
+                         self.expression)
+        return False
+
+
+def _chunks(message):
+    if hasattr(message, 'read'):
+        while True:
+            chunk = message.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        for start in range(0, len(message), CHUNK_SIZE):
+            yield message[start:start + CHUNK_SIZE]
+
+
+@lru_cache(maxsize=256)
+def compile_path(expression: str) -> ElementPath:
+    '''
+    Compiles an element path expression.  The compiled paths are cached by
+    expression so each RuleFilter's path is only compiled once per process.
+    :raises ElementPathError: If the expression is not valid.
+    '''
+    return ElementPath(expression)
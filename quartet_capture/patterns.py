@@ -0,0 +1,261 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+'''
+Evaluates the regular expressions of `regex` RuleFilters without letting a
+bad pattern hang the capture endpoint.
+
+* Patterns are checked when a RuleFilter is saved.  Patterns with nested
+  unbounded repeats, such as `(a+)+`, can backtrack catastrophically and
+  are rejected unless the re2 engine is in use.
+* With QUARTET_CAPTURE_REGEX_ENGINE set to `re2` the patterns run on the
+  linear time re2 engine (the optional `google-re2` package).  Patterns
+  re2 does not support fall back to Python's `re`.
+* On Python's engine the patterns that could still backtrack badly (for
+  example an alternation under an unbounded repeat, or several unbounded
+  repeats in a row such as `.*.*=x`) are run in a worker
+  process that is killed if the search takes longer than
+  QUARTET_CAPTURE_REGEX_TIMEOUT seconds.  At most
+  QUARTET_CAPTURE_REGEX_WORKERS searches run at once and a killed worker
+  does not affect the searches of the others.
+* Messages longer than QUARTET_CAPTURE_REGEX_MAX_SIZE characters are not
+  searched.
+
+An evaluation that exceeds its budget counts as a non-match and is logged
+as a warning.
+'''
+import multiprocessing
+import os
+import re
+import threading
+from functools import lru_cache
+from logging import getLogger
+from django.conf import settings
+
+try:
+    import re._parser as sre_parse
+    import re._constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+logger = getLogger('quartet_capture')
+
+REGEX_ENGINE = getattr(settings, 'QUARTET_CAPTURE_REGEX_ENGINE', 're')
+# the number of seconds a sandboxed evaluation may take, zero disables
+# the sandbox
+REGEX_TIMEOUT = getattr(settings, 'QUARTET_CAPTURE_REGEX_TIMEOUT', 5.0)
+# the number of characters a regex filter may search, zero is unlimited
+REGEX_MAX_SIZE = getattr(settings, 'QUARTET_CAPTURE_REGEX_MAX_SIZE',
+                         10 * 1024 * 1024)
+# the number of sandboxed searches that may run at once
+REGEX_WORKERS = getattr(settings, 'QUARTET_CAPTURE_REGEX_WORKERS', 2)
+
+SAFE, RISKY, CATASTROPHIC = 0, 1, 2
+
+# the idle sandbox processes and the number of searches they may run at
+# once
+_idle = []
+_workers_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(REGEX_WORKERS)
+
+
+def analyze(pattern: str) -> int:
+    '''
+    Estimates how badly a pattern can backtrack on Python's engine.
+    :return: SAFE, RISKY (an alternation under an unbounded repeat, or
+    unbounded repeats in sequence such as `.*.*=x`, which take polynomial
+    time) or CATASTROPHIC (an unbounded repeat nested in another).
+    :raises re.error: If the pattern is not valid.
+    '''
+    return _analyze(sre_parse.parse(pattern), False)
+
+
+def _analyze(items, in_repeat: bool) -> int:
+    level = SAFE
+    # the number of items of the sequence with an unbounded repeat
+    repeats = 0
+    for op, av in items:
+        if _unbounded(op, av):
+            repeats += 1
+            if repeats > 1:
+                level = max(level, RISKY)
+        if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            unbounded = av[1] == sre_constants.MAXREPEAT
+            if unbounded and in_repeat:
+                return CATASTROPHIC
+            level = max(level, _analyze(av[2], in_repeat or unbounded))
+        elif op == sre_constants.SUBPATTERN:
+            level = max(level, _analyze(av[3], in_repeat))
+        elif op == sre_constants.BRANCH:
+            if in_repeat:
+                level = max(level, RISKY)
+            for branch in av[1]:
+                level = max(level, _analyze(branch, in_repeat))
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            level = max(level, _analyze(av[1], in_repeat))
+        if level == CATASTROPHIC:
+            break
+    return level
+
+
+def _unbounded(op, av) -> bool:
+    '''
+    Returns True if an item is or contains an unbounded repeat.
+    '''
+    if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+        return av[1] == sre_constants.MAXREPEAT or any(
+            _unbounded(*item) for item in av[2])
+    if op == sre_constants.SUBPATTERN:
+        return any(_unbounded(*item) for item in av[3])
+    if op == sre_constants.BRANCH:
+        return any(_unbounded(*item) for branch in av[1] for item in branch)
+    return False
+
+
+def validate_pattern(pattern: str):
+    '''
+    Checks a RuleFilter pattern before it is saved.
+    :raises ValueError: If the pattern is invalid or can backtrack
+    catastrophically.
+    '''
+    try:
+        level = analyze(pattern)
+    except re.error as e:
+        raise ValueError('Invalid regular expression: %s' % e)
+    if level == CATASTROPHIC and not _compile(pattern)[1]:
+        raise ValueError(
+            'The regular expression nests unbounded repeats, for example '
+            '(a+)+, and can take exponential time on some messages.  '
+            'Rewrite it, use a possessive quantifier or atomic group, or '
+            'enable the re2 engine.')
+
+
+@lru_cache(maxsize=256)
+def _compile(pattern: str):
+    '''
+    :return: A tuple of the compiled pattern, whether it runs on re2 and
+    whether it must run in the sandbox.
+    '''
+    if REGEX_ENGINE == 're2':
+        if re2 is None:
+            logger.warning('QUARTET_CAPTURE_REGEX_ENGINE is re2 but the '
+                           'google-re2 package is not installed.')
+        else:
+            try:
+                return re2.compile(pattern), True, False
+            except Exception:
+                logger.warning('re2 does not support the pattern %r, using '
+                               'Python\'s engine.', pattern)
+    compiled = re.compile(pattern)
+    return compiled, False, bool(REGEX_TIMEOUT) and analyze(pattern) > SAFE
+
+
+def search(pattern: str, message: str, source=None) -> bool:
+    '''
+    Searches the message for the pattern within the configured budget.
+    :param pattern: The regular expression.
+    :param message: The message to search within.
+    :param source: What the pattern belongs to, for the warnings.
+    :return: True if the pattern matched within the budget.
+    '''
+    if REGEX_MAX_SIZE and len(message) > REGEX_MAX_SIZE:
+        logger.warning('The message is longer than '
+                       'QUARTET_CAPTURE_REGEX_MAX_SIZE, %s is treated as not '
+                       'matching.', source or pattern)
+        return False
+    compiled, _, sandboxed = _compile(pattern)
+    if not sandboxed:
+        return bool(compiled.search(message))
+    # waiting for a free worker does not count against the budget
+    with _slots:
+        worker = _get_worker()
+        try:
+            result = worker.search(pattern, message, REGEX_TIMEOUT)
+        except multiprocessing.TimeoutError:
+            logger.warning('%s took longer than %s seconds and is treated as '
+                           'not matching.', source or pattern, REGEX_TIMEOUT)
+            worker.kill()
+            return False
+        except Exception:
+            logger.warning('%s could not be evaluated and is treated as not '
+                           'matching.', source or pattern, exc_info=True)
+            worker.kill()
+            return False
+        _release_worker(worker)
+        return result
+
+
+class _Worker:
+    '''
+    A sandbox process that runs one search at a time.  Each search is timed
+    from when it is handed to the idle process, and a search that runs over
+    its budget kills only this process.
+    '''
+
+    def __init__(self):
+        context = multiprocessing.get_context('fork')
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_serve,
+                                       args=(child_connection,), daemon=True)
+        self.process.start()
+        child_connection.close()
+
+    def search(self, pattern: str, message: str, timeout: float) -> bool:
+        self.connection.send((pattern, message))
+        if not self.connection.poll(timeout):
+            raise multiprocessing.TimeoutError()
+        return self.connection.recv()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+def _serve(connection):
+    while True:
+        try:
+            pattern, message = connection.recv()
+        except EOFError:
+            return
+        connection.send(bool(re.search(pattern, message)))
+
+
+def _get_worker() -> _Worker:
+    with _workers_lock:
+        if _idle:
+            return _idle.pop()
+    return _Worker()
+
+
+def _release_worker(worker: _Worker):
+    with _workers_lock:
+        _idle.append(worker)
+
+
+def _reset_after_fork():
+    # a forked child must not use its parent's workers
+    global _idle, _workers_lock, _slots
+    _idle = []
+    _workers_lock = threading.Lock()
+    _slots = threading.BoundedSemaphore(REGEX_WORKERS)
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
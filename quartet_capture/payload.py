@@ -0,0 +1,143 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+'''
+The data a rule is currently working on along with the decoded and parsed
+forms of it that steps have asked for.  Each form is produced once and
+shared by all of the steps that use it until a step returns new data.
+'''
+import io
+import threading
+from quartet_capture.buffers import DataBuffer
+
+
+class Payload:
+    '''
+    Lazily decodes and parses a rule's current data and keeps the results
+    for the following steps.  lxml is only imported once a tree or an
+    iterparse stream is asked for.  The parsed tree is shared, steps
+    must copy it before changing it.
+    :param data: The data as bytes, a string or a DataBuffer.
+    :param encoding: The encoding used to decode the data to text.
+    '''
+
+    def __init__(self, data, encoding: str = 'utf-8'):
+        self.data = data
+        self.encoding = encoding
+        self._cache = {}
+        self._lock = threading.RLock()
+
+    @property
+    def content(self) -> bytes:
+        '''
+        The data as bytes.
+        '''
+        return self._get('content', self._to_bytes)
+
+    @property
+    def text(self) -> str:
+        '''
+        The data decoded to a string.
+        '''
+        if isinstance(self.data, str):
+            return self.data
+        return self._get('text', lambda: self.content.decode(self.encoding))
+
+    @property
+    def tree(self):
+        '''
+        The data parsed into an `lxml.etree._ElementTree`.
+        '''
+        def parse():
+            from lxml import etree
+            return etree.parse(self.open())
+
+        return self._get('tree', parse)
+
+    def iterparse(self, **kwargs):
+        '''
+        Returns a new `lxml.etree.iterparse` iterator over the data.  Unlike
+        the tree, a stream can only be consumed once so it is not shared.
+        :param kwargs: Passed on to iterparse, for example `events` and
+        `tag`.
+        '''
+        from lxml import etree
+        return etree.iterparse(self.open(), **kwargs)
+
+    def open(self) -> io.RawIOBase:
+        '''
+        Returns a new binary stream over the data.  The stream over a
+        DataBuffer reads from its memory or memory map without copying it.
+        '''
+        if isinstance(self.data, DataBuffer):
+            return _ViewReader(self.data.getbuffer())
+        return io.BytesIO(self.content)
+
+    def _to_bytes(self) -> bytes:
+        if isinstance(self.data, str):
+            return self.data.encode(self.encoding)
+        if isinstance(self.data, DataBuffer):
+            return self.data.getvalue()
+        return bytes(self.data)
+
+    def _get(self, key, factory):
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = factory()
+            return self._cache[key]
+
+
+class _ViewReader(io.RawIOBase):
+    '''
+    A read-only binary stream over a memoryview.  Only the chunks that are
+    read are copied.
+    '''
+
+    def __init__(self, view: memoryview):
+        self._view = view
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        self._checkClosed()
+        chunk = self._view[self._position:self._position + len(buffer)]
+        size = len(chunk)
+        buffer[:size] = chunk
+        self._position += size
+        return size
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self._checkClosed()
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError('Negative seek position %d' % offset)
+        self._position = offset
+        return offset
+
+    def tell(self) -> int:
+        self._checkClosed()
+        return self._position
+
+    def close(self):
+        # the view keeps the buffer's memory map open
+        self._view = None
+        super().close()
@@ -13,22 +13,62 @@
 #
 # Copyright 2018 SerialLab Corp.  All rights reserved.
 
+import asyncio
+import inspect
+import threading
 import traceback
 import logging
 import importlib
+import json
 import time
-from copy import deepcopy
+from concurrent.futures import ThreadPoolExecutor
+from copy import copy
 from datetime import datetime
 from enum import Enum
 from abc import ABCMeta, abstractmethod
-from quartet_capture import models, errors
+from quartet_capture import models, errors, metrics
+from quartet_capture.buffers import DataBuffer
+from quartet_capture.bundles import export_rules, import_rules, unique_name
+from quartet_capture.payload import Payload
 from pydoc import locate
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.utils.translation import gettext as _
+from django.db import connections, transaction
 from django.db.models import Model
 
 logger = logging.getLogger('quartet_capture')
 
+# The maximum number of threads used to run the steps of a single stage.
+STEP_THREAD_POOL_SIZE = getattr(
+    settings, 'QUARTET_CAPTURE_STEP_THREAD_POOL_SIZE', 4)
+
+_event_loops = threading.local()
+
+# step classes by class path, populated on first use or by warm_up
+_step_classes = {}
+
+
+def run_coroutine(coroutine):
+    '''
+    Runs a coroutine to completion from synchronous code.  Each thread keeps
+    one event loop for the life of the thread so that anything an async step
+    binds to the loop (sessions, connections) can be reused by the next
+    task.  If the calling thread is already running an event loop, the
+    coroutine is run on a new loop in another thread.
+    :param coroutine: The coroutine to run.
+    :return: The coroutine's result.
+    '''
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        loop = getattr(_event_loops, 'loop', None)
+        if loop is None or loop.is_closed():
+            loop = _event_loops.loop = asyncio.new_event_loop()
+        return loop.run_until_complete(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        return pool.submit(asyncio.run, coroutine).result()
+
 
 class TaskMessageLevel(Enum):
     INFO = 'INFO'
@@ -85,6 +125,30 @@ class TaskMessaging:
         self._create_task_message(*args, task=task,
                                   level=TaskMessageLevel.ERROR)
 
+    async def adebug(self, *args: object, task: models.Task = None):
+        '''
+        Creates a debug message from a coroutine (async Step).
+        '''
+        await sync_to_async(self.debug)(*args, task=task)
+
+    async def ainfo(self, *args: object, task: models.Task = None):
+        '''
+        Creates an info message from a coroutine (async Step).
+        '''
+        await sync_to_async(self.info)(*args, task=task)
+
+    async def awarning(self, *args: object, task: models.Task = None):
+        '''
+        Creates a warning message from a coroutine (async Step).
+        '''
+        await sync_to_async(self.warning)(*args, task=task)
+
+    async def aerror(self, *args: object, task: models.Task = None):
+        '''
+        Creates an error message from a coroutine (async Step).
+        '''
+        await sync_to_async(self.error)(*args, task=task)
+
     def _create_task_message(
         self,
         *args: object,
@@ -110,6 +174,7 @@ class TaskMessaging:
                 task=task or self.task,
                 level=level.value
             )
+            metrics.record_task_message(level.value)
         except:
             logger.exception('Could not create TaskMessage.')
 
@@ -117,7 +182,10 @@ class TaskMessaging:
 class RuleContext:
     '''
     The RuleContext is passed to each step in the rule and can be
-    used by steps to pass data to and from one another.
+    used by steps to pass data to and from one another.  Its `payload`
+    is a `quartet_capture.payload.Payload` over the data the current step
+    was handed; steps that parse the data should use its `text`, `tree`
+    and `iterparse` members so that the data is only parsed once.
     '''
 
     def __init__(self, rule_name: str, task_name: str, context: dict = None):
@@ -130,6 +198,46 @@ class RuleContext:
         self.context = context or {}
         self._rule_name = rule_name
         self._task_name = task_name
+        # shared with the copies made for concurrent steps
+        self._buffers = []
+        # the data the current step was handed, set by the rule
+        self.payload = None
+        # the task's parameters, loaded once by the rule
+        self.task_parameters = None
+
+    def create_buffer(self, data: bytes = None) -> DataBuffer:
+        '''
+        Creates a DataBuffer that spills to a temporary file once it grows
+        past the QUARTET_CAPTURE_SPILL_THRESHOLD setting and is closed when
+        the rule completes.  Return it from a step's execute method to hand
+        it to the next step without copying.
+        :param data: Optional initial contents.
+        :return: The new buffer.
+        '''
+        return self.track_buffer(DataBuffer(data))
+
+    def track_buffer(self, buffer: DataBuffer) -> DataBuffer:
+        '''
+        Closes the buffer when the rule completes.
+        '''
+        if not any(tracked is buffer for tracked in self._buffers):
+            self._buffers.append(buffer)
+        return buffer
+
+    def close_buffers(self, keep=None):
+        '''
+        Closes the buffers created or returned by the rule's steps.
+        :param keep: A buffer to leave open, the rule's final data.  Its
+        new owner is responsible for closing it.
+        '''
+        for buffer in self._buffers:
+            if buffer is keep:
+                continue
+            try:
+                buffer.close()
+            except Exception:
+                logger.exception('Could not close a data buffer.')
+        self._buffers.clear()
 
     def get_required_context_variable(self, key: str):
         '''
@@ -178,6 +286,15 @@ class RuleContext:
 
 
 class DependencyMixin:
+    '''
+    Allows a step to block until the tasks that were running when it
+    started have finished.  Blocking ties up a worker for the whole wait;
+    where possible declare the dependency when the task is queued instead
+    (see the `depends_on_tasks` and `depends_on_rules` parameters of
+    `quartet_capture.tasks.create_and_queue_task`) which parks the task in
+    the WAITING state without holding a worker.
+    '''
+
     def get_running_tasks(self):
         """
         Will return the current list of tasks that are running.
@@ -189,20 +306,27 @@ class DependencyMixin:
         return list(running_tasks)
 
     def monitor_tasks(self):
+        """
+        Waits for the currently running tasks (other than this step's own
+        task) to finish or for the maximum number of wait cycles to elapse.
+        """
         running_tasks = self.get_running_tasks()
         task_interval = int(getattr(
             settings,
-            'QUARTET_CAPTURE_WAIT_CYCLE_INTERVAL'),
+            'QUARTET_CAPTURE_WAIT_CYCLE_INTERVAL',
             10
-        )
+        ))
         cycles = int(getattr(
             settings, 'QUARTET_CAPTURE_MAX_WAIT_CYCLES', 1080
         ))
-        while tasks.count() > 0 or cycles == 0:
-            # refresh the tasks
-            tasks = models.Task.objects.filter(
-                name__in=running_tasks
-            )
+        current_task = getattr(self, 'task', None)
+        tasks = models.Task.objects.filter(
+            name__in=running_tasks,
+            status='RUNNING'
+        )
+        if current_task:
+            tasks = tasks.exclude(name=current_task.name)
+        while tasks.exists() and cycles > 0:
             time.sleep(task_interval)
             cycles -= 1
 
@@ -238,6 +362,12 @@ class Rule(TaskMessaging):
         self.context = RuleContext(rule.name, task.name)
         self.context.context['RULE_PARAMETERS'] = {p.name: p.value for p in
                                                    self.db_rule.ruleparameter_set.all()}
+        # loaded once so steps can read them without querying
+        self.context.task_parameters = {
+            p.name: p.value for p in task.taskparameter_set.all()}
+        self._steps_released = False
+        # the execution time of each step in seconds by step order
+        self.step_times = {}
         self.steps = self._load_steps()
 
     def execute(self, data):
@@ -258,16 +388,29 @@ class Rule(TaskMessaging):
                     'The rule %s was loaded with no '
                     'steps configured.' % self.db_rule.name
                 )
-            for number, step in self.steps.items():
+            self._set_payload(data)
+            for stage in self._get_stages():
+                if len(stage) > 1:
+                    data = self._set_payload(self._execute_stage(stage, data))
+                    continue
+                number, step = stage[0]
                 # execute each step in order
                 logger.debug('Executing step %s.', number)
+                start = time.perf_counter()
                 try:
-                    new_data = step.execute(data, self.context)
-                    data = new_data or data
+                    if self._is_async(step):
+                        new_data = run_coroutine(
+                            step.execute(data, self.context))
+                    else:
+                        new_data = step.execute(data, self.context)
+                    data = self._set_payload(
+                        self._track_data(new_data) or data)
                 except:
                     self._log_exception()
                     self._on_step_failure(step)
                     raise
+                finally:
+                    self.step_times[number] = time.perf_counter() - start
             self.data = data
         except Exception:
             # make sure error info is routed into the TaskMessage
@@ -275,6 +418,171 @@ class Rule(TaskMessaging):
             # for this rule
             self._log_exception()
             raise
+        finally:
+            self._release_steps()
+            # a buffer that is the rule's result is handed to the caller
+            self.context.close_buffers(keep=self.data)
+
+    def _set_payload(self, data):
+        '''
+        Gives the steps a new, empty parse cache when the data changes.
+        '''
+        if self.context.payload is None or \
+            self.context.payload.data is not data:
+            self.context.payload = Payload(data)
+        return data
+
+    def _track_data(self, data):
+        '''
+        Makes sure a DataBuffer returned by a step is closed when the rule
+        completes.
+        '''
+        if isinstance(data, DataBuffer):
+            self.context.track_buffer(data)
+        return data
+
+    def _release_steps(self):
+        '''
+        Returns reusable steps to the step pool and tears down the others.
+        '''
+        if self._steps_released:
+            return
+        self._steps_released = True
+        self._release(self.steps.values())
+
+    @staticmethod
+    def _release(steps):
+        for step in steps:
+            try:
+                if getattr(step, 'reusable', False):
+                    step_pool.release(step)
+                else:
+                    step.teardown()
+            except Exception:
+                logger.exception('Could not release step %s.', step.db_step)
+
+    def _get_stages(self):
+        '''
+        Groups the steps into execution stages.  Consecutive steps sharing
+        the same (non-empty) `stage` value form a single stage; every other
+        step is a stage of its own.
+        :return: A list of lists of (order, Step) tuples.
+        '''
+        stages = []
+        previous = None
+        for number, step in self.steps.items():
+            stage = getattr(step.db_step, 'stage', None)
+            if stage is not None and stage == previous:
+                stages[-1].append((number, step))
+            else:
+                stages.append([(number, step)])
+            previous = stage
+        return stages
+
+    def _execute_stage(self, stage: list, data):
+        '''
+        Executes the independent steps of a stage concurrently.  Synchronous
+        steps run on a thread pool and async steps are awaited together on
+        an event loop.  Each step is handed the same data and its own copy
+        of the rule context.  Once all of the steps are done, their context
+        changes and return values are merged back in step order so that the
+        result does not depend on which step finished first: for keys
+        written by more than one step, and for the returned data, the
+        highest ordered step wins.  If any steps fail, each failed step's
+        failure routine is called and the exception of the lowest ordered
+        failed step is raised.
+        :param stage: A list of (order, Step) tuples.
+        :param data: The data to pass to each of the steps.
+        :return: The data for the following steps.
+        '''
+        logger.debug('Executing steps %s concurrently.',
+                     [number for number, step in stage])
+        snapshot = dict(self.context.context)
+        contexts = []
+        for number, step in stage:
+            context = copy(self.context)
+            context.context = dict(snapshot)
+            contexts.append(context)
+        if any(self._is_async(step) for number, step in stage):
+            results = run_coroutine(
+                self._gather_stage(stage, data, contexts))
+        else:
+            with ThreadPoolExecutor(
+                max_workers=min(STEP_THREAD_POOL_SIZE, len(stage))) as pool:
+                futures = [
+                    pool.submit(self._execute_step_in_thread, number, step,
+                                data, context)
+                    for (number, step), context in zip(stage, contexts)
+                ]
+            results = [future.exception() or future.result()
+                       for future in futures]
+        failures = []
+        new_data = None
+        for (number, step), context, result in zip(stage, contexts, results):
+            if isinstance(result, BaseException):
+                failures.append((step, result))
+                continue
+            self._merge_context(snapshot, context)
+            new_data = self._track_data(result) or new_data
+        for step, exception in failures:
+            self.error('Step %s failed: %s' % (step.db_step, exception))
+            self._on_step_failure(step)
+        if failures:
+            raise failures[0][1]
+        return new_data or data
+
+    async def _gather_stage(self, stage: list, data, contexts: list):
+        '''
+        Awaits the async steps of a stage while the synchronous ones run in
+        the loop's thread pool.
+        :return: The results or exceptions of each step, in step order.
+        '''
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(
+            max_workers=min(STEP_THREAD_POOL_SIZE, len(stage))) as pool:
+            awaitables = []
+            for (number, step), context in zip(stage, contexts):
+                if self._is_async(step):
+                    awaitables.append(self._await_step(number, step, data,
+                                                       context))
+                else:
+                    awaitables.append(loop.run_in_executor(
+                        pool, self._execute_step_in_thread, number, step,
+                        data, context))
+            return await asyncio.gather(*awaitables, return_exceptions=True)
+
+    @staticmethod
+    def _is_async(step) -> bool:
+        return inspect.iscoroutinefunction(step.execute)
+
+    def _execute_step_in_thread(self, number: int, step, data,
+                                context: RuleContext):
+        start = time.perf_counter()
+        try:
+            return step.execute(data, context)
+        finally:
+            self.step_times[number] = time.perf_counter() - start
+            # each thread opens its own database connections
+            connections.close_all()
+
+    async def _await_step(self, number: int, step, data,
+                          context: RuleContext):
+        start = time.perf_counter()
+        try:
+            return await step.execute(data, context)
+        finally:
+            self.step_times[number] = time.perf_counter() - start
+
+    def _merge_context(self, snapshot: dict, context: RuleContext):
+        '''
+        Applies the changes a step made to its copy of the context dictionary
+        to the rule's context.
+        '''
+        for key, value in context.context.items():
+            if key not in snapshot or snapshot[key] is not value:
+                self.context.context[key] = value
+        for key in snapshot.keys() - context.context.keys():
+            self.context.context.pop(key, None)
 
     def _log_exception(self):
         data = traceback.format_exc()
@@ -293,19 +601,24 @@ class Rule(TaskMessaging):
             self.db_task.STATUS = 'FAILED'
             self.db_task.save()
             self.error('Performing step failure routine.')
-            step.on_failure()
+            result = step.on_failure()
+            if inspect.isawaitable(result):
+                run_coroutine(result)
         except Exception:
             self.error('Step\'s on failure routine failed!')
             raise
 
     def _load_steps(self):
         '''
-        Dynamically loads each of the steps into memory for execution.
+        Dynamically loads each of the steps into memory for execution.  If
+        a step can not be loaded, the steps loaded before it are returned
+        to the step pool or torn down.
         :return: A list of Step instances.
         '''
+        steps = {}
         try:
-            db_steps = self.db_rule.step_set.all()
-            steps = {}
+            db_steps = self.db_rule.step_set.prefetch_related(
+                'stepparameter_set')
             for db_step in db_steps:
                 step = self._load_step(db_step)
                 steps[db_step.order] = step
@@ -317,6 +630,7 @@ class Rule(TaskMessaging):
             data = traceback.format_exc()
             self.error('Could not load the steps.')
             self.error(data)
+            self._release(steps.values())
             raise
 
     def _load_step(self, db_step: models.Step):
@@ -327,10 +641,12 @@ class Rule(TaskMessaging):
         :return: A Step instance.
         '''
         self.info(_('Loading step %s') % db_step.name)
-        step = locate(db_step.step_class)
+        step = load_step_class(db_step.step_class)
         if not step:
             step = self._step_import(db_step.step_class)
-            if not step:
+            if step:
+                _step_classes[db_step.step_class] = step
+            else:
                 self.error(_(
                     'Step %s could not be loaded. '
                     'Make sure it and any dependencies are on the PYTHONPATH '
@@ -345,8 +661,19 @@ class Rule(TaskMessaging):
         step.db_step = db_step
         params = {p.name: p.value
                   for p in db_step.stepparameter_set.all()}
+        step_class = step
+        if getattr(step_class, 'reusable', False):
+            step = step_pool.acquire(
+                db_step, params, lambda: step_class(self.db_task, **params))
+            # point the pooled instance's messaging at this task
+            step.task = self.db_task
+        else:
+            step = step_class(self.db_task, **params)
+            step.setup()
+        # the class level value is shared by every rule using the class
+        step.db_step = db_step
         self.info('Step loaded successfully.')
-        return step(self.db_task, **params)
+        return step
 
     def _step_import(self, step_name: str):
         '''
@@ -384,6 +711,18 @@ class Step(TaskMessaging, metaclass=ABCMeta):
     Each Rule has a number of steps that execute in order.
     A step has a defined python.
 
+    Steps have a simple lifecycle: `setup` is called once the step is
+    created, `execute` for each message and `teardown` when the step is
+    discarded.  By default a new step instance is created for every task
+    and torn down when the rule completes.  Steps that open expensive
+    resources (database connections, HTTP or SFTP sessions, compiled
+    schemas) can set `reusable = True`; the instance is then kept in the
+    worker process's step pool, set up once and reused by subsequent tasks
+    of the same step configuration until the worker shuts down.  Before
+    each reuse `health_check` is called and, if it returns False, the
+    instance is torn down and replaced.  Reusable steps must not keep
+    per-message state on the instance.
+
     A step can declare it's parameters by providing a dictionary with
     parameter name and description.  For example:
     declared_paramters = {'order':'How to order the data.  Possible values
@@ -394,6 +733,8 @@ class Step(TaskMessaging, metaclass=ABCMeta):
     steps.
     '''
 
+    reusable = False
+
     def __init__(self, db_task: models.Task, **kwargs):
         '''
         Any parameters loaded from the database will be sent
@@ -404,6 +745,8 @@ class Step(TaskMessaging, metaclass=ABCMeta):
         super().__init__(db_task)
         self._db_step = None
         self.parameters = kwargs or {}
+        # converted parameter values by (name, type)
+        self._converted_parameters = {}
         self._declared_parameters = {}
         self._check_parameters(self.parameters, self._declared_parameters)
 
@@ -442,9 +785,38 @@ class Step(TaskMessaging, metaclass=ABCMeta):
         :return: Either return the original data or None.  If None
         then the data will remain unchanged for following steps.
         If the data is modified, then subsequent steps will get the
+
+        `execute` may also be declared as a coroutine (`async def execute`)
+        in which case the Rule will run it on an event loop.  Async steps
+        that share an execution stage are awaited concurrently.  Use the
+        `ainfo`, `aerror`, etc. helpers for task messages and Django's async
+        ORM methods (or `sync_to_async`) for database access from async
+        steps.
         '''
         return data
 
+    def setup(self):
+        '''
+        Override to open any resources the step needs.  Called once after
+        the step is created; for reusable steps that is once per worker
+        process and step configuration.
+        '''
+        pass
+
+    def teardown(self):
+        '''
+        Override to close the resources opened in `setup`.
+        '''
+        pass
+
+    def health_check(self) -> bool:
+        '''
+        Override to verify that a reusable step's resources are still usable
+        before the step is handed to another task.
+        :return: False if the step should be torn down and replaced.
+        '''
+        return True
+
     def get_parameter(self, parameter_name: str,
                       default: str = None,
                       raise_exception: bool = False):
@@ -497,6 +869,8 @@ class Step(TaskMessaging, metaclass=ABCMeta):
                 ' is configured in the Step\'s '
                 'parameters settings.' % parameter_name
             )
+        if parameter_name in self.parameters:
+            return self._convert_parameter(parameter_name, int)
         return int(ret)
 
     def get_boolean_parameter(self, parameter_name: str,
@@ -521,9 +895,45 @@ class Step(TaskMessaging, metaclass=ABCMeta):
         ret = default
         val = self.get_parameter(parameter_name, default, raise_exception)
         if isinstance(val, str):
-            ret = val.lower() in ['true', '1']
+            ret = self._convert_parameter(
+                parameter_name, bool,
+                lambda value: value.lower() in ['true', '1'], val)
         return ret
 
+    def get_json_parameter(self, parameter_name: str,
+                           default=None,
+                           raise_exception: bool = False):
+        '''
+        A helper function that will parse a parameter holding JSON.  The
+        value is only parsed the first time it is asked for; do not modify
+        the returned object.
+        :param parameter_name: The name of the parameter from which the value
+        should be obtained.
+        :param default: If the parameter is not found, return this value-
+        default is None.
+        :param raise_exception: Whether or not to raise an Exception if
+        the value is not found.
+        :return: The parsed value of the parameter.
+        '''
+        val = self.get_parameter(parameter_name, None, raise_exception)
+        if val is None:
+            return default
+        return self._convert_parameter(parameter_name, 'json', json.loads)
+
+    def _convert_parameter(self, parameter_name: str, parameter_type,
+                           converter=None, value: str = None):
+        '''
+        Converts a parameter value once and returns the cached result on
+        subsequent calls.
+        '''
+        if value is None:
+            value = self.parameters[parameter_name]
+        key = (parameter_name, parameter_type, value)
+        if key not in self._converted_parameters:
+            self._converted_parameters[key] = (converter or parameter_type)(
+                value)
+        return self._converted_parameters[key]
+
     def get_or_create_parameter(self, name: str,
                                 default: str,
                                 description: str = 'Default value.'):
@@ -536,16 +946,15 @@ class Step(TaskMessaging, metaclass=ABCMeta):
         :param description: The description to add.
         :return: The value of the parameter.
         '''
-        try:
-            param = models.StepParameter.objects.get(name=name,
-                                                     step=self.db_step)
-        except models.StepParameter.DoesNotExist:
-            param = models.StepParameter.objects.create(
-                name=name,
-                value=default,
-                step=self.db_step,
-                description=description
-            )
+        # the step's parameters were loaded with the step
+        if name in self.parameters:
+            return self.parameters[name]
+        param, created = models.StepParameter.objects.get_or_create(
+            name=name,
+            step=self.db_step,
+            defaults={'value': default, 'description': description}
+        )
+        self.parameters[name] = param.value
         return param.value
 
     def get_task_parameters(self, rule_context: RuleContext) -> dict:
@@ -555,15 +964,17 @@ class Step(TaskMessaging, metaclass=ABCMeta):
         need to accept additional parameters from external sources, any
         get parameters in the URL to the rule engine will be placed into
         the task parameters and can be retrieved here.
+        The rule loads the task parameters into the rule context once, so
+        this does not query the database.
         :return: A python dict
         '''
-        ret = {}
-        params = models.TaskParameter.objects.filter(
-            task__name=rule_context.task_name
-        )
-        for param in params:
-            ret[param.name] = param.value
-        return ret
+        if rule_context.task_parameters is None:
+            rule_context.task_parameters = {
+                param.name: param.value for param in
+                models.TaskParameter.objects.filter(
+                    task__name=rule_context.task_name)
+            }
+        return dict(rule_context.task_parameters)
 
     @abstractmethod
     def on_failure(self):
@@ -591,14 +1002,132 @@ class Step(TaskMessaging, metaclass=ABCMeta):
         pass
 
 
+def load_step_class(class_path: str):
+    '''
+    Returns the class at the python class path, caching it for the life of
+    the process so that subsequent tasks skip the lookup.
+    :param class_path: The full python path of the class.
+    :return: The class or None if it could not be located.
+    '''
+    step = _step_classes.get(class_path)
+    if step is None:
+        step = locate(class_path)
+        if step:
+            _step_classes[class_path] = step
+    return step
+
+
+def warm_up() -> int:
+    '''
+    Imports the step class of every configured Step.  Called by the Celery
+    worker before it forks its pool processes so that the children share the
+    imported modules with the parent and the first task of each rule does
+    not pay for the imports.
+    :return: The number of step classes loaded.
+    '''
+    loaded = 0
+    class_paths = models.Step.objects.values_list(
+        'step_class', flat=True).distinct()
+    for class_path in class_paths:
+        try:
+            if load_step_class(class_path):
+                loaded += 1
+            else:
+                logger.warning('Could not preload step class %s.',
+                               class_path)
+        except Exception:
+            logger.exception('Could not preload step class %s.', class_path)
+    return loaded
+
+
+class StepPool:
+    '''
+    Keeps idle, set up instances of reusable steps (see `Step.reusable`)
+    for the life of the worker process.  Instances are pooled by step
+    configuration; when a step's class or parameters change, the idle
+    instances of the old configuration are torn down.  Instances are
+    checked out for the duration of a rule execution so concurrent rules
+    never share an instance.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def acquire(self, db_step: models.Step, params: dict, factory):
+        '''
+        Returns a healthy idle instance for the step configuration or, if
+        there is none, a new instance that has been set up.
+        :param db_step: The step's database configuration.
+        :param params: The step's parameters.
+        :param factory: A callable returning a new step instance.
+        :return: A step instance.
+        '''
+        signature = (db_step.step_class, tuple(sorted(params.items())))
+        stale = []
+        with self._lock:
+            current, idle = self._idle.get(db_step.pk, (signature, []))
+            if current != signature:
+                stale, idle = idle, []
+            self._idle[db_step.pk] = (signature, idle)
+        for step in stale:
+            self._teardown(step)
+        while True:
+            with self._lock:
+                step = idle.pop() if idle else None
+            if step is None:
+                step = factory()
+                step.setup()
+                break
+            if self._is_healthy(step):
+                break
+            self._teardown(step)
+        step._pool_key = (db_step.pk, signature)
+        return step
+
+    def release(self, step: 'Step'):
+        '''
+        Returns a step to the pool.  If its configuration is no longer
+        current, it is torn down instead.
+        '''
+        pk, signature = step._pool_key
+        with self._lock:
+            current, idle = self._idle.get(pk, (None, None))
+            if current == signature:
+                idle.append(step)
+                return
+        self._teardown(step)
+
+    def clear(self):
+        '''
+        Tears down every idle step.  Called when the worker shuts down.
+        '''
+        with self._lock:
+            entries, self._idle = self._idle, {}
+        for signature, idle in entries.values():
+            for step in idle:
+                self._teardown(step)
+
+    def _is_healthy(self, step: 'Step') -> bool:
+        try:
+            return step.health_check()
+        except Exception:
+            logger.exception('Health check of pooled step failed.')
+            return False
+
+    def _teardown(self, step: 'Step'):
+        try:
+            step.teardown()
+        except Exception:
+            logger.exception('Could not tear down pooled step.')
+
+
+step_pool = StepPool()
+
+
 def _rename_model(model_instance: Model, model_type, new_rule_name=None):
-    i = 1
-    if not new_rule_name:
-        new_rule_name = "%s_copy_%s" % (model_instance.name, i)
-    while model_type.objects.filter(name=new_rule_name).exists():
-        i += 1
-        new_rule_name = "%s_copy_%s" % (model_instance.name, i)
-    model_instance.name = new_rule_name
+    model_instance.name = unique_name(model_type, model_instance.name,
+                                      new_rule_name)
 
 
 def clone_rule(rule_name: str, new_rule_name: str):
@@ -607,39 +1136,15 @@ def clone_rule(rule_name: str, new_rule_name: str):
     will be [rule_name] (n) - where rule_name is the original name and
     n is an integer representing the number of the copy if there is more
     than one.  For example, copy of *This Rule* would result in
-    *This Rule 1*.
+    *This Rule 1*.  The copy is made in a single transaction by exporting
+    the rule as a bundle and importing it under the new name.
     :param rule_name: The name of the rule to clone.
     :param new_rule_name: The name of the new rule.
     :return: The new rule model instance.
     """
     logger.debug('Getting rule with name %s.', rule_name)
-    db_rule = models.Rule.objects.prefetch_related(
-        'step_set',
-        'step_set__stepparameter_set',
-        'ruleparameter_set'
-    ).get(name=rule_name)
-
-    new_rule = deepcopy(db_rule)
-    new_rule.id = None
-    new_rule.pk = None
-    _rename_model(new_rule, models.Rule, new_rule_name)
-    new_rule.save()
-    for rule_param in db_rule.ruleparameter_set.all():
-        new_rp = deepcopy(rule_param)
-        new_rp.id = None
-        new_rp.pk = None
-        new_rp.rule = new_rule
-        new_rp.save()
-    for step in db_rule.step_set.all():
-        new_step = deepcopy(step)
-        new_step.id = None
-        new_step.pk = None
-        new_step.rule = new_rule
-        new_step.save()
-        for step_parameter in step.stepparameter_set.all():
-            new_sp = deepcopy(step_parameter)
-            new_sp.id = None
-            new_sp.pk = None
-            new_sp.step = new_step
-            new_sp.save()
-    return new_rule
+    with transaction.atomic():
+        bundle = export_rules([rule_name])
+        bundle['rules'][0]['name'] = unique_name(models.Rule, rule_name,
+                                                 new_rule_name)
+        return import_rules(bundle, replace=False)[0]
@@ -0,0 +1,381 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+'''
+A storage backend that appends messages to rolling segment files instead
+of creating a file per message.  Small messages then cost a sequential
+append rather than a file creation, metadata write and fsync each.
+
+Each process appends to its own segment file, which it holds an exclusive
+`flock` on, and rolls over to a new one once it reaches
+QUARTET_CAPTURE_SEGMENT_SIZE bytes.  Every record is a header (magic,
+name length, CRC32 and payload length), the name the message was saved
+under and the payload.  The storage key returned by `save` (and recorded in
+`Task.location`) is `<segment>@<record offset>+<payload length>`, so a read
+is a single positioned read that is checked against the CRC.  Keys without
+an `@` are plain files and are handled by the file system storage so
+messages stored before the switch can still be read.
+
+Appends are made durable with group commit: a writer that finds its record
+already covered by another thread's fsync does not sync again.  A record
+torn by a crash is never referenced by a task because the task's location
+is saved after the append returns; `recover_segments` truncates such tails.
+Deleting a message does nothing, `compact_segments` copies the records
+still referenced by tasks out of mostly dead segments and removes them.
+'''
+import fcntl
+import os
+import struct
+import threading
+import time
+import weakref
+import zlib
+from logging import getLogger
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from quartet_capture.locations import DeferredDeletes
+from quartet_capture.models import Task as DBTask
+
+logger = getLogger('quartet_capture')
+
+# the size at which a process starts a new segment
+SEGMENT_SIZE = getattr(settings, 'QUARTET_CAPTURE_SEGMENT_SIZE',
+                       64 * 1024 * 1024)
+# whether each append is fsynced before the task is saved
+SEGMENT_FSYNC = getattr(settings, 'QUARTET_CAPTURE_SEGMENT_FSYNC', True)
+# the directory of the segments relative to the storage root
+SEGMENT_DIRECTORY = 'segments'
+# segments touched more recently than this many seconds are not compacted
+COMPACT_MIN_AGE = 60
+
+_MAGIC = b'QCS1'
+_HEADER = struct.Struct('>4sHIQ')
+
+
+class SegmentStorage(FileSystemStorage):
+    '''
+    Stores messages as records of append-only segment files.  Configure it
+    with QUARTET_CAPTURE_MESSAGE_STORAGE.
+    '''
+    directory = SEGMENT_DIRECTORY
+    # prepended to the keys of the records
+    key_prefix = ''
+
+    def save(self, name, content, max_length=None):
+        '''
+        Appends the content to the process's active segment.
+        :return: The key of the record.
+        '''
+        if hasattr(content, 'read'):
+            content = content.read()
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        return _get_writer(self).append(name or '', content)
+
+    def _open(self, name, mode='rb'):
+        if not is_segment_key(name):
+            return super()._open(name, mode)
+        return ContentFile(read_record(self, name), name=name)
+
+    def exists(self, name):
+        if not is_segment_key(name):
+            return super().exists(name)
+        segment, offset, length = self.parse_key(name)
+        try:
+            return offset + _HEADER.size + length <= os.path.getsize(
+                self.path(segment))
+        except OSError:
+            return False
+
+    def size(self, name):
+        if not is_segment_key(name):
+            return super().size(name)
+        return self.parse_key(name)[2]
+
+    def parse_key(self, key: str):
+        '''
+        :return: A tuple of (segment name, record offset, payload length).
+        '''
+        return parse_key(key[len(self.key_prefix):])
+
+    def delete(self, name):
+        # the space of segment records is reclaimed by compaction
+        if not is_segment_key(name):
+            super().delete(name)
+
+
+def is_segment_key(name: str) -> bool:
+    return '@' in name
+
+
+def parse_key(key: str):
+    '''
+    :return: A tuple of (segment name, record offset, payload length).
+    '''
+    segment, position = key.rsplit('@', 1)
+    offset, length = position.split('+')
+    return segment, int(offset), int(length)
+
+
+def read_record(storage: SegmentStorage, key: str) -> bytes:
+    '''
+    Reads and checks the payload of a record.
+    :raises IOError: If the record is damaged.
+    '''
+    segment, offset, length = storage.parse_key(key)
+    fd = os.open(storage.path(segment), os.O_RDONLY)
+    try:
+        header = os.pread(fd, _HEADER.size, offset)
+        magic, name_length, crc, stored_length = _HEADER.unpack(header)
+        data = os.pread(fd, length, offset + _HEADER.size + name_length)
+    finally:
+        os.close(fd)
+    if magic != _MAGIC or stored_length != length or \
+        zlib.crc32(data) != crc:
+        raise IOError('The segment record %s is damaged.' % key)
+    return data
+
+
+class _SegmentWriter:
+    '''
+    Appends records to the active segment of a process.
+    '''
+
+    def __init__(self, storage: SegmentStorage):
+        self.storage = storage
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.file = None
+        self.segment = None
+        self.position = 0
+        self.synced = 0
+        self.sequence = 0
+        # closed segments whose final fsync failed
+        self.unsynced = weakref.WeakSet()
+
+    def append(self, name: str, data: bytes) -> str:
+        encoded_name = name.encode('utf-8')
+        record = _HEADER.pack(_MAGIC, len(encoded_name), zlib.crc32(data),
+                              len(data)) + encoded_name + data
+        with self.lock:
+            if self.file is None or self.position >= SEGMENT_SIZE:
+                self._roll()
+            file, segment, offset = self.file, self.segment, self.position
+            try:
+                file.write(record)
+                file.flush()
+            except Exception:
+                # part of the record may have been written, so the position
+                # is unknown; the next append starts a new segment and
+                # recover_segments truncates the torn record
+                self._abandon()
+                raise
+            self.position += len(record)
+            end = self.position
+        if SEGMENT_FSYNC:
+            self._sync(file, segment, end)
+        return '%s%s@%s+%s' % (self.storage.key_prefix, segment, offset,
+                                len(data))
+
+    def _sync(self, file, segment: str, end: int):
+        '''
+        Makes the records written to a segment up to `end` durable.
+        :raises OSError: If the segment was closed and could not be synced.
+        '''
+        with self.sync_lock:
+            # one fsync covers the records of every waiting thread and a
+            # closed segment was synced when it was closed
+            if file in self.unsynced:
+                raise OSError('Could not sync segment %s.' % segment)
+            if self.file is file and self.synced < end:
+                synced = self.position
+                os.fsync(file.fileno())
+                self.synced = synced
+
+    def _roll(self):
+        if self.file:
+            self._close_file()
+        directory = self.storage.path(self.storage.directory)
+        os.makedirs(directory, exist_ok=True)
+        self.sequence += 1
+        self.segment = '%s/%d-%d-%d.seg' % (
+            self.storage.directory, time.time() * 1000, self.pid,
+            self.sequence)
+        self.file = open(self.storage.path(self.segment), 'xb')
+        # marks the segment as active for recovery and compaction
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.position = self.synced = 0
+
+    def _close_file(self):
+        '''
+        Syncs and closes the active segment.  The threads waiting to sync
+        their records to it find it synced, or fail if the fsync failed.
+        Must be called holding `lock`.
+        '''
+        with self.sync_lock:
+            file, self.file = self.file, None
+            try:
+                os.fsync(file.fileno())
+            except Exception:
+                self.unsynced.add(file)
+                raise
+            finally:
+                file.close()
+
+    def _abandon(self):
+        try:
+            self._close_file()
+        except Exception:
+            logger.warning('Could not close segment %s.', self.segment,
+                           exc_info=True)
+
+    def close(self):
+        with self.lock:
+            if self.file:
+                self._close_file()
+
+
+# the writers of this process by segment directory
+_writers = {}
+_writer_lock = threading.Lock()
+
+
+def _get_writer(storage: SegmentStorage) -> _SegmentWriter:
+    directory = storage.path(storage.directory)
+    with _writer_lock:
+        writer = _writers.get(directory)
+        # a forked child must not append to its parent's segment
+        if writer is None or writer.pid != os.getpid():
+            writer = _writers[directory] = _SegmentWriter(storage)
+        return writer
+
+
+def close_segment():
+    '''
+    Seals the active segments of this process.  The next save starts a new
+    one.
+    '''
+    for writer in list(_writers.values()):
+        if writer.pid == os.getpid():
+            writer.close()
+
+
+def sealed_segments(storage: SegmentStorage):
+    '''
+    Yields the names of the segments no process is appending to.
+    '''
+    directory = storage.path(storage.directory)
+    if not os.path.isdir(directory):
+        return
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.endswith('.seg'):
+            continue
+        segment = '%s/%s' % (storage.directory, file_name)
+        with open(storage.path(segment), 'rb') as file:
+            try:
+                fcntl.flock(file.fileno(), fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+        yield segment
+
+
+def _scan(path: str):
+    '''
+    Yields the (offset, name, payload length, valid) of the records of a
+    segment up to the first damaged one.
+    '''
+    with open(path, 'rb') as file:
+        offset = 0
+        while True:
+            header = file.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                if header:
+                    yield offset, None, 0, False
+                return
+            magic, name_length, crc, length = _HEADER.unpack(header)
+            name = file.read(name_length)
+            data = file.read(length) if magic == _MAGIC else b''
+            if magic != _MAGIC or len(data) < length or \
+                zlib.crc32(data) != crc:
+                yield offset, None, 0, False
+                return
+            yield offset, name.decode('utf-8', 'replace'), length, True
+            offset += _HEADER.size + name_length + length
+
+
+def recover_segments(storage: SegmentStorage = None) -> int:
+    '''
+    Truncates the records torn by a crash from the end of the sealed
+    segments.
+    :return: The number of bytes truncated.
+    '''
+    storage = storage or SegmentStorage()
+    truncated = 0
+    for segment in sealed_segments(storage):
+        path = storage.path(segment)
+        for offset, name, length, valid in _scan(path):
+            if not valid:
+                truncated += os.path.getsize(path) - offset
+                logger.warning('Truncating the damaged tail of segment %s '
+                               'at %s.', segment, offset)
+                os.truncate(path, offset)
+    return truncated
+
+
+def compact_segments(threshold: float = 0.5,
+                     storage: SegmentStorage = None,
+                     grace: float = None) -> int:
+    '''
+    Rewrites the records that tasks still reference out of sealed segments
+    whose live records make up less than `threshold` of the file, then
+    removes the segments no task references.  The live records are
+    appended to the active segment and each task is repointed before the
+    old segment is removed, so compaction can run alongside captures.  The
+    old segments are kept for a grace period so that workers that loaded a
+    task before it was repointed can still read its record.
+    :param threshold: The live fraction below which a segment is rewritten.
+    :param storage: The segment storage.
+    :param grace: The number of seconds the old segments are kept.
+    Defaults to the QUARTET_CAPTURE_STORAGE_DELETE_GRACE setting.
+    :return: The number of bytes reclaimed.
+    '''
+    storage = storage or SegmentStorage()
+    recover_segments(storage)
+    deletes = DeferredDeletes(os.remove, grace)
+    reclaimed = 0
+    for segment in sealed_segments(storage):
+        path = storage.path(segment)
+        size = os.path.getsize(path)
+        if time.time() - os.path.getmtime(path) < COMPACT_MIN_AGE:
+            continue
+        prefix = storage.key_prefix + segment + '@'
+        live = list(DBTask.objects.filter(
+            location__startswith=prefix).values_list('name', 'location'))
+        live_bytes = sum(storage.parse_key(location)[2]
+                         for name, location in live)
+        if live and live_bytes >= size * threshold:
+            continue
+        for task_name, location in live:
+            with storage.open(location) as message_file:
+                new_location = storage.save(task_name + '.dat', message_file)
+            DBTask.objects.filter(
+                name=task_name, location=location
+            ).update(location=new_location)
+        if not DBTask.objects.filter(location__startswith=prefix).exists():
+            deletes.add(path)
+            reclaimed += size - live_bytes
+    deletes.run(wait=True)
+    return reclaimed
@@ -17,7 +17,8 @@ This module defines the default serializers for the
 rule framework model.
 '''
 from django.contrib.auth import get_user_model
-from rest_framework.serializers import ModelSerializer
+from django.core.exceptions import ValidationError as DjangoValidationError
+from rest_framework.serializers import ModelSerializer, ValidationError
 from quartet_capture import models
 
 User = get_user_model()
@@ -96,6 +97,19 @@ class RuleFilterSerializer(ModelSerializer):
     Default serializer for the RuleFilter model.
     '''
 
+    def validate(self, attrs):
+        # runs the search value checks of the model
+        rule_filter = models.RuleFilter(
+            search_type=attrs.get('search_type', getattr(
+                self.instance, 'search_type', 'search')),
+            search_value=attrs.get('search_value', getattr(
+                self.instance, 'search_value', '')))
+        try:
+            rule_filter.clean()
+        except DjangoValidationError as e:
+            raise ValidationError(e.message_dict)
+        return attrs
+
     class Meta:
         model = models.RuleFilter
         fields = '__all__'
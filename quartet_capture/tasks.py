@@ -13,27 +13,71 @@
 #
 # Copyright 2018 SerialLab Corp.  All rights reserved.
 from __future__ import absolute_import, unicode_literals
+import gc
+import os
 import io
-import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
 from typing import List
+from django.apps import apps
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.utils.translation import gettext as _
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.utils.timezone import datetime
+from datetime import timedelta
+from django.db import connections, transaction
+from django.db.models import Q
 from django.db.utils import IntegrityError
-from django.core.files.storage import get_storage_class
 from celery import shared_task
 from celery.exceptions import SoftTimeLimitExceeded
-from quartet_capture.errors import RuleNotFound
+from celery.signals import worker_init, worker_process_shutdown, \
+    worker_shutdown
+from quartet_capture import metrics, patterns
+from quartet_capture.backends import get_backend, start_claimed_task
+from quartet_capture.buffers import DataBuffer
+from quartet_capture.paths import compile_path
+from quartet_capture.locations import build_location, \
+    get_message_storage, open_task_message
+from quartet_capture.errors import RuleNotFound, TaskDependencyError, \
+    TaskDeferred
 from quartet_capture.models import Task as DBTask, Rule as DBRule, \
-    TaskHistory, Filter, RuleFilter
-from quartet_capture.rules import Rule
+    TaskHistory, Filter, RuleFilter, TaskDependency
+from quartet_capture.rules import Rule, step_pool, warm_up
 import time
 from quartet_capture.models import haikunate
 
 StringList = List[str]
 logger = getLogger('quartet_capture')
 
+# tasks in these states no longer hold up any dependent tasks
+COMPLETED_STATUSES = ['FINISHED', 'FAILED']
+# tasks in these states hold up tasks that depend on their rule
+OUTSTANDING_STATUSES = ['QUEUED', 'RUNNING']
+# the number of threads storing the messages of tasks run inline
+PERSIST_THREADS = getattr(settings, 'QUARTET_CAPTURE_PERSIST_THREADS', 2)
+_persist_executor = None
+_persist_executor_lock = threading.Lock()
+# the number of seconds a running task's lease lasts, it is renewed every
+# third of that
+LEASE_SECONDS = getattr(settings, 'QUARTET_CAPTURE_LEASE_SECONDS', 300)
+# how long a task can be QUEUED without being dispatched before the
+# sweeper dispatches it
+SWEEP_QUEUED_AFTER = getattr(settings, 'QUARTET_CAPTURE_SWEEP_QUEUED_AFTER',
+                             300)
+# the maximum number of tasks of each kind the sweeper recovers per run
+SWEEP_LIMIT = getattr(settings, 'QUARTET_CAPTURE_SWEEP_LIMIT', 1000)
+# the maximum number of tasks the sweeper dispatches per second
+SWEEP_RATE = getattr(settings, 'QUARTET_CAPTURE_SWEEP_RATE', 100)
+# the number of tasks sent to celery as one group by a bulk requeue
+REQUEUE_BATCH_SIZE = getattr(settings, 'QUARTET_CAPTURE_REQUEUE_BATCH_SIZE',
+                             100)
+# the celery message priority of bulk requeued tasks
+REQUEUE_PRIORITY = getattr(settings, 'QUARTET_CAPTURE_REQUEUE_PRIORITY',
+                           None)
+
 
 def execute_rule(message: bytes, db_task: DBTask):
     '''
@@ -52,6 +96,59 @@ def execute_rule(message: bytes, db_task: DBTask):
     return c_rule.context
 
 
+@worker_init.connect
+def warm_up_worker(**kwargs):
+    '''
+    Preloads the configured step classes in the main worker process before
+    the pool processes are forked.  The objects that exist at that point
+    are then frozen out of the garbage collector so that collections in
+    the children do not touch, and therefore copy, the shared memory pages.
+    Set QUARTET_CAPTURE_WARM_UP_WORKERS to False to disable.
+    '''
+    if not getattr(settings, 'QUARTET_CAPTURE_WARM_UP_WORKERS', True) \
+        or not apps.ready:
+        return
+    try:
+        logger.info('Preloaded %s step classes.', warm_up())
+    except Exception:
+        logger.exception('Could not warm up the worker.')
+    finally:
+        # database connections must not be shared with forked children
+        connections.close_all()
+    if hasattr(gc, 'freeze'):
+        gc.collect()
+        gc.freeze()
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def teardown_step_pool(**kwargs):
+    '''
+    Tears down the pooled reusable steps when a worker stops.
+    '''
+    step_pool.clear()
+
+
+@worker_init.connect
+def start_metrics_exporter(**kwargs):
+    '''
+    Serves the worker's metrics on QUARTET_CAPTURE_METRICS_PORT if it is
+    set.
+    '''
+    try:
+        metrics.start_exporter()
+    except Exception:
+        logger.exception('Could not start the metrics exporter.')
+
+
+@worker_process_shutdown.connect
+def remove_process_metrics(pid=None, **kwargs):
+    '''
+    Discards the live metric values of a stopped pool process.
+    '''
+    metrics.mark_process_dead(pid or os.getpid())
+
+
 @shared_task(name='execute_queued_task')
 def execute_queued_task(task_name: str, user_id: int = None,
                         raise_exception=False):
@@ -60,30 +157,68 @@ def execute_queued_task(task_name: str, user_id: int = None,
     and putting the descriptor and rule name on a queue.
     :param message: The message to queue.
     '''
+    db_task = DBTask.objects.get(name=task_name)
+    return run_task(db_task, user_id=user_id,
+                    raise_exception=raise_exception)
+
+
+def run_task(db_task: DBTask, data=None, user_id: int = None,
+             raise_exception=False, claimed: bool = False):
+    '''
+    Executes the task's rule.
+    :param db_task: The task to run.
+    :param data: The task's message.  If omitted the message is read from
+    storage.
+    :param user_id: The user running the task (optional).
+    :param raise_exception: Whether to raise the exception of a failed
+    rule.
+    :param claimed: Whether the task was claimed by a database worker, in
+    which case it is only run if the claim still holds.
+    :return: False if the task was not run: its claim was lost, another
+    worker started it or it was parked in the WAITING state because its
+    rule is at its concurrency limit.  Otherwise True.
+    '''
+    if claimed and not start_claimed_task(db_task):
+        logger.info('Task %s was claimed by another worker, skipping it.',
+                    db_task.name)
+        return False
+    if not claimed and not start_task(db_task):
+        logger.info('Task %s was started by another worker, skipping it.',
+                    db_task.name)
+        return False
     if user_id:
         User = get_user_model()
         user = User.objects.get(id=user_id)
     else:
         user = None
-    db_task = DBTask.objects.get(name=task_name)
     if user and user.id:
         TaskHistory.objects.create(task=db_task, user=user)
+    if db_task.status == 'QUEUED' and db_task.status_changed:
+        metrics.record_queue_wait(
+            db_task.rule.name,
+            (timezone.now() - db_task.status_changed).total_seconds())
+    if not acquire_rule_slot(db_task):
+        logger.debug('Rule %s is at its concurrency limit, task %s will '
+                     'wait.', db_task.rule.name, db_task.name)
+        return False
+    c_rule = None
     try:
         start = time.time()
         logger.debug('Running task %s', db_task.name)
         # update the start time and status
         db_task.start = datetime.now()
         db_task.status = 'RUNNING'
+        db_task.lease_expires = TaskLease.expiry()
         db_task.save()
-        # load the message
-        storage_class = get_storage_class()
-        django_storage = storage_class()
-        message_file = django_storage.open(
-            name='{0}.dat'.format(db_task.name))
-        data = message_file.read()
-        c_rule = Rule(db_task.rule, db_task)
-        # execute the rule
-        c_rule.execute(data)
+        with TaskLease(db_task):
+            c_rule = Rule(db_task.rule, db_task)
+            if data is None:
+                # execute the rule without keeping a reference to the
+                # original message here so it can be freed once a step has
+                # transformed it
+                c_rule.execute(read_task_data(db_task))
+            else:
+                c_rule.execute(data)
         db_task.status = 'FINISHED'
     except SoftTimeLimitExceeded:
         logger.exception('The task exceeded the configured time limit '
@@ -91,18 +226,458 @@ def execute_queued_task(task_name: str, user_id: int = None,
                          'limit in your Celery configuration and/or adjust '
                          'your computing resources accordingly.')
         db_task.status = 'QUEUED'
+        # let the sweeper dispatch it again
+        db_task.dispatched = None
         db_task.save()
     except Exception:
-        logger.exception('Could not execute task with name %s', task_name)
+        logger.exception('Could not execute task with name %s', db_task.name)
         db_task.status = 'FAILED'
         db_task.save()
         if raise_exception:
             raise
     finally:
         db_task.end = datetime.now()
+        db_task.lease_expires = None
         end = time.time()
         db_task.execution_time = (end - start)
         db_task.save()
+        metrics.record_task(
+            db_task.rule.name, db_task.status, db_task.execution_time,
+            c_rule and {c_rule.steps[number].db_step.name: seconds
+                        for number, seconds in c_rule.step_times.items()})
+        if c_rule and isinstance(c_rule.data, DataBuffer):
+            # the rule hands its final buffer to the caller
+            c_rule.data.close()
+        if db_task.status in COMPLETED_STATUSES:
+            release_waiting_tasks(db_task)
+        release_rule_slot(db_task)
+    return True
+
+
+class TaskLease:
+    '''
+    Renews the lease of a running task from a background thread until the
+    block it guards exits.  If the worker dies the lease expires and the
+    task sweeper re-queues the task.
+    :param db_task: The running task.
+    '''
+
+    def __init__(self, db_task: DBTask):
+        self.db_task = db_task
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def expiry():
+        return timezone.now() + timedelta(seconds=LEASE_SECONDS)
+
+    def __enter__(self):
+        self._thread = threading.Thread(
+            target=self._renew, name='quartet_capture_lease', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stopped.set()
+        self._thread.join()
+
+    def _renew(self):
+        try:
+            while not self._stopped.wait(LEASE_SECONDS / 3):
+                try:
+                    if not self._renew_once():
+                        logger.warning(
+                            'Task %s was taken over by another worker after '
+                            'its lease expired.', self.db_task.name)
+                        return
+                except Exception:
+                    # try again at the next interval, the lease is still
+                    # valid for two more
+                    logger.exception('Could not renew the lease of task %s.',
+                                     self.db_task.name)
+                    connections.close_all()
+        finally:
+            connections.close_all()
+
+    def _renew_once(self) -> bool:
+        '''
+        Extends the lease if this worker still holds it.
+        :return: False if the lease was lost.
+        '''
+        expiry = self.expiry()
+        renewed = DBTask.objects.filter(
+            name=self.db_task.name, status='RUNNING',
+            lease_expires=self.db_task.lease_expires
+        ).update(lease_expires=expiry)
+        if renewed:
+            self.db_task.lease_expires = expiry
+        return bool(renewed)
+
+
+def start_task(db_task: DBTask) -> bool:
+    '''
+    Takes a lease on a task before a worker runs it, unless another worker
+    holds a live lease on it or its status or lease changed since it was
+    loaded.  Two dispatches of the same task, for example one by the task
+    sweeper, can then not run it at the same time.
+    :param db_task: The task as loaded by the worker.
+    :return: False if the task must not be run.
+    '''
+    now = timezone.now()
+    expiry = TaskLease.expiry()
+    started = DBTask.objects.filter(
+        Q(lease_expires__isnull=True) | Q(lease_expires__lt=now),
+        name=db_task.name, status=db_task.status,
+        lease_expires=db_task.lease_expires
+    ).update(lease_expires=expiry)
+    if started:
+        db_task.lease_expires = expiry
+    return bool(started)
+
+
+def sweep_tasks(limit: int = None, rate: float = None) -> int:
+    '''
+    Recovers tasks that would otherwise never run: QUEUED tasks that were
+    never dispatched (for example because the broker was down) and have
+    waited longer than QUARTET_CAPTURE_SWEEP_QUEUED_AFTER seconds, and
+    RUNNING tasks whose lease has expired because their worker died.  They
+    are re-dispatched in rate limited batches.
+    :param limit: The maximum number of tasks of each kind to recover.
+    Defaults to the QUARTET_CAPTURE_SWEEP_LIMIT setting.
+    :param rate: The maximum number of tasks dispatched per second.
+    Defaults to the QUARTET_CAPTURE_SWEEP_RATE setting.
+    :return: The number of tasks re-dispatched.
+    '''
+    limit = limit or SWEEP_LIMIT
+    now = timezone.now()
+    orphaned = list(DBTask.objects.filter(
+        status='QUEUED', dispatched__isnull=True,
+        status_changed__lt=now - timedelta(seconds=SWEEP_QUEUED_AFTER)
+    ).order_by('status_changed').values_list('name', flat=True)[:limit])
+    expired = list(DBTask.objects.filter(
+        status='RUNNING', lease_expires__lt=now
+    ).order_by('lease_expires').values_list('name', flat=True)[:limit])
+    if expired:
+        # a lease renewed since the query above is left alone
+        expired = list(DBTask.objects.filter(
+            name__in=expired, status='RUNNING', lease_expires__lt=now
+        ).values_list('name', flat=True))
+        DBTask.objects.filter(name__in=expired).update(
+            status='QUEUED', lease_expires=None, status_changed=now,
+            dispatched=None)
+        logger.warning('Re-queuing tasks whose worker stopped: %s', expired)
+    if orphaned:
+        logger.warning('Dispatching tasks that were never dispatched: %s',
+                       orphaned)
+    return requeue_tasks(orphaned + expired,
+                         rate=SWEEP_RATE if rate is None else rate)
+
+
+@shared_task(name='sweep_tasks')
+def sweep_tasks_task():
+    '''
+    Runs the task sweeper.  Schedule it with Celery beat.
+    '''
+    return sweep_tasks()
+
+
+@shared_task(name='archive_tasks')
+def archive_tasks_task(days: float = None, limit: int = None,
+                       rate: float = 0):
+    '''
+    Moves the messages of completed tasks to the archive tier.  Schedule
+    it with Celery beat.
+    '''
+    from quartet_capture.tiers import archive_tasks
+    return archive_tasks(days=days, limit=limit, rate=rate)
+
+
+def read_task_data(db_task: DBTask) -> bytes:
+    '''
+    Reads the message stored for a task from whichever storage tier holds
+    it.
+    :param db_task: The task.
+    :return: The message.
+    '''
+    with open_task_message(db_task) as message_file:
+        return message_file.read()
+
+
+def acquire_rule_slot(db_task: DBTask) -> bool:
+    '''
+    Enforces the rule's `max_concurrency` across all workers.  The rule's
+    row is locked while the running tasks are counted so that two workers
+    can not both take the last slot.  If there is no free slot the task is
+    parked in the WAITING state; `release_rule_slot` will dispatch it again
+    when one of the running tasks completes.
+    :param db_task: The task about to run.
+    :return: True if the task may run, False if it was deferred.
+    '''
+    limit = db_task.rule.max_concurrency
+    if not limit:
+        return True
+    with transaction.atomic():
+        DBRule.objects.select_for_update().get(pk=db_task.rule_id)
+        running = DBTask.objects.filter(
+            rule_id=db_task.rule_id, status='RUNNING'
+        ).exclude(name=db_task.name).count()
+        if running >= limit:
+            db_task.status = 'WAITING'
+            db_task.lease_expires = None
+        else:
+            db_task.status = 'RUNNING'
+        db_task.save()
+    return db_task.status == 'RUNNING'
+
+
+def release_rule_slot(db_task: DBTask):
+    '''
+    Called when a task stops running.  If the task's rule has a concurrency
+    limit, the oldest tasks that were deferred waiting for a slot (and have
+    no outstanding dependencies) are dispatched to fill the free slots.
+    Never raises.
+    :param db_task: The task that stopped running.
+    '''
+    try:
+        limit = db_task.rule.max_concurrency
+        if not limit:
+            return
+        released = []
+        with transaction.atomic():
+            DBRule.objects.select_for_update().get(pk=db_task.rule_id)
+            free_slots = limit - DBTask.objects.filter(
+                rule_id=db_task.rule_id, status='RUNNING'
+            ).count()
+            waiting_tasks = DBTask.objects.filter(
+                rule_id=db_task.rule_id, status='WAITING'
+            ).order_by('status_changed')
+            for waiting_task in waiting_tasks.iterator(chunk_size=100):
+                if len(released) >= free_slots:
+                    break
+                if claim_waiting_task(waiting_task):
+                    released.append(waiting_task.name)
+        for task_name in released:
+            # the queuing user was recorded when the task was queued
+            dispatch_task(task_name)
+    except Exception:
+        logger.exception('Could not release the tasks waiting on rule %s.',
+                         db_task.rule_id)
+
+
+def dispatch_task(task_name: str, user_id: int = None):
+    '''
+    Sends a queued task to the execution backend.
+    :param task_name: The name of the task to execute.
+    :param user_id: The user that queued the task (optional).
+    '''
+    get_backend().dispatch([task_name], user_id=user_id)
+    DBTask.objects.filter(name=task_name).update(dispatched=timezone.now())
+
+
+def dispatch_batch(task_names: StringList, user_id: int = None,
+                   priority: int = None):
+    '''
+    Sends a batch of queued tasks to the execution backend, with Celery as
+    a single group.
+    :param task_names: The names of the tasks to execute.
+    :param user_id: The user that queued the tasks (optional).
+    :param priority: The Celery message priority (optional).
+    '''
+    get_backend().dispatch(task_names, user_id=user_id, priority=priority)
+    DBTask.objects.filter(name__in=task_names).update(
+        dispatched=timezone.now())
+
+
+def select_tasks(rule_name: str = None, status: str = None,
+                 since: datetime = None, until: datetime = None):
+    '''
+    Returns the tasks matching the criteria of a bulk operation, oldest
+    first.
+    :param rule_name: Only tasks of this rule.
+    :param status: Only tasks with this status.
+    :param since: Only tasks whose status changed on or after this time.
+    :param until: Only tasks whose status changed before this time.
+    :return: A Task queryset.
+    '''
+    tasks = DBTask.objects.all()
+    if rule_name:
+        tasks = tasks.filter(rule__name=rule_name)
+    if status:
+        tasks = tasks.filter(status=status)
+    if since:
+        tasks = tasks.filter(status_changed__gte=since)
+    if until:
+        tasks = tasks.filter(status_changed__lt=until)
+    return tasks.order_by('status_changed', 'name')
+
+
+def requeue_tasks(task_names: StringList, batch_size: int = None,
+                  rate: float = 0, priority: int = None, user_id: int = None,
+                  progress=None) -> int:
+    '''
+    Re-queues tasks for execution in batches.  Each batch is marked QUEUED
+    with one update and sent to Celery as one group.  Running tasks are
+    skipped.
+    :param task_names: The names of the tasks to requeue.
+    :param batch_size: The number of tasks per batch.  Defaults to the
+    QUARTET_CAPTURE_REQUEUE_BATCH_SIZE setting.
+    :param rate: The maximum number of tasks to requeue per second so that
+    a recovery backlog does not swamp live traffic.  Zero is unlimited.
+    :param priority: The Celery message priority.  Defaults to the
+    QUARTET_CAPTURE_REQUEUE_PRIORITY setting.
+    :param user_id: The user requeuing the tasks (optional).
+    :param progress: An optional callable that is passed the number of
+    tasks requeued so far and the total after each batch.
+    :return: The number of tasks requeued.
+    '''
+    batch_size = batch_size or REQUEUE_BATCH_SIZE
+    if priority is None:
+        priority = REQUEUE_PRIORITY
+    task_names = list(task_names)
+    total = len(task_names)
+    requeued = 0
+    start = time.time()
+    for offset in range(0, total, batch_size):
+        batch = task_names[offset:offset + batch_size]
+        if rate:
+            delay = start + offset / rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        with transaction.atomic():
+            tasks = DBTask.objects.select_for_update().filter(
+                name__in=batch).exclude(status='RUNNING')
+            batch = list(tasks.values_list('name', flat=True))
+            # cleared so the sweeper recovers the batch if it can not be
+            # dispatched
+            DBTask.objects.filter(name__in=batch).update(
+                status='QUEUED', status_changed=timezone.now(),
+                dispatched=None, lease_expires=None)
+        if batch:
+            dispatch_batch(batch, user_id=user_id, priority=priority)
+        requeued += len(batch)
+        logger.info('Requeued %s of %s tasks.', requeued, total)
+        if progress:
+            progress(requeued, total)
+    return requeued
+
+
+@shared_task(name='requeue_tasks')
+def requeue_tasks_task(rule_name: str = None, status: str = None,
+                       since: str = None, until: str = None,
+                       limit: int = None, batch_size: int = None,
+                       rate: float = 0, priority: int = None,
+                       user_id: int = None):
+    '''
+    Selects and requeues tasks on a worker so that a rate limited bulk
+    requeue does not hold up the request that started it.  The since and
+    until times are ISO 8601 strings.
+    '''
+    tasks = select_tasks(rule_name, status,
+                         since and parse_datetime(since),
+                         until and parse_datetime(until))
+    task_names = tasks.values_list('name', flat=True)
+    if limit:
+        task_names = task_names[:limit]
+    return requeue_tasks(task_names, batch_size=batch_size, rate=rate,
+                         priority=priority, user_id=user_id)
+
+
+def add_task_dependencies(db_task: DBTask,
+                          depends_on_tasks: StringList = None,
+                          depends_on_rules: StringList = None):
+    '''
+    Declares that the task can not run until the tasks in
+    `depends_on_tasks` have completed and there are no queued or running
+    tasks left for the rules in `depends_on_rules`.
+    :param db_task: The dependent task.
+    :param depends_on_tasks: A list of task names.
+    :param depends_on_rules: A list of rule names.
+    :return: The list of TaskDependency instances created.
+    '''
+    tasks, rules = _resolve_dependencies(depends_on_tasks, depends_on_rules)
+    dependencies = [TaskDependency(task=db_task, depends_on_task=task)
+                    for task in tasks]
+    dependencies += [TaskDependency(task=db_task, depends_on_rule=rule)
+                     for rule in rules]
+    return TaskDependency.objects.bulk_create(dependencies)
+
+
+def _resolve_dependencies(depends_on_tasks: StringList,
+                          depends_on_rules: StringList):
+    '''
+    Looks up the prerequisite tasks and rules by name.
+    :return: A tuple of the task and rule model instances.
+    '''
+    task_names = set(depends_on_tasks or [])
+    rule_names = set(depends_on_rules or [])
+    tasks = list(DBTask.objects.filter(name__in=task_names))
+    rules = list(DBRule.objects.filter(name__in=rule_names))
+    missing = (task_names - {task.name for task in tasks}) | \
+              (rule_names - {rule.name for rule in rules})
+    if missing:
+        raise TaskDependencyError(
+            _('The following task or rule dependencies do not exist: %s'),
+            ', '.join(sorted(missing))
+        )
+    return tasks, rules
+
+
+def dependencies_satisfied(db_task: DBTask) -> bool:
+    '''
+    Returns True if all of the task's declared dependencies have completed.
+    :param db_task: The dependent task.
+    '''
+    pending_tasks = DBTask.objects.filter(
+        dependents__task=db_task
+    ).exclude(status__in=COMPLETED_STATUSES)
+    if pending_tasks.exists():
+        return False
+    return not DBTask.objects.filter(
+        rule__dependents__task=db_task,
+        status__in=OUTSTANDING_STATUSES
+    ).exclude(name=db_task.name).exists()
+
+
+def claim_waiting_task(db_task: DBTask) -> bool:
+    '''
+    Moves a WAITING task to QUEUED if its dependencies have been met.  The
+    status is changed with a conditional update so that, when several
+    prerequisites complete at once, only one caller wins the claim and
+    the task is only dispatched once.
+    :param db_task: The waiting task.
+    :return: True if the caller claimed the task and must dispatch it.
+    '''
+    if not dependencies_satisfied(db_task):
+        return False
+    claimed = DBTask.objects.filter(
+        name=db_task.name, status='WAITING'
+    ).update(status='QUEUED', status_changed=timezone.now(),
+             dispatched=None, lease_expires=None)
+    return claimed == 1
+
+
+def release_waiting_tasks(db_task: DBTask):
+    '''
+    The task completion hook.  Dispatches any WAITING tasks that depend
+    on the completed task (or its rule) and whose dependencies have now
+    all been met.  Never raises; the completed task's outcome should not
+    change because a dependent could not be released.
+    :param db_task: The task that just completed.
+    '''
+    try:
+        waiting_tasks = DBTask.objects.filter(status='WAITING').filter(
+            Q(dependencies__depends_on_task=db_task) |
+            Q(dependencies__depends_on_rule_id=db_task.rule_id)
+        ).distinct()
+        for waiting_task in waiting_tasks:
+            if claim_waiting_task(waiting_task):
+                logger.debug('Releasing waiting task %s.',
+                             waiting_task.name)
+                # the queuing user was recorded when the task was parked
+                dispatch_task(waiting_task.name)
+    except Exception:
+        logger.exception('Could not release the tasks waiting on %s.',
+                         db_task.name)
 
 
 def create_and_queue_task(data, rule_name: str,
@@ -111,7 +686,9 @@ def create_and_queue_task(data, rule_name: str,
                           initial_status='QUEUED',
                           task_parameters=[],
                           user_id: int = None,
-                          rule: Rule = None):
+                          rule: Rule = None,
+                          depends_on_tasks: StringList = None,
+                          depends_on_rules: StringList = None):
     '''
     Will queue an outbound task in the rule engine for processing using
     the rule specified by name in the rule_name parameter.
@@ -126,6 +703,15 @@ def create_and_queue_task(data, rule_name: str,
     :param run_immediately: If this is set to true, the task will be created
     and sent directly to the rule engine for processing thereby bypassing
     the Celery task queue.  When False, the task gets queued using Celery.
+    If the task can not run right away because its rule is at its
+    concurrency limit or it has outstanding dependencies, it is parked in
+    the WAITING state and TaskDeferred is raised.
+    :param depends_on_tasks: The names of tasks that must complete before
+    this task can run.
+    :param depends_on_rules: The names of rules that must have no queued or
+    running tasks before this task can run.  If any dependencies are
+    outstanding the task is saved with a WAITING status and is dispatched
+    once they complete.
     :return: The task instance.
     '''
     try:
@@ -134,18 +720,30 @@ def create_and_queue_task(data, rule_name: str,
             rule = DBRule.objects.get(name=rule_name)
         # if the rule exists, store the file using the configured
         # storage class
-        file_store = get_storage_class()
+        file_store = get_message_storage()
         task = DBTask()
         task.rule = rule
         task.type = task_type
+        if depends_on_tasks or depends_on_rules:
+            # fail before anything is stored if a prerequisite is missing
+            _resolve_dependencies(depends_on_tasks, depends_on_rules)
         task.save()
         # correlate the name of the file with the task
-        filename = '{0}.dat'.format(task.name)
-        if isinstance(data, str):
-            data = io.BytesIO(data.encode('utf-8'))
-        elif isinstance(data, bytes):
-            data = io.BytesIO(data)
-        task.location = file_store().save(name=filename, content=data)
+        filename = build_location(task.name)
+        # tasks that may have to wait need their message in storage first
+        inline = run_immediately and not (
+            depends_on_tasks or depends_on_rules or rule.max_concurrency)
+        if inline:
+            # the rule runs on the message in memory while it is stored
+            data = _read_message(data)
+            persisted = _get_persist_executor().submit(
+                file_store.save, name=filename, content=io.BytesIO(data))
+        else:
+            if isinstance(data, str):
+                data = io.BytesIO(data.encode('utf-8'))
+            elif isinstance(data, bytes):
+                data = io.BytesIO(data)
+            task.location = file_store.save(name=filename, content=data)
         task.status = initial_status
         try:
             task.save()
@@ -156,13 +754,50 @@ def create_and_queue_task(data, rule_name: str,
         for task_parameter in task_parameters:
             task_parameter.task = task
             task_parameter.save()
-        if run_immediately:
+        if depends_on_tasks or depends_on_rules:
+            add_task_dependencies(task, depends_on_tasks, depends_on_rules)
+            if user_id:
+                # recorded now since the task may be released later by
+                # another process; the history is written only once
+                TaskHistory.objects.create(task=task, user_id=user_id)
+                user_id = None
+            # park the task before checking so that a prerequisite
+            # completing in the meantime will release it
+            task.status = 'WAITING'
+            task.save()
+            if not claim_waiting_task(task):
+                if run_immediately:
+                    raise TaskDeferred(
+                        task, _('Task %s is waiting for its dependencies '
+                                'and will run once they complete.'),
+                        task.name)
+                return task
+            task.refresh_from_db()
+        if inline:
+            # execute in line on the in-memory message (skips celery and
+            # reading the message back from storage)
+            try:
+                run_task(task, data=data, user_id=user_id,
+                         raise_exception=True)
+            finally:
+                _finish_persist(task, persisted)
+        elif run_immediately:
             # execute in line (skips the rule engine and celery)
-            execute_queued_task(task_name=task.name, user_id=user_id,
-                                raise_exception=True)
+            if not execute_queued_task(task_name=task.name, user_id=user_id,
+                                       raise_exception=True):
+                task.refresh_from_db()
+                raise TaskDeferred(
+                    task, _('Rule %s is at its concurrency limit, task %s '
+                            'will run once a running task completes.'),
+                    rule.name, task.name)
         else:
             # queue up the task using celery
-            execute_queued_task.delay(task_name=task.name, user_id=user_id)
+            try:
+                dispatch_task(task.name, user_id=user_id)
+            except Exception:
+                # the message is stored, the sweeper will dispatch it
+                logger.exception('Could not dispatch task %s, the task '
+                                 'sweeper will retry.', task.name)
         return task
     except IntegrityError:
         logger.exception('There was an error creating and queuing the task.')
@@ -175,6 +810,41 @@ def create_and_queue_task(data, rule_name: str,
         )
 
 
+def _read_message(data) -> bytes:
+    '''
+    Returns the message passed to create_and_queue_task as bytes.
+    '''
+    if hasattr(data, 'read'):
+        data = data.read()
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    return data
+
+
+def _get_persist_executor() -> ThreadPoolExecutor:
+    global _persist_executor
+    if _persist_executor is None:
+        with _persist_executor_lock:
+            if _persist_executor is None:
+                _persist_executor = ThreadPoolExecutor(
+                    max_workers=PERSIST_THREADS,
+                    thread_name_prefix='quartet_capture_persist')
+    return _persist_executor
+
+
+def _finish_persist(task: DBTask, persisted):
+    '''
+    Waits for the message of an inline task to be stored and records where
+    it was stored.  Never raises, the task has already run.
+    '''
+    try:
+        task.location = persisted.result()
+        DBTask.objects.filter(name=task.name).update(location=task.location)
+    except Exception:
+        logger.exception('Could not store the message of task %s.',
+                         task.name)
+
+
 def get_rules_by_filter(filter_name: str, message: str,
                         return_all: bool = True) -> StringList:
     '''
@@ -194,6 +864,7 @@ def get_rules_by_filter(filter_name: str, message: str,
     if not isinstance(message, str):
         message = str(message.read())
 
+    start = time.perf_counter()
     filter = Filter.objects.prefetch_related('rulefilter_set').get(
         name=filter_name)
     ret = []
@@ -203,19 +874,11 @@ def get_rules_by_filter(filter_name: str, message: str,
             ret.append(rule_filter.rule.name)
         elif match_found and rule_filter.default:
             pass
-        elif rule_filter.search_type == 'search':
-            match = rule_filter.search_value in message \
-                    and not rule_filter.reverse
-            if match:
-                match_found = True
-                ret.append(rule_filter.rule.name)
-                if not return_all or rule_filter.break_on_true: break
-        elif rule_filter.search_type == 'regex':
-            match = re.search(rule_filter.search_value, message) and not rule_filter.reverse
-            if match:
-                match_found = True
-                ret.append(rule_filter.rule.name)
-                if not return_all or rule_filter.break_on_true: break
+        elif filter_matches(rule_filter, message):
+            match_found = True
+            ret.append(rule_filter.rule.name)
+            if not return_all or rule_filter.break_on_true: break
+    metrics.record_filter_routing(filter_name, time.perf_counter() - start)
     return ret
 
 
@@ -230,15 +893,25 @@ def get_rule_by_filter(filter_name: str, message: str) -> str:
         name=filter_name)
     ret = None
     for rule_filter in filter.rulefilter_set.all():
-        if rule_filter.search_type == 'search':
-            match = rule_filter.search_value in message \
-                    and not rule_filter.reverse
-            if match:
-                ret = rule_filter.rule.name
-                break
-        if rule_filter.search_type == 'regex':
-            match = re.search(rule_filter.search_value, message) and not rule_filter.reverse
-            if match:
-                ret = rule_filter.rule.name
-                break
+        if filter_matches(rule_filter, message):
+            ret = rule_filter.rule.name
+            break
     return ret
+
+
+def filter_matches(rule_filter: RuleFilter, message: str) -> bool:
+    '''
+    Returns True if the message matches the rule filter's search value.
+    :param rule_filter: The rule filter.
+    :param message: The message to search within.
+    '''
+    if rule_filter.search_type == 'search':
+        match = rule_filter.search_value in message
+    elif rule_filter.search_type == 'regex':
+        match = patterns.search(rule_filter.search_value, message,
+                                rule_filter)
+    elif rule_filter.search_type == 'path':
+        match = compile_path(rule_filter.search_value).search(message)
+    else:
+        match = False
+    return bool(match) and not rule_filter.reverse
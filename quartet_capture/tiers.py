@@ -0,0 +1,158 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+'''
+Moves the messages of completed tasks off the primary message storage to
+a cheaper archive tier.  The archive is a set of compressed pack files
+(segment files whose records are zlib compressed) under
+QUARTET_CAPTURE_ARCHIVE_ROOT, which can be a slower disk or a mounted
+object store.  Archived tasks have a location starting with `archive:`
+and are read back transparently by `read_task_data`.
+'''
+import os
+import time
+import zlib
+from datetime import timedelta
+from logging import getLogger
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from quartet_capture.locations import DeferredDeletes, get_location, \
+    get_message_storage
+from quartet_capture.models import Task as DBTask
+from quartet_capture.segments import SegmentStorage, read_record
+
+logger = getLogger('quartet_capture')
+
+ARCHIVE_PREFIX = 'archive:'
+# the directory of the archive packs
+ARCHIVE_ROOT = getattr(settings, 'QUARTET_CAPTURE_ARCHIVE_ROOT', None) or \
+               os.path.join(settings.MEDIA_ROOT or '', 'archive')
+# tasks in these states are archived...
+ARCHIVE_STATUSES = getattr(settings, 'QUARTET_CAPTURE_ARCHIVE_STATUSES',
+                           ['FINISHED'])
+# ...this many days after their status last changed, zero archives them
+# as soon as they complete
+ARCHIVE_AFTER_DAYS = getattr(settings, 'QUARTET_CAPTURE_ARCHIVE_AFTER_DAYS',
+                             7)
+ARCHIVE_COMPRESSION_LEVEL = getattr(
+    settings, 'QUARTET_CAPTURE_ARCHIVE_COMPRESSION_LEVEL', 6)
+
+
+class ArchiveStorage(SegmentStorage):
+    '''
+    Stores compressed messages in pack files under
+    QUARTET_CAPTURE_ARCHIVE_ROOT.
+    '''
+    directory = 'packs'
+    key_prefix = ARCHIVE_PREFIX
+
+    def __init__(self, location=None, **kwargs):
+        super().__init__(location=location or ARCHIVE_ROOT, **kwargs)
+
+    def save(self, name, content, max_length=None):
+        if hasattr(content, 'read'):
+            content = content.read()
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        return super().save(
+            name, zlib.compress(content, ARCHIVE_COMPRESSION_LEVEL))
+
+    def _open(self, name, mode='rb'):
+        return ContentFile(zlib.decompress(read_record(self, name)),
+                           name=name)
+
+    def size(self, name):
+        with self.open(name) as message_file:
+            return len(message_file.read())
+
+
+def is_archived(location: str) -> bool:
+    return location.startswith(ARCHIVE_PREFIX)
+
+
+def archive_tasks(days: float = None, statuses: list = None,
+                  batch_size: int = 500, limit: int = None, rate: float = 0,
+                  progress=None, grace: float = None) -> int:
+    '''
+    Moves the messages of completed tasks to the archive in batches.  Each
+    message is written to the archive and the task is pointed at it.  The
+    original is deleted once the grace period has passed, so a worker that
+    loaded the task before the move can still read it, and an interrupted
+    run can be started again.
+    :param days: Archive tasks whose status changed more than this many
+    days ago.  Defaults to the QUARTET_CAPTURE_ARCHIVE_AFTER_DAYS setting.
+    :param statuses: The statuses of the tasks to archive.  Defaults to the
+    QUARTET_CAPTURE_ARCHIVE_STATUSES setting.
+    :param batch_size: The number of tasks loaded per query.
+    :param limit: The maximum number of messages to archive.
+    :param rate: The maximum number of messages archived per second.  Zero
+    is unlimited.
+    :param progress: An optional callable that is passed the number of
+    messages archived so far.
+    :param grace: The number of seconds the originals are kept.  Defaults
+    to the QUARTET_CAPTURE_STORAGE_DELETE_GRACE setting.
+    :return: The number of messages archived.
+    '''
+    days = ARCHIVE_AFTER_DAYS if days is None else days
+    cutoff = timezone.now() - timedelta(days=days)
+    hot_storage = get_message_storage()
+    archive = ArchiveStorage()
+    deletes = DeferredDeletes(hot_storage.delete, grace)
+    tasks = DBTask.objects.filter(
+        status__in=statuses or ARCHIVE_STATUSES, status_changed__lte=cutoff
+    ).exclude(location__startswith=ARCHIVE_PREFIX).only(
+        'name', 'location').order_by('name')
+    archived = 0
+    start = time.time()
+    last_name = ''
+    while limit is None or archived < limit:
+        batch = list(tasks.filter(name__gt=last_name)[:batch_size])
+        if not batch:
+            break
+        last_name = batch[-1].name
+        for db_task in batch:
+            if limit is not None and archived >= limit:
+                break
+            if rate:
+                delay = start + archived / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            try:
+                old_location = _archive(hot_storage, archive, db_task)
+                if old_location:
+                    deletes.add(old_location)
+                    archived += 1
+            except Exception:
+                logger.exception('Could not archive the message of task %s.',
+                                 db_task.name)
+        if progress:
+            progress(archived)
+    deletes.run(wait=True)
+    return archived
+
+
+def _archive(hot_storage, archive: ArchiveStorage, db_task: DBTask) -> str:
+    '''
+    :return: The location the message was moved from, or None.
+    '''
+    old_location = get_location(db_task)
+    if not hot_storage.exists(old_location):
+        return None
+    with hot_storage.open(old_location) as message_file:
+        new_location = archive.save(db_task.name + '.dat', message_file)
+    updated = DBTask.objects.filter(
+        name=db_task.name, location=db_task.location
+    ).update(location=new_location)
+    return old_location if updated else None
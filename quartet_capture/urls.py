@@ -32,11 +32,17 @@ urlpatterns = [
         views.ExcuteTaskView.as_view(),
         name="execute-task",
     ),
+    re_path(
+        r"^execute-bulk/$",
+        views.BulkExecuteTaskView.as_view(),
+        name="execute-bulk",
+    ),
     re_path(
         r"^task-data/(?P<task_name>[a-zA-Z0-9\-]{1,50})/?$",
         views.GetTaskData.as_view(),
         name="task-data",
     ),
+    re_path(r"^metrics/?$", views.MetricsView.as_view(), name="metrics"),
     re_path(r"^clone-rule/$", views.CloneRuleView.as_view(), name="clone"),
     re_path(
         r"^clone-rule/(?P<rule_name>[0-9a-zA-Z\W\s]*)/(?P<new_rule_name>[0-9a-zA-Z\W\s]*)/$",
@@ -12,14 +12,14 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 # Copyright 2018 SerialLab Corp.  All rights reserved.
-import coreapi
-import coreschema
 import io
 import logging
 from django.conf import settings
 from django.core.files import storage
 from django.http.request import HttpRequest
+from django.http import Http404
 from django.http.response import HttpResponse
+from django.utils.dateparse import parse_datetime
 from django.utils.translation import gettext as _
 from drf_yasg.utils import swagger_auto_schema
 from rest_framework import exceptions
@@ -27,19 +27,81 @@ from rest_framework import status
 from rest_framework.parsers import MultiPartParser
 from rest_framework.request import Request
 from rest_framework.response import Response
-from rest_framework.schemas import ManualSchema
 from rest_framework.views import APIView
 
-from quartet_capture.errors import TaskExecutionError
+from quartet_capture import idempotency
+from quartet_capture.errors import TaskExecutionError, TaskDeferred
+from quartet_capture.locations import build_location, open_message, \
+    open_task_message
 from quartet_capture.models import Rule, Task, TaskParameter, Filter
 from quartet_capture.parsers import RawParser
-from quartet_capture.rules import clone_rule
-from quartet_capture.tasks import execute_queued_task, create_and_queue_task, \
-    get_rules_by_filter
-from rest_framework_xml.renderers import XMLRenderer
 
 logger = logging.getLogger('quartet_capture')
 
+# whether the web processes serve the Prometheus metrics at metrics/
+METRICS_VIEW = getattr(settings, 'QUARTET_CAPTURE_METRICS_VIEW', False)
+
+# The task and rule modules (and with them celery), the metrics and
+# admission control modules (and with them prometheus_client) along with
+# the schema and XML libraries are only imported once they are used so
+# that processes loading the URL configuration without serving captures
+# (management commands, system checks, celery workers) do not pay for
+# them.
+_LAZY_TASK_FUNCTIONS = ['execute_queued_task', 'create_and_queue_task',
+                        'get_rules_by_filter']
+
+
+def __getattr__(name):
+    '''
+    Resolves the names this module used to import at load time.
+    '''
+    if name in _LAZY_TASK_FUNCTIONS:
+        from quartet_capture import tasks
+        value = getattr(tasks, name)
+    elif name == 'TaskXMLRenderer':
+        value = _task_xml_renderer()
+    else:
+        raise AttributeError(
+            "module %r has no attribute %r" % (__name__, name))
+    globals()[name] = value
+    return value
+
+
+class LazySchema:
+    '''
+    Builds a view's schema inspector the first time it is accessed.
+    :param factory: A callable that returns the schema inspector.
+    '''
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.schema = None
+
+    def __get__(self, instance, owner):
+        if self.schema is None:
+            self.schema = self.factory()
+        return self.schema.__get__(instance, owner)
+
+
+def _clone_rule_schema():
+    import coreapi
+    import coreschema
+    from rest_framework.schemas import ManualSchema
+    return ManualSchema(fields=[
+        coreapi.Field(
+            "rule_name",
+            required=True,
+            location="path",
+            schema=coreschema.String()
+        ),
+        coreapi.Field(
+            "new_rule_name",
+            required=True,
+            location="path",
+            schema=coreschema.String()
+        ),
+    ])
+
 # Set RETURN_ALL_RULES in your settings to overide the default behavior of
 # the capture filters.  Setting to false will make the default behavior
 # to return the first matched filter.
@@ -60,6 +122,7 @@ class ExcuteTaskView(APIView):
     queryset = Task.objects.none()
 
     def get(self, request: Request, task_name: str = None, format=None):
+        from quartet_capture.tasks import execute_queued_task, dispatch_task
         if task_name:
             run = request.query_params.get('run-immediately', False)
             user_id = None
@@ -73,8 +136,7 @@ class ExcuteTaskView(APIView):
                     if task.status == 'FAILED':
                         raise TaskExecutionError()
                 else:
-                    execute_queued_task.delay(task_name=task_name,
-                                              user_id=user_id)
+                    dispatch_task(task_name, user_id=user_id)
                 ret = Response(
                     _('Task %s has been re-queued for execution.') % task_name)
             except TaskExecutionError:
@@ -96,6 +158,80 @@ class ExcuteTaskView(APIView):
         return ret
 
 
+class BulkExecuteTaskView(APIView):
+    """
+    Will re-queue every task matching a query for execution.  This is
+    useful for recovering the tasks that failed during an outage of a
+    downstream system.  The tasks are selected and sent to Celery in
+    batches by a background task and the number of matching tasks is
+    returned.
+
+    Usage:
+
+        POST http[s]://[host]:[port]/capture/execute-bulk/
+
+    The following values can be posted as JSON or form data:
+
+    * rule - only requeue tasks of this rule.
+    * status - only requeue tasks with this status, defaults to FAILED.
+    * since / until - only requeue tasks whose status changed in this
+      ISO 8601 time window.
+    * limit - the maximum number of tasks to requeue.
+    * batch-size - the number of tasks sent to Celery per group.
+    * rate - the maximum number of tasks requeued per second.
+    * priority - the Celery message priority of the requeued tasks.
+    """
+    queryset = Task.objects.none()
+
+    def post(self, request: Request, format=None):
+        from quartet_capture.backends import get_backend
+        from quartet_capture.tasks import requeue_tasks_task, select_tasks
+        try:
+            criteria = {
+                'rule_name': request.data.get('rule'),
+                'status': request.data.get('status', 'FAILED'),
+                'since': self._get_time(request, 'since'),
+                'until': self._get_time(request, 'until'),
+            }
+            options = {
+                'limit': self._get_number(request, 'limit', int),
+                'batch_size': self._get_number(request, 'batch-size', int),
+                'rate': self._get_number(request, 'rate', float) or 0,
+                'priority': self._get_number(request, 'priority', int),
+            }
+        except ValueError as e:
+            raise exceptions.ValidationError(str(e))
+        count = select_tasks(
+            criteria['rule_name'], criteria['status'],
+            criteria['since'] and parse_datetime(criteria['since']),
+            criteria['until'] and parse_datetime(criteria['until'])
+        ).count()
+        if options['limit']:
+            count = min(count, options['limit'])
+        if count:
+            get_backend().run_in_background(
+                requeue_tasks_task,
+                user_id=request.user.id if request.user else None,
+                **criteria, **options)
+        return Response({'count': count}, status=status.HTTP_202_ACCEPTED)
+
+    def _get_time(self, request: Request, name: str):
+        value = request.data.get(name)
+        if value and not parse_datetime(value):
+            raise ValueError(
+                _('%s is not a valid ISO 8601 date/time.') % name)
+        return value
+
+    def _get_number(self, request: Request, name: str, number_type):
+        value = request.data.get(name)
+        if value in [None, '']:
+            return None
+        try:
+            return number_type(value)
+        except (TypeError, ValueError):
+            raise ValueError(_('%s must be a number.') % name)
+
+
 class CloneRuleView(APIView):
     """
     Will clone a rule instance.  The clone will contain copies of the
@@ -107,22 +243,10 @@ class CloneRuleView(APIView):
     """
     queryset = Rule.objects.none()
 
-    schema = ManualSchema(fields=[
-        coreapi.Field(
-            "rule_name",
-            required=True,
-            location="path",
-            schema=coreschema.String()
-        ),
-        coreapi.Field(
-            "new_rule_name",
-            required=True,
-            location="path",
-            schema=coreschema.String()
-        ),
-    ])
+    schema = LazySchema(_clone_rule_schema)
 
     def post(self, request, rule_name=None, new_rule_name=None):
+        from quartet_capture.rules import clone_rule
         if rule_name:
             try:
                 new_rule = clone_rule(rule_name, new_rule_name=new_rule_name)
@@ -142,6 +266,44 @@ class CloneRuleView(APIView):
         return ret
 
 
+class MetricsView(APIView):
+    '''
+    Returns the capture and rule execution metrics in the Prometheus text
+    format.  The metrics are kept in memory, so a scrape does not query the
+    database.  The view is disabled unless QUARTET_CAPTURE_METRICS_VIEW is
+    set and is authenticated like the other API views.  Returns a 404 if it
+    is disabled or prometheus_client is not installed.
+    '''
+    # sentry queryset for permissions
+    queryset = Task.objects.none()
+    swagger_schema = None
+
+    def get(self, request: Request, format=None):
+        from quartet_capture import metrics
+        if not METRICS_VIEW:
+            raise Http404('The metrics view is disabled.')
+        if not metrics.prometheus_client:
+            raise Http404('prometheus_client is not installed.')
+        content_type = metrics.prometheus_client.CONTENT_TYPE_LATEST
+        return HttpResponse(metrics.generate_latest(),
+                            content_type=content_type)
+
+
+class CaptureQueueFull(exceptions.APIException):
+    '''
+    Returned, as a 503 with a Retry-After header, when the task queue of a
+    rule is over the capture admission limits.
+    '''
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+
+    def __init__(self, rule_name: str, wait: int):
+        super().__init__(
+            _('Rule %s has too many queued messages, please try again '
+              'later.') % rule_name)
+        # the exception handler sends this as the Retry-After header
+        self.wait = wait
+
+
 class CaptureInterface(APIView):
     '''
     The view responsible for capturing the files and handing
@@ -171,6 +333,7 @@ class CaptureInterface(APIView):
                           500: 'Internal server error descriptions.'}
                          )
     def post(self, request: Request, format=None, epcis=False):
+        from quartet_capture.tasks import get_rules_by_filter
         logger.info('Message from %s', getattr(request.META, 'REMOTE_HOST',
                                                'Host Info not Available'))
         # get the message from the request
@@ -234,44 +397,105 @@ class CaptureInterface(APIView):
                 )
                 exc.status_code = status.HTTP_400_BAD_REQUEST
                 raise exc
-            # execute the rule as a task in celery
-            for rule_name in rules:
-                logger.debug('Executing rule %s', rule_name)
-                if not self._rule_exists(rule_name):
-                    exc = exceptions.APIException(
-                        'The rule with name %s, does '
-                        'not exist in the system.' %
-                        rule_name
-                    )
-                    exc.status_code = status.HTTP_400_BAD_REQUEST
-                    raise exc
-                storage_class = storage.get_storage_class()
-                django_storage = storage_class()
-                # create a task and get the task name to return to the
-                # calling application
-                user_id = self._get_user_id(request)
+            key = idempotency.get_key(request, message,
+                                      'epcis' if epcis else '')
+            if key:
                 try:
-                    task = create_and_queue_task(
-                        message,
-                        rule_name,
-                        run_immediately=run,
-                        task_parameters=self._get_task_parameters(request),
-                        user_id=user_id
-                    )
-                except Exception as err:
-                    args = [str(arg) for arg in err.args]
+                    original_task = idempotency.claim(key)
+                except idempotency.KeyInUse:
                     exc = exceptions.APIException(
-                        'Error in rule %s: %s' % (
-                            rule_name, args)
+                        'A request with the same idempotency key is still '
+                        'being processed.'
                     )
-                    exc.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+                    exc.status_code = status.HTTP_409_CONFLICT
                     raise exc
-                return self._determine_return_status(request, task)
-            raise exceptions.APIException('No task was created.  This is most '
-                                          'likely due to a filter with no '
-                                          'rules assigned.',
-                                          status.HTTP_500_INTERNAL_SERVER_ERROR
-                                          )
+                if original_task:
+                    return self._determine_return_status(request,
+                                                         original_task)
+            try:
+                ret = self._create_tasks(request, message, rules, run)
+            except Exception:
+                if key:
+                    idempotency.release(key)
+                raise
+            if key:
+                idempotency.complete(key, ret.task)
+            return ret
+
+    def _create_tasks(self, request: Request, message, rules: list,
+                      run: bool) -> Response:
+        '''
+        Creates and queues a task for the message.
+        :return: The response with the created task as its `task`
+        attribute.
+        '''
+        from quartet_capture import metrics
+        from quartet_capture.admission import check_admission
+        from quartet_capture.tasks import create_and_queue_task
+        # execute the rule as a task in celery
+        for rule_name in rules:
+            logger.debug('Executing rule %s', rule_name)
+            rule = self._rule_exists(rule_name)
+            if not rule:
+                exc = exceptions.APIException(
+                    'The rule with name %s, does '
+                    'not exist in the system.' %
+                    rule_name
+                )
+                exc.status_code = status.HTTP_400_BAD_REQUEST
+                raise exc
+            if not run:
+                # turn the message away if the workers are too far behind
+                retry_after = check_admission(rule)
+                if retry_after:
+                    raise CaptureQueueFull(rule_name, retry_after)
+            # create a task and get the task name to return to the
+            # calling application
+            user_id = self._get_user_id(request)
+            try:
+                task = create_and_queue_task(
+                    message,
+                    rule_name,
+                    run_immediately=run,
+                    task_parameters=self._get_task_parameters(request),
+                    user_id=user_id
+                )
+            except TaskDeferred as err:
+                # accepted but not run, the task runs once it is released
+                logger.info(str(err))
+                ret = Response(err.task.name, status=status.HTTP_202_ACCEPTED)
+                ret.task = err.task
+                return ret
+            except Exception as err:
+                args = [str(arg) for arg in err.args]
+                exc = exceptions.APIException(
+                    'Error in rule %s: %s' % (
+                        rule_name, args)
+                )
+                exc.status_code = status.HTTP_500_INTERNAL_SERVER_ERROR
+                raise exc
+            metrics.record_capture(rule_name, self._get_size(message))
+            ret = self._determine_return_status(request, task)
+            ret.task = task
+            return ret
+        raise exceptions.APIException('No task was created.  This is most '
+                                      'likely due to a filter with no '
+                                      'rules assigned.',
+                                      status.HTTP_500_INTERNAL_SERVER_ERROR
+                                      )
+
+    def _get_size(self, message) -> int:
+        '''
+        Returns the size of the captured message in bytes.
+        '''
+        size = getattr(message, 'size', None)
+        if size is None:
+            try:
+                size = len(message.encode('utf-8') if isinstance(
+                    message, str) else message)
+            except TypeError:
+                size = 0
+        return size
 
     def _determine_return_status(self, request: Request, task: Task) -> Response:
         """
@@ -343,7 +567,8 @@ class CaptureInterface(APIView):
         '''
         task = Task()
         task.rule = rule
-        filename = '{0}.dat'.format(task.name)
+        task.name = task.haikunate()
+        filename = build_location(task.name)
         if isinstance(message, str):
             message = io.StringIO(message)
         task.location = file_store.save(name=filename, content=message)
@@ -374,10 +599,16 @@ class CaptureInterface(APIView):
         return ret
 
 
-class TaskXMLRenderer(XMLRenderer):
+def _task_xml_renderer():
+    from rest_framework_xml.renderers import XMLRenderer
+
+    class TaskXMLRenderer(XMLRenderer):
+
+        def render(self, data, accepted_media_type=None,
+                   renderer_context=None):
+            return data
 
-    def render(self, data, accepted_media_type=None, renderer_context=None):
-        return data
+    return TaskXMLRenderer
 
 
 class GetTaskData(APIView):
@@ -387,10 +618,11 @@ class GetTaskData(APIView):
     queryset = Task.objects.none()
 
     def get(self, request: Request, task_name: str = None, format=None):
-        storage_class = storage.get_storage_class()
-        django_storage = storage_class()
         file_name = '{0}.dat'.format(task_name)
-        message_file = django_storage.open(file_name)
+        task = Task.objects.filter(name=task_name).only(
+            'name', 'location').first()
+        message_file = open_task_message(task) if task else \
+            open_message(file_name)
         data = message_file.read()
         response = HttpResponse(data, content_type='application/text')
         response['Content-Disposition'] = 'attachment; filename=%s' % file_name
@@ -18,12 +18,22 @@ The url routes are established in the routers module and appended
 to the urlparams in urls.py.
 '''
 
+from django.conf import settings
 from django.shortcuts import get_object_or_404
 from rest_framework.response import Response
 from rest_framework import viewsets
+from rest_framework.settings import api_settings
 from django.db.models import Q
 from quartet_capture import serializers
 from quartet_capture import models
+from quartet_capture import pagination
+
+# Set QUARTET_CAPTURE_CURSOR_PAGINATION to True in your settings to use
+# keyset (cursor) pagination for the task endpoints instead of the
+# project's default pagination class.  It changes the shape of the
+# responses so it is opt-in.
+CURSOR_PAGINATION = getattr(settings, 'QUARTET_CAPTURE_CURSOR_PAGINATION',
+                            False)
 
 class RuleViewSet(viewsets.ModelViewSet):
     queryset = models.Rule.objects.prefetch_related(
@@ -90,16 +100,24 @@ class StepParameterViewSet(viewsets.ModelViewSet):
 
 
 class TaskViewset(viewsets.ModelViewSet):
-    queryset = models.Task.objects.all()
+    queryset = models.Task.objects.select_related('rule').prefetch_related(
+        'taskmessage_set',
+        'taskhistory_set__user',
+        'rule__step_set__stepparameter_set',
+    ).all()
     serializer_class = serializers.TaskSerializer
     search_fields = ['name', 'status', 'status_changed', 'rule__name']
+    pagination_class = pagination.TaskCursorPagination \
+        if CURSOR_PAGINATION else api_settings.DEFAULT_PAGINATION_CLASS
 
 class TaskHistoryViewSet(viewsets.ReadOnlyModelViewSet):
     '''
     CRUD ready model view for the TaskHistory model.
     '''
-    queryset = models.TaskHistory.objects.all()
+    queryset = models.TaskHistory.objects.select_related('user').all()
     serializer_class = serializers.TaskHistorySerializer
+    pagination_class = pagination.TaskHistoryCursorPagination \
+        if CURSOR_PAGINATION else api_settings.DEFAULT_PAGINATION_CLASS
 
 class FilterViewSet(viewsets.ModelViewSet):
     '''
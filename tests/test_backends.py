@@ -0,0 +1,101 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import os
+import django
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
+django.setup()
+import threading
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.utils import timezone
+from quartet_capture import models
+from quartet_capture.backends import DatabaseBackend, claim_tasks, \
+    release_tasks, run_worker
+from quartet_capture.tasks import create_and_queue_task, run_task
+
+
+@mock.patch('quartet_capture.tasks.get_backend', return_value=DatabaseBackend())
+class DatabaseBackendTest(TestCase):
+    '''
+    Tests executing tasks from the database queue.
+    '''
+
+    def test_run_worker(self, get_backend):
+        self._create_rule()
+        user = get_user_model().objects.create(username='worker')
+        tasks = [create_and_queue_task('<data/>', 'queued', user_id=user.id)
+                 for i in range(3)]
+        self.assertEqual(
+            models.Task.objects.filter(status='QUEUED',
+                                       dispatched__isnull=False).count(), 3)
+        self.assertEqual(run_worker(threading.Event(), batch_size=2,
+                                    exit_when_idle=True), 3)
+        for task in tasks:
+            task.refresh_from_db()
+            self.assertEqual(task.status, 'FINISHED')
+            self.assertIsNone(task.lease_expires)
+        self.assertEqual(models.TaskHistory.objects.count(), 3)
+
+    def test_claim_tasks(self, get_backend):
+        self._create_rule()
+        for i in range(3):
+            create_and_queue_task('<data/>', 'queued')
+        claimed = claim_tasks(batch_size=2)
+        self.assertEqual(len(claimed), 2)
+        # the claimed tasks stay queued until they start
+        self.assertEqual(claimed[0].status, 'QUEUED')
+        self.assertEqual(claimed[0].rule.name, 'queued')
+        self.assertEqual(
+            models.Task.objects.filter(status='RUNNING').count(), 0)
+        self.assertEqual(len(claim_tasks(batch_size=2)), 1)
+        self.assertEqual(claim_tasks(), [])
+        # tasks claimed by a stopping worker go back on the queue
+        release_tasks(claimed)
+        self.assertEqual(len(claim_tasks()), 2)
+
+    def test_claimed_batch_concurrency(self, get_backend):
+        db_rule = self._create_rule()
+        db_rule.max_concurrency = 1
+        db_rule.save()
+        for i in range(3):
+            create_and_queue_task('<data/>', 'queued')
+        self.assertEqual(run_worker(threading.Event(), batch_size=3,
+                                    exit_when_idle=True), 3)
+        # the unstarted tasks of the batch did not hold the only slot
+        self.assertEqual(
+            models.Task.objects.filter(status='FINISHED').count(), 3)
+
+    def test_expired_claim(self, get_backend):
+        self._create_rule()
+        create_and_queue_task('<data/>', 'queued')
+        stale = claim_tasks()[0]
+        # the claim expired and another worker claimed and ran the task
+        models.Task.objects.update(lease_expires=timezone.now())
+        other = claim_tasks()[0]
+        self.assertTrue(run_task(other, claimed=True))
+        self.assertFalse(run_task(stale, claimed=True))
+        self.assertEqual(models.TaskHistory.objects.count(), 0)
+        other.refresh_from_db()
+        self.assertEqual(other.status, 'FINISHED')
+
+    def _create_rule(self):
+        db_rule = models.Rule.objects.create(name='queued',
+                                             description='unit test rule')
+        models.Step.objects.create(
+            rule=db_rule, name='context', order=1,
+            step_class='tests.test_models.ContextStep')
+        return db_rule
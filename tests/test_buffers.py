@@ -0,0 +1,107 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import os
+import django
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
+django.setup()
+from django.test import TestCase
+from quartet_capture import models, rules
+from quartet_capture.buffers import DataBuffer
+
+
+class UpperCaseStep(rules.Step):
+    '''
+    Writes the upper cased data to a buffer in small chunks.
+    '''
+    buffers = []
+
+    def execute(self, data, rule_context: rules.RuleContext):
+        buffer = rule_context.create_buffer()
+        buffer.threshold = 8
+        for i in range(0, len(data), 4):
+            buffer.write(data[i:i + 4].upper())
+        buffer.seek(0)
+        self.buffers.append(buffer)
+        return buffer
+
+    @property
+    def declared_parameters(self):
+        return {}
+
+    def on_failure(self):
+        pass
+
+
+class ReadBufferStep(UpperCaseStep):
+    '''
+    Records what it was handed by the previous step.
+    '''
+
+    def execute(self, data, rule_context: rules.RuleContext):
+        rule_context.context['spilled'] = data.spilled
+        rule_context.context['data'] = bytes(data.getbuffer())
+        return rule_context.context['data']
+
+
+class DataBufferTest(TestCase):
+    '''
+    Tests the intermediate data buffers.
+    '''
+
+    def test_spill(self):
+        buffer = DataBuffer(b'abc', threshold=4)
+        self.assertFalse(buffer.spilled)
+        buffer.seek(0, 2)
+        buffer.write(b'defg')
+        self.assertTrue(buffer.spilled)
+        self.assertEqual(buffer.size, 7)
+        self.assertEqual(bytes(buffer.getbuffer()), b'abcdefg')
+        self.assertEqual(buffer.getvalue(), b'abcdefg')
+        buffer.seek(2)
+        self.assertEqual(buffer.read(2), b'cd')
+        buffer.close()
+        self.assertTrue(buffer.closed)
+
+    def test_rule_buffers(self):
+        db_rule = models.Rule.objects.create(name='buffers',
+                                             description='unit test rule')
+        for order, step_class in enumerate(['UpperCaseStep',
+                                            'ReadBufferStep'], start=1):
+            models.Step.objects.create(
+                rule=db_rule, name=step_class, order=order,
+                step_class='tests.test_buffers.%s' % step_class)
+        db_task = models.Task.objects.create(name='buffers', rule=db_rule,
+                                             status='RUNNING')
+        rule = rules.Rule(db_rule, db_task)
+        rule.execute(b'spill to disk')
+        self.assertTrue(rule.context.context['spilled'])
+        self.assertEqual(rule.context.context['data'], b'SPILL TO DISK')
+        # the buffer is closed once the rule completes
+        self.assertTrue(UpperCaseStep.buffers[-1].closed)
+
+    def test_final_buffer(self):
+        db_rule = models.Rule.objects.create(name='buffers',
+                                             description='unit test rule')
+        models.Step.objects.create(
+            rule=db_rule, name='upper', order=1,
+            step_class='tests.test_buffers.UpperCaseStep')
+        db_task = models.Task.objects.create(name='buffers', rule=db_rule,
+                                             status='RUNNING')
+        rule = rules.Rule(db_rule, db_task)
+        rule.execute(b'final data')
+        # the rule's result is left open for the caller
+        with rule.data as buffer:
+            self.assertEqual(buffer.read(), b'FINAL DATA')
@@ -0,0 +1,113 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import os
+import django
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
+django.setup()
+from django.test import TestCase
+from quartet_capture import models
+from quartet_capture.bundles import export_rules, import_rules
+from quartet_capture.errors import RuleBundleError
+from quartet_capture.rules import clone_rule
+
+
+class RuleBundleTest(TestCase):
+    '''
+    Tests the export, import and cloning of rules.
+    '''
+
+    def test_round_trip(self):
+        self._create_rule()
+        bundle = export_rules(['bundle'])
+        bundle['rules'][0]['name'] = 'imported'
+        rule = import_rules(bundle)[0]
+        self.assertEqual(rule.name, 'imported')
+        self.assertEqual(rule.max_concurrency, 2)
+        self.assertEqual(rule.ruleparameter_set.get().value, 'rule value')
+        steps = list(rule.step_set.all())
+        self.assertEqual([step.name for step in steps], ['first', 'second'])
+        self.assertEqual(steps[1].stage, 1)
+        self.assertEqual(steps[1].stepparameter_set.get().value,
+                         'step value')
+
+    def test_idempotent_import(self):
+        db_rule = self._create_rule()
+        bundle = export_rules()
+        bundle['rules'][0]['steps'].pop()
+        import_rules(bundle)
+        step_ids = list(models.Step.objects.values_list('id', flat=True))
+        with self.assertNumQueries(9):
+            rule = import_rules(bundle)[0]
+        self.assertEqual(rule.pk, db_rule.pk)
+        # the steps are updated in place rather than recreated
+        self.assertEqual(
+            list(models.Step.objects.values_list('id', flat=True)), step_ids)
+        self.assertEqual(models.Rule.objects.count(), 1)
+        self.assertEqual(models.Step.objects.count(), 1)
+        self.assertEqual(models.StepParameter.objects.count(), 0)
+        with self.assertRaises(RuleBundleError):
+            import_rules(bundle, replace=False)
+
+    def test_update_import(self):
+        self._create_rule()
+        step_ids = dict(models.Step.objects.values_list('name', 'id'))
+        bundle = export_rules()
+        steps = bundle['rules'][0]['steps']
+        steps[1]['step_class'] = 'tests.test_models.AsyncContextStep'
+        steps[1]['parameters'] = [['step param', 'new value', None]]
+        steps.append({'name': 'third', 'step_class': steps[0]['step_class'],
+                      'order': 3})
+        bundle['rules'][0]['parameters'] = []
+        rule = import_rules(bundle)[0]
+        second = rule.step_set.get(name='second')
+        self.assertEqual(second.id, step_ids['second'])
+        self.assertEqual(second.step_class,
+                         'tests.test_models.AsyncContextStep')
+        self.assertEqual(second.stepparameter_set.get().value, 'new value')
+        self.assertEqual(rule.step_set.count(), 3)
+        self.assertFalse(rule.ruleparameter_set.exists())
+
+    def test_invalid_bundle(self):
+        with self.assertRaises(RuleBundleError):
+            import_rules({'version': 99, 'rules': []})
+        with self.assertRaises(RuleBundleError):
+            import_rules({'version': 1, 'rules': [{'name': 'a'},
+                                                  {'name': 'a'}]})
+
+    def test_clone_names(self):
+        self._create_rule()
+        self.assertEqual(clone_rule('bundle', None).name, 'bundle_copy_1')
+        self.assertEqual(clone_rule('bundle', 'other').name, 'other')
+        self.assertEqual(clone_rule('bundle', 'other').name, 'bundle_copy_2')
+        clone = models.Rule.objects.get(name='bundle_copy_2')
+        self.assertEqual(clone.step_set.count(), 2)
+        self.assertEqual(
+            models.StepParameter.objects.filter(step__rule=clone).count(), 1)
+
+    def _create_rule(self):
+        db_rule = models.Rule.objects.create(name='bundle',
+                                             description='unit test rule',
+                                             max_concurrency=2)
+        models.RuleParameter.objects.create(rule=db_rule, name='rule param',
+                                            value='rule value')
+        models.Step.objects.create(rule=db_rule, name='first', order=1,
+                                   step_class='tests.test_models.ContextStep')
+        step = models.Step.objects.create(
+            rule=db_rule, name='second', order=2, stage=1,
+            step_class='tests.test_models.ContextStep')
+        models.StepParameter.objects.create(step=step, name='step param',
+                                            value='step value')
+        return db_rule
@@ -0,0 +1,140 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import os
+import django
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
+django.setup()
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+from django.core.management import call_command, CommandError
+from django.test import TestCase
+from django.utils import timezone
+from quartet_capture import models
+from quartet_capture.tasks import create_and_queue_task
+from tests.test_models import ContextStep
+
+
+class DuplicateRuleStep(ContextStep):
+    '''
+    Fails with a database error.
+    '''
+
+    def execute(self, data, rule_context):
+        models.Rule.objects.create(name='replay')
+
+
+@mock.patch('quartet_capture.tasks.dispatch_task')
+class ReplayTasksTest(TestCase):
+    '''
+    Tests the replay_tasks management command.
+    '''
+
+    def test_dry_run(self, dispatch_task):
+        self._create_rule()
+        create_and_queue_task('<data/>', 'replay')
+        output = self._replay('--dry-run')
+        self.assertIn('Replayed 1 tasks', output)
+        self.assertIn('0 failed', output)
+        self.assertIn('parse:', output)
+        self.assertFalse(models.Task.objects.filter(type='Replay').exists())
+
+    def test_dry_run_other_threads(self, dispatch_task):
+        db_rule = self._create_rule()
+        create_and_queue_task('<data/>', 'replay')
+        with self.assertRaises(CommandError):
+            self._replay('--dry-run', '--concurrency', '2')
+        db_rule.step_set.update(stage=1)
+        with self.assertRaises(CommandError):
+            self._replay('--dry-run')
+        self.assertFalse(models.Task.objects.filter(type='Replay').exists())
+
+    def test_dry_run_database_error(self, dispatch_task):
+        db_rule = self._create_rule()
+        create_and_queue_task('<data/>', 'replay')
+        db_rule.step_set.filter(name='parse').update(
+            step_class='tests.test_commands.DuplicateRuleStep')
+        output = self._replay('--dry-run')
+        self.assertIn('Replayed 1 tasks', output)
+        self.assertIn('1 failed', output)
+
+    def test_replay(self, dispatch_task):
+        self._create_rule()
+        create_and_queue_task('<data/>', 'replay')
+        self._replay()
+        replay = models.Task.objects.get(type='Replay')
+        self.assertEqual(replay.status, 'FINISHED')
+        # replay tasks are not replayed again
+        self.assertIn('Replayed 1 tasks', self._replay())
+
+    def _replay(self, *args):
+        out = StringIO()
+        call_command('replay_tasks', '--rule', 'replay', '--stub', 'send',
+                     *args, stdout=out)
+        return out.getvalue()
+
+    def _create_rule(self):
+        db_rule = models.Rule.objects.create(name='replay',
+                                             description='unit test rule')
+        for order, name in enumerate(['parse', 'send'], start=1):
+            models.Step.objects.create(
+                rule=db_rule, name=name, order=order,
+                step_class='tests.test_models.ContextStep')
+        # the send step would fail if it were not stubbed
+        models.StepParameter.objects.create(
+            step=db_rule.step_set.get(name='send'), name='fail',
+            value='true')
+        return db_rule
+
+
+@mock.patch('quartet_capture.tasks.dispatch_batch')
+class RequeueTasksTest(TestCase):
+    '''
+    Tests the requeue_tasks management command.
+    '''
+
+    def test_requeue(self, dispatch_batch):
+        rule = models.Rule.objects.create(name='requeue',
+                                          description='unit test rule')
+        for i, task_status in enumerate(['FAILED', 'FAILED', 'FINISHED']):
+            models.Task.objects.create(name='task-%s' % i, rule=rule,
+                                       status=task_status)
+        out = StringIO()
+        call_command('requeue_tasks', '--rule', 'requeue', '--batch-size',
+                     '1', stdout=out)
+        self.assertIn('2 of 2 tasks requeued', out.getvalue())
+        self.assertEqual(dispatch_batch.call_count, 2)
+        self.assertEqual(
+            models.Task.objects.filter(status='QUEUED').count(), 2)
+
+
+@mock.patch('quartet_capture.tasks.dispatch_batch')
+class SweepTasksTest(TestCase):
+    '''
+    Tests the sweep_tasks management command.
+    '''
+
+    def test_sweep(self, dispatch_batch):
+        rule = models.Rule.objects.create(name='sweep',
+                                          description='unit test rule')
+        models.Task.objects.create(name='orphaned', rule=rule,
+                                   status='QUEUED')
+        models.Task.objects.filter(name='orphaned').update(
+            status_changed=timezone.now() - timedelta(hours=1))
+        out = StringIO()
+        call_command('sweep_tasks', '--rate', '0', stdout=out)
+        self.assertIn('Recovered 1 tasks', out.getvalue())
+        self.assertEqual(dispatch_batch.call_args[0][0], ['orphaned'])
@@ -0,0 +1,68 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import os
+import subprocess
+import sys
+from unittest import TestCase
+
+# The budget (in milliseconds) for importing the quartet_capture URL
+# configuration once Django and the Django Rest Framework are loaded.
+# Override with the QUARTET_CAPTURE_IMPORT_BUDGET_MS environment variable
+# on slow build machines.
+IMPORT_BUDGET_MS = int(os.environ.get('QUARTET_CAPTURE_IMPORT_BUDGET_MS',
+                                      100))
+
+# These are only needed once a message is captured or queued.
+LAZY_MODULES = ['celery', 'rest_framework_xml', 'quartet_capture.tasks',
+                'quartet_capture.rules', 'quartet_capture.metrics',
+                'quartet_capture.admission', 'prometheus_client']
+
+SCRIPT = '''
+import django
+django.setup()
+import rest_framework.views, rest_framework.viewsets
+import rest_framework.serializers, rest_framework.pagination
+import drf_yasg.utils
+import quartet_capture.urls
+'''
+
+
+class ImportTimeTest(TestCase):
+    '''
+    Guards against heavy modules creeping back into the import graph of
+    the URL configuration, which every management command and Celery
+    worker loads during the Django system checks.
+    '''
+
+    def test_import_time(self):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='tests.settings')
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', SCRIPT],
+            cwd=os.path.dirname(os.path.dirname(__file__)),
+            env=env, stderr=subprocess.PIPE, universal_newlines=True,
+            check=True
+        )
+        cumulative = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            self_time, total, module = line[12:].split('|')
+            cumulative[module.strip()] = int(total)
+        for module in LAZY_MODULES:
+            self.assertNotIn(module, cumulative,
+                             '%s was imported at load time.' % module)
+        elapsed = cumulative['quartet_capture.urls'] / 1000
+        self.assertLess(elapsed, IMPORT_BUDGET_MS,
+                        'Importing quartet_capture took %sms.' % elapsed)
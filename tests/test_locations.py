@@ -0,0 +1,104 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import os
+import time
+import django
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
+django.setup()
+from datetime import datetime
+from io import BytesIO
+from unittest import mock
+from django.core.files.storage import default_storage
+from django.test import TestCase
+from quartet_capture import models
+from quartet_capture.locations import build_location, \
+    get_message_storage, reshard_tasks
+from quartet_capture.tasks import create_and_queue_task, read_task_data
+
+
+@mock.patch('quartet_capture.tasks.dispatch_task')
+class LocationsTest(TestCase):
+    '''
+    Tests the storage layouts of task messages.
+    '''
+
+    def test_build_location(self, dispatch_task):
+        date = datetime(2018, 6, 1)
+        self.assertEqual(build_location('task', date, 'flat'), 'task.dat')
+        self.assertEqual(build_location('task', date, 'date'),
+                         '2018/06/01/task.dat')
+        # md5('task') starts with 478f
+        self.assertEqual(build_location('task', date, 'hash'),
+                         '47/8f/task.dat')
+        self.assertEqual(build_location('task', date, 'date-hash'),
+                         '2018/06/01/47/8f/task.dat')
+        self.assertEqual(build_location('task', date, 'in/{year}/{name}'),
+                         'in/2018/task')
+
+    @mock.patch('quartet_capture.locations.STORAGE_LAYOUT', 'hash')
+    def test_sharded_task(self, dispatch_task):
+        self._create_rule()
+        task = create_and_queue_task('<data/>', 'sharded')
+        task.refresh_from_db()
+        self.assertEqual(task.location, build_location(task.name))
+        self.assertEqual(read_task_data(task), b'<data/>')
+        default_storage.delete(task.location)
+
+    def test_reshard(self, dispatch_task):
+        rule = self._create_rule()
+        # a task stored before locations were recorded
+        task = models.Task.objects.create(rule=rule)
+        default_storage.save('%s.dat' % task.name, BytesIO(b'<data/>'))
+        self.assertEqual(reshard_tasks(layout='hash', grace=0), 1)
+        task.refresh_from_db()
+        self.assertEqual(task.location, build_location(task.name,
+                                                       layout='hash'))
+        self.assertEqual(read_task_data(task), b'<data/>')
+        self.assertFalse(default_storage.exists('%s.dat' % task.name))
+        # already in place
+        self.assertEqual(reshard_tasks(layout='hash'), 0)
+        default_storage.delete(task.location)
+
+    def test_reshard_grace(self, dispatch_task):
+        rule = self._create_rule()
+        task = models.Task.objects.create(rule=rule)
+        default_storage.save('%s.dat' % task.name, BytesIO(b'<data/>'))
+        stale = models.Task.objects.get(name=task.name)
+        storage = get_message_storage()
+        deleted = []
+        delete = storage.delete
+
+        def check_delete(location):
+            # the old copy outlives the move for the grace period
+            self.assertTrue(time.time() - moved >= 0.2)
+            deleted.append(location)
+            delete(location)
+
+        moved = time.time()
+        with mock.patch.object(storage, 'delete', check_delete), \
+                mock.patch('quartet_capture.locations.get_message_storage',
+                           return_value=storage):
+            self.assertEqual(reshard_tasks(layout='hash', grace=0.2), 1)
+        self.assertEqual(deleted, ['%s.dat' % task.name])
+        # a worker that loaded the task before the move reads the new copy
+        self.assertEqual(read_task_data(stale), b'<data/>')
+        self.assertEqual(stale.location, build_location(task.name,
+                                                        layout='hash'))
+        default_storage.delete(stale.location)
+
+    def _create_rule(self):
+        return models.Rule.objects.create(name='sharded',
+                                          description='unit test rule')
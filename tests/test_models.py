@@ -14,7 +14,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 # Copyright 2018 SerialLab Corp.  All rights reserved.
+import asyncio
 import os
+import threading
+import time
 import django
 
 os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
@@ -27,6 +30,75 @@ from quartet_capture import rules
 from quartet_capture.loader import load_data
 from quartet_capture.rules import TaskMessaging
 
+
+class ContextStep(rules.Step):
+    '''
+    Waits briefly and then records its name in the rule context.
+    '''
+
+    # set by tests to check that the steps of a stage run at the same time
+    barrier = None
+
+    def execute(self, data, rule_context: rules.RuleContext):
+        time.sleep(float(self.get_parameter('sleep', '0')))
+        if self.barrier:
+            self.barrier.wait()
+        if self.get_boolean_parameter('fail'):
+            raise ValueError('Failing as configured.')
+        rule_context.context[self.db_step.name] = True
+        rule_context.context['last'] = self.db_step.name
+        return self.db_step.name.encode()
+
+    @property
+    def declared_parameters(self):
+        return {'sleep': 'Seconds to wait.', 'fail': 'Raise an error.'}
+
+    def on_failure(self):
+        pass
+
+
+class AsyncContextStep(ContextStep):
+    '''
+    The async version of the ContextStep.
+    '''
+
+    async def execute(self, data, rule_context: rules.RuleContext):
+        await asyncio.sleep(float(self.get_parameter('sleep', '0')))
+        rule_context.context[self.db_step.name] = True
+        return self.db_step.name.encode()
+
+
+class ReusableStep(ContextStep):
+    '''
+    Counts how often its lifecycle methods are called.
+    '''
+    reusable = True
+    setups = 0
+    teardowns = 0
+
+    def setup(self):
+        ReusableStep.setups += 1
+
+    def teardown(self):
+        ReusableStep.teardowns += 1
+
+
+class ParameterStep(ContextStep):
+    '''
+    Reads its task and step parameters.
+    '''
+
+    def execute(self, data, rule_context: rules.RuleContext):
+        rule_context.context['task'] = self.get_task_parameters(rule_context)
+        rule_context.context['json'] = self.get_json_parameter('json')
+        rule_context.context['created'] = self.get_or_create_parameter(
+            'created', 'default')
+
+    @property
+    def declared_parameters(self):
+        return {'json': 'A JSON value.', 'created': 'Created on first use.'}
+
+
 class TestQuartet_capture(TestCase):
 
     def setUp(self):
@@ -185,6 +257,148 @@ class TestQuartet_capture(TestCase):
         tm.warning('This is a warning!')
         tm.error('This is an error!!!')
 
+    def test_parallel_stage(self):
+        db_rule = models.Rule.objects.create(name='parallel')
+        for order, name in enumerate(['a', 'b', 'c'], 1):
+            step = models.Step.objects.create(
+                rule=db_rule, name=name, order=order, stage=1,
+                step_class='tests.test_models.ContextStep')
+        db_task = models.Task.objects.create(name='parallel', rule=db_rule,
+                                             status='RUNNING')
+        rule = rules.Rule(db_rule, db_task)
+        self.assertEqual(len(rule._get_stages()), 1)
+        # the barrier breaks unless all three steps are running at once
+        ContextStep.barrier = threading.Barrier(3, timeout=10)
+        try:
+            rule.execute(b'data')
+        finally:
+            ContextStep.barrier = None
+        for name in ['a', 'b', 'c']:
+            self.assertTrue(rule.context.context[name])
+        # the highest ordered step wins
+        self.assertEqual(rule.context.context['last'], 'c')
+        self.assertEqual(rule.data, b'c')
+
+    def test_parallel_stage_failure(self):
+        db_rule = models.Rule.objects.create(name='parallel')
+        for order, name in enumerate(['a', 'b'], 1):
+            step = models.Step.objects.create(
+                rule=db_rule, name=name, order=order, stage=1,
+                step_class='tests.test_models.ContextStep')
+        models.StepParameter.objects.create(step=step, name='fail',
+                                            value='true')
+        db_task = models.Task.objects.create(name='parallel', rule=db_rule,
+                                             status='RUNNING')
+        rule = rules.Rule(db_rule, db_task)
+        with self.assertRaises(ValueError):
+            rule.execute(b'data')
+        self.assertTrue(rule.context.context['a'])
+
+    def test_async_steps(self):
+        db_rule = models.Rule.objects.create(name='async')
+        steps = [('a', 1, None, 'ContextStep'),
+                 ('b', 2, 1, 'AsyncContextStep'),
+                 ('c', 3, 1, 'AsyncContextStep'),
+                 ('d', 4, 1, 'ContextStep'),
+                 ('e', 5, None, 'AsyncContextStep')]
+        for name, order, stage, step_class in steps:
+            step = models.Step.objects.create(
+                rule=db_rule, name=name, order=order, stage=stage,
+                step_class='tests.test_models.%s' % step_class)
+            models.StepParameter.objects.create(step=step, name='sleep',
+                                                value='0.3')
+        db_task = models.Task.objects.create(name='async', rule=db_rule,
+                                             status='RUNNING')
+        rule = rules.Rule(db_rule, db_task)
+        start = time.time()
+        rule.execute(b'data')
+        # three stages of 0.3 seconds each
+        self.assertLess(time.time() - start, 1.4)
+        for name in ['a', 'b', 'c', 'd', 'e']:
+            self.assertTrue(rule.context.context[name])
+        self.assertEqual(rule.data, b'e')
+
+    def test_reusable_step(self):
+        ReusableStep.setups = ReusableStep.teardowns = 0
+        db_rule = models.Rule.objects.create(name='reusable')
+        db_step = models.Step.objects.create(
+            rule=db_rule, name='reusable', order=1,
+            step_class='tests.test_models.ReusableStep')
+        instances = []
+        for name in ['first', 'second']:
+            db_task = models.Task.objects.create(name=name, rule=db_rule,
+                                                 status='RUNNING')
+            rule = rules.Rule(db_rule, db_task)
+            instances.append(rule.steps[1])
+            self.assertEqual(rule.steps[1].task, db_task)
+            rule.execute(b'data')
+        self.assertIs(instances[0], instances[1])
+        self.assertEqual(ReusableStep.setups, 1)
+        # a configuration change replaces the pooled instance
+        models.StepParameter.objects.create(step=db_step, name='sleep',
+                                            value='0')
+        db_task = models.Task.objects.create(name='third', rule=db_rule,
+                                             status='RUNNING')
+        rule = rules.Rule(db_rule, db_task)
+        self.assertIsNot(rule.steps[1], instances[0])
+        self.assertEqual(ReusableStep.teardowns, 1)
+        rule.execute(b'data')
+        rules.step_pool.clear()
+        self.assertEqual(ReusableStep.teardowns, 2)
+
+    def test_step_load_failure(self):
+        ReusableStep.setups = ReusableStep.teardowns = 0
+        db_rule = models.Rule.objects.create(name='reusable')
+        models.Step.objects.create(
+            rule=db_rule, name='reusable', order=1,
+            step_class='tests.test_models.ReusableStep')
+        models.Step.objects.create(
+            rule=db_rule, name='missing', order=2,
+            step_class='tests.test_models.MissingStep')
+        db_task = models.Task.objects.create(name='failed', rule=db_rule,
+                                             status='RUNNING')
+        with self.assertRaises(rules.Rule.StepNotFound):
+            rules.Rule(db_rule, db_task)
+        # the step loaded before the failure went back to the pool
+        models.Step.objects.filter(name='missing').delete()
+        rule = rules.Rule(db_rule, db_task)
+        self.assertEqual(ReusableStep.setups, 1)
+        rule.execute(b'data')
+        rules.step_pool.clear()
+        self.assertEqual(ReusableStep.teardowns, 1)
+
+    def test_warm_up(self):
+        self._create_rule()
+        rules._step_classes.clear()
+        self.assertEqual(rules.warm_up(), 1)
+        self.assertIs(
+            rules._step_classes['quartet_epcis.parsing.steps.EPCISParsingStep'],
+            EPCISParsingStep)
+
+    def test_preloaded_parameters(self):
+        db_rule = models.Rule.objects.create(name='parameters')
+        db_step = models.Step.objects.create(
+            rule=db_rule, name='parameters', order=1,
+            step_class='tests.test_models.ParameterStep')
+        models.StepParameter.objects.create(step=db_step, name='json',
+                                            value='{"a": [1, 2]}')
+        db_task = models.Task.objects.create(name='parameters', rule=db_rule,
+                                             status='RUNNING')
+        models.TaskParameter.objects.create(task=db_task, name='param',
+                                            value='value')
+        rule = rules.Rule(db_rule, db_task)
+        step = rule.steps[1]
+        step.get_or_create_parameter('created', 'default')
+        with self.assertNumQueries(0):
+            step.execute(None, rule.context)
+            self.assertIs(step.get_json_parameter('json'),
+                          rule.context.context['json'])
+        self.assertEqual(rule.context.context['task'], {'param': 'value'})
+        self.assertEqual(rule.context.context['json'], {'a': [1, 2]})
+        self.assertEqual(rule.context.context['created'], 'default')
+        self.assertTrue(db_step.stepparameter_set.filter(
+            name='created').exists())
+
     def tearDown(self):
         pass
 
@@ -0,0 +1,106 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import os
+import django
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
+django.setup()
+from io import BytesIO
+from django.core.exceptions import ValidationError
+from django.test import TestCase
+from quartet_capture import models
+from quartet_capture.serializers import RuleFilterSerializer
+from quartet_capture.paths import compile_path, ElementPathError
+from quartet_capture.tasks import get_rules_by_filter
+
+EPCIS = '''<?xml version="1.0" encoding="UTF-8"?>
+<epcis:EPCISDocument xmlns:epcis="urn:epcglobal:epcis:xsd:1"
+    xmlns:sbdh="http://www.unece.org/cefact/namespaces/StandardBusinessDocumentHeader">
+  <EPCISHeader>
+    <sbdh:StandardBusinessDocumentHeader>
+      <sbdh:Sender>
+        <sbdh:Identifier Authority="SGLN">urn:epc:id:sgln:0555555.00000.0</sbdh:Identifier>
+      </sbdh:Sender>
+    </sbdh:StandardBusinessDocumentHeader>
+  </EPCISHeader>
+  <EPCISBody>
+    <EventList>
+      <ObjectEvent>
+        <bizStep> urn:epcglobal:cbv:bizstep:shipping </bizStep>
+      </ObjectEvent>
+'''
+
+
+class ElementPathTest(TestCase):
+    '''
+    Tests the element path RuleFilter search type.
+    '''
+
+    def test_search(self):
+        # the document is never closed, matches are found before the end
+        self.assertTrue(compile_path('//bizStep').search(EPCIS))
+        self.assertTrue(compile_path(
+            "//bizStep[.='urn:epcglobal:cbv:bizstep:shipping']").search(
+            EPCIS.encode('utf-8')))
+        self.assertTrue(compile_path(
+            "//ObjectEvent/bizStep[contains(., 'shipping')]").search(
+            BytesIO(EPCIS.encode('utf-8'))))
+        self.assertTrue(compile_path(
+            "/epcis:EPCISDocument/EPCISHeader//Sender/"
+            "Identifier[@Authority='SGLN']").search(EPCIS))
+        self.assertTrue(compile_path(
+            '//{http://www.unece.org/cefact/namespaces/'
+            'StandardBusinessDocumentHeader}Sender').search(EPCIS))
+        self.assertFalse(compile_path(
+            "//bizStep[.!='urn:epcglobal:cbv:bizstep:shipping']").search(
+            EPCIS + '</EventList></EPCISBody></epcis:EPCISDocument>'))
+        self.assertFalse(compile_path('//Identifier[@Authority="GLN"]')
+                         .search(EPCIS + '<broken'))
+        self.assertFalse(compile_path('//bizStep').search('not xml'))
+
+    def test_root_mismatch(self):
+        # decided on the root element without reading any further
+        self.assertFalse(compile_path('/Other//bizStep').search(
+            '<EPCISDocument><bizStep>x</bizStep><broken'))
+
+    def test_invalid(self):
+        for expression in ['bizStep', '//bizStep[1]', '//a[.="x"]/b', '']:
+            with self.assertRaises(ElementPathError):
+                compile_path(expression)
+        rule = models.Rule.objects.create(name='path', description='test')
+        filter = models.Filter.objects.create(name='path')
+        rule_filter = models.RuleFilter(filter=filter, rule=rule,
+                                        search_type='path',
+                                        search_value='//bizStep[1]')
+        with self.assertRaises(ValidationError):
+            rule_filter.full_clean()
+        serializer = RuleFilterSerializer(data={
+            'filter': filter.pk, 'rule': rule.pk, 'search_type': 'path',
+            'search_value': '//bizStep[1]', 'order': 1})
+        self.assertFalse(serializer.is_valid())
+        self.assertIn('search_value', serializer.errors)
+
+    def test_filter(self):
+        rule = models.Rule.objects.create(name='shipping', description='test')
+        other = models.Rule.objects.create(name='receiving',
+                                           description='test')
+        filter = models.Filter.objects.create(name='path')
+        models.RuleFilter.objects.create(
+            filter=filter, rule=other, search_type='path', order=1,
+            search_value="//bizStep[contains(., 'receiving')]")
+        models.RuleFilter.objects.create(
+            filter=filter, rule=rule, search_type='path', order=2,
+            search_value="//bizStep[contains(., 'shipping')]")
+        self.assertEqual(get_rules_by_filter('path', EPCIS), ['shipping'])
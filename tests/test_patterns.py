@@ -0,0 +1,119 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import os
+import django
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
+django.setup()
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from django.core.exceptions import ValidationError
+from django.test import TestCase
+from quartet_capture import models, patterns
+from quartet_capture.tasks import get_rules_by_filter
+
+
+@mock.patch('quartet_capture.patterns.REGEX_TIMEOUT', 0.5)
+class RegexBudgetTest(TestCase):
+    '''
+    Tests the protection against runaway regex rule filters.
+    '''
+
+    def setUp(self):
+        patterns._compile.cache_clear()
+
+    def tearDown(self):
+        patterns._compile.cache_clear()
+
+    def test_analyze(self):
+        self.assertEqual(patterns.analyze('^<epcis.*</epcis>'), patterns.SAFE)
+        self.assertEqual(patterns.analyze(r'(ab|cd)+x'), patterns.RISKY)
+        self.assertEqual(patterns.analyze(r'.*.*.*=x'), patterns.RISKY)
+        self.assertEqual(patterns.analyze(r'a(b.*)c(d+)'), patterns.RISKY)
+        self.assertEqual(patterns.analyze(r'(a+)+$'), patterns.CATASTROPHIC)
+        self.assertEqual(patterns.analyze(r'(?:\s*\w+)*;'),
+                         patterns.CATASTROPHIC)
+
+    def test_validation(self):
+        rule = models.Rule.objects.create(name='regex', description='test')
+        filter = models.Filter.objects.create(name='regex')
+        for pattern in ['(a+)+$', '(unclosed']:
+            rule_filter = models.RuleFilter(filter=filter, rule=rule,
+                                            search_type='regex',
+                                            search_value=pattern)
+            with self.assertRaises(ValidationError):
+                rule_filter.full_clean()
+
+    def test_sandbox(self):
+        self.assertTrue(patterns.search(r'(ab|cd)+x', 'ababcdx'))
+        start = time.perf_counter()
+        with self.assertLogs('quartet_capture', 'WARNING'):
+            self.assertFalse(patterns.search(r'(a|aa)+b', 'a' * 50))
+        self.assertLess(time.perf_counter() - start, 5)
+        # the sandbox is restarted
+        self.assertTrue(patterns.search(r'(ab|cd)+x', 'cdx'))
+
+    def test_polynomial_sandbox(self):
+        start = time.perf_counter()
+        with self.assertLogs('quartet_capture', 'WARNING'):
+            self.assertFalse(patterns.search(r'.*.*.*=x', 'a' * 3000))
+        self.assertLess(time.perf_counter() - start, 5)
+        self.assertTrue(patterns.search(r'.*.*.*=x', 'ab=x'))
+
+    @mock.patch('quartet_capture.patterns.REGEX_TIMEOUT', 1.0)
+    def test_concurrent_sandbox(self):
+        runaway = (r'(a|aa)+$', 'a' * 60 + 'b')
+        # two runaway searches hold every worker while a good one waits,
+        # its time only counts once a worker is free
+        with ThreadPoolExecutor(max_workers=3) as pool, \
+                self.assertLogs('quartet_capture', 'WARNING'):
+            bad = [pool.submit(patterns.search, *runaway) for i in range(2)]
+            time.sleep(0.2)
+            good = pool.submit(patterns.search, r'(foo|bar)+z', 'foobarz')
+            self.assertTrue(good.result())
+            self.assertEqual([future.result() for future in bad],
+                             [False, False])
+        # a search still running when a runaway one is killed is unaffected
+        with ThreadPoolExecutor(max_workers=2) as pool, \
+                self.assertLogs('quartet_capture', 'WARNING'):
+            bad = pool.submit(patterns.search, *runaway)
+            time.sleep(0.8)
+            good = pool.submit(patterns.search, r'(foo|bar)+z',
+                               'foobar' * 1000000 + 'z')
+            self.assertTrue(good.result())
+            self.assertFalse(bad.result())
+
+    @mock.patch('quartet_capture.patterns.REGEX_MAX_SIZE', 10)
+    def test_size_budget(self):
+        self.assertTrue(patterns.search('data', '<data/>'))
+        with self.assertLogs('quartet_capture', 'WARNING'):
+            self.assertFalse(patterns.search('data', '<data/>' * 2))
+
+    def test_filter(self):
+        rule = models.Rule.objects.create(name='regex', description='test')
+        default = models.Rule.objects.create(name='default',
+                                             description='test')
+        filter = models.Filter.objects.create(name='regex')
+        # saved before patterns were validated
+        models.RuleFilter.objects.create(
+            filter=filter, rule=rule, search_type='regex', order=1,
+            search_value='(a+)+b')
+        models.RuleFilter.objects.create(
+            filter=filter, rule=default, search_type='search', order=2,
+            search_value='', default=True)
+        with self.assertLogs('quartet_capture', 'WARNING'):
+            self.assertEqual(get_rules_by_filter('regex', 'a' * 50),
+                             ['default'])
@@ -0,0 +1,92 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import io
+import os
+import tracemalloc
+import django
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
+django.setup()
+from django.test import TestCase
+from quartet_capture import models, rules
+from quartet_capture.buffers import DataBuffer
+from quartet_capture.payload import Payload
+
+
+class TreeStep(rules.Step):
+    '''
+    Records the parsed tree it was handed and, if configured, returns
+    new data.
+    '''
+
+    def execute(self, data, rule_context: rules.RuleContext):
+        rule_context.context.setdefault('trees', []).append(
+            rule_context.payload.tree)
+        return self.get_parameter('data', '').encode() or None
+
+    @property
+    def declared_parameters(self):
+        return {'data': 'The data to return.'}
+
+    def on_failure(self):
+        pass
+
+
+class PayloadTest(TestCase):
+    '''
+    Tests the shared parse cache of the rule context.
+    '''
+
+    def test_payload(self):
+        payload = Payload(DataBuffer(b'<a><b>\xc3\xa9</b></a>'))
+        self.assertEqual(payload.text, '<a><b>é</b></a>')
+        self.assertIs(payload.tree, payload.tree)
+        self.assertEqual(payload.tree.getroot().tag, 'a')
+        tags = [element.tag for event, element in payload.iterparse()]
+        self.assertEqual(tags, ['b', 'a'])
+
+    def test_open_spilled(self):
+        data = b'<a>' + b'<b>x</b>' * 2 * 1024 * 1024 + b'</a>'
+        payload = Payload(DataBuffer(data, threshold=1024))
+        tracemalloc.start()
+        try:
+            stream = payload.open()
+            self.assertEqual(stream.read(6), b'<a><b>')
+            # the buffer is not copied onto the heap
+            self.assertLess(tracemalloc.get_traced_memory()[1], 1024 * 1024)
+        finally:
+            tracemalloc.stop()
+        stream.seek(-4, io.SEEK_END)
+        self.assertEqual(stream.read(), b'</a>')
+        stream.close()
+        self.assertEqual(len(payload.tree.getroot()), 2 * 1024 * 1024)
+
+    def test_shared_parse(self):
+        db_rule = models.Rule.objects.create(name='payload',
+                                             description='unit test rule')
+        for order in range(1, 4):
+            step = models.Step.objects.create(
+                rule=db_rule, name='step %s' % order, order=order,
+                step_class='tests.test_payload.TreeStep')
+            if order == 2:
+                models.StepParameter.objects.create(step=step, name='data',
+                                                    value='<new/>')
+        db_task = models.Task.objects.create(name='payload', rule=db_rule,
+                                             status='RUNNING')
+        rule = rules.Rule(db_rule, db_task)
+        rule.execute(b'<old/>')
+        first, second, third = rule.context.context['trees']
+        self.assertIs(first, second)
+        self.assertEqual(third.getroot().tag, 'new')
@@ -0,0 +1,133 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import os
+import django
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
+django.setup()
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from django.test import TestCase
+from quartet_capture import models, segments
+from quartet_capture.segments import SegmentStorage, close_segment, \
+    compact_segments, parse_key, recover_segments
+from quartet_capture.tasks import create_and_queue_task, read_task_data
+
+
+@mock.patch('quartet_capture.segments.COMPACT_MIN_AGE', 0)
+class SegmentStorageTest(TestCase):
+    '''
+    Tests storing messages in segment files.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.storage = SegmentStorage(location=self.directory)
+
+    def tearDown(self):
+        close_segment()
+        segments._writers.clear()
+        shutil.rmtree(self.directory)
+
+    def test_save_and_open(self):
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            keys = list(pool.map(
+                lambda i: self.storage.save('%s.dat' % i, b'<data %s/>' % (
+                    str(i).encode())), range(20)))
+        # all in one segment
+        self.assertEqual(len({parse_key(key)[0] for key in keys}), 1)
+        for i, key in enumerate(keys):
+            self.assertTrue(self.storage.exists(key))
+            with self.storage.open(key) as message_file:
+                self.assertEqual(message_file.read(),
+                                 b'<data %s/>' % str(i).encode())
+
+    def test_task_data(self):
+        models.Rule.objects.create(name='segments',
+                                   description='unit test rule')
+        with mock.patch('quartet_capture.tasks.get_message_storage',
+                        return_value=self.storage), \
+            mock.patch('quartet_capture.locations.get_message_storage',
+                       return_value=self.storage), \
+            mock.patch('quartet_capture.tasks.dispatch_task'):
+            task = create_and_queue_task('<data/>', 'segments')
+            task.refresh_from_db()
+            self.assertIn('@', task.location)
+            self.assertEqual(read_task_data(task), b'<data/>')
+
+    def test_recover(self):
+        key = self.storage.save('first.dat', b'<data/>')
+        close_segment()
+        path = self.storage.path(parse_key(key)[0])
+        size = os.path.getsize(path)
+        with open(path, 'ab') as segment:
+            segment.write(b'QCS1\x00')
+        self.assertEqual(recover_segments(self.storage), 5)
+        self.assertEqual(os.path.getsize(path), size)
+        self.assertEqual(self.storage.open(key).read(), b'<data/>')
+
+    def test_failed_write(self):
+        key = self.storage.save('first.dat', b'<data/>')
+        writer = segments._get_writer(self.storage)
+        segment_file = writer.file
+
+        def torn_write(record):
+            segment_file.write(record[:10])
+            raise OSError(28, 'No space left on device')
+
+        writer.file = mock.Mock(wraps=segment_file)
+        writer.file.write.side_effect = torn_write
+        with self.assertRaises(OSError):
+            self.storage.save('second.dat', b'<data/>')
+        self.assertTrue(segment_file.closed)
+        # the next message goes to a new segment at a known offset
+        third = self.storage.save('third.dat', b'<third/>')
+        self.assertNotEqual(parse_key(third)[0], parse_key(key)[0])
+        self.assertEqual(parse_key(third)[1], 0)
+        self.assertEqual(self.storage.open(third).read(), b'<third/>')
+        close_segment()
+        self.assertEqual(recover_segments(self.storage), 10)
+        self.assertEqual(self.storage.open(key).read(), b'<data/>')
+
+    def test_failed_close_sync(self):
+        key = self.storage.save('first.dat', b'<data/>')
+        writer = segments._get_writer(self.storage)
+        segment_file, segment = writer.file, parse_key(key)[0]
+        with mock.patch('quartet_capture.segments.os.fsync',
+                        side_effect=OSError(5, 'I/O error')), \
+                self.assertLogs('quartet_capture', 'WARNING'):
+            with writer.lock:
+                writer._abandon()
+        self.assertTrue(segment_file.closed)
+        # a thread still waiting to sync its record to the segment fails
+        with self.assertRaises(OSError):
+            writer._sync(segment_file, segment, 1)
+
+    def test_compact(self):
+        rule = models.Rule.objects.create(name='segments',
+                                          description='unit test rule')
+        keys = [self.storage.save('%s.dat' % i, b'x' * 100)
+                for i in range(10)]
+        close_segment()
+        old_segment = parse_key(keys[0])[0]
+        # only one message is still referenced by a task
+        task = models.Task.objects.create(rule=rule, location=keys[3])
+        self.assertGreater(compact_segments(0.5, self.storage, grace=0), 0)
+        self.assertFalse(os.path.exists(self.storage.path(old_segment)))
+        task.refresh_from_db()
+        self.assertNotEqual(parse_key(task.location)[0], old_segment)
+        self.assertEqual(self.storage.open(task.location).read(), b'x' * 100)
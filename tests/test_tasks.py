@@ -0,0 +1,258 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import os
+import django
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
+django.setup()
+import threading
+from datetime import timedelta
+from unittest import mock
+from django.contrib.auth.models import User
+from django.core.files.storage import default_storage
+from django.db import DatabaseError
+from django.test import TestCase
+from django.utils import timezone
+from quartet_capture import models
+from quartet_capture.backends import DatabaseBackend
+from quartet_capture.errors import TaskDependencyError, TaskDeferred
+from quartet_capture.tasks import TaskLease, create_and_queue_task, \
+    execute_queued_task, release_rule_slot, requeue_tasks, run_task, \
+    sweep_tasks
+
+
+@mock.patch('quartet_capture.tasks.dispatch_task')
+class TaskSchedulingTest(TestCase):
+    '''
+    Tests the queuing and scheduling of tasks without a Celery broker.
+    '''
+
+    def test_task_dependency(self, dispatch_task):
+        self._create_rule()
+        first = create_and_queue_task('<data/>', 'blank')
+        second = create_and_queue_task('<data/>', 'blank',
+                                       depends_on_tasks=[first.name])
+        second.refresh_from_db()
+        self.assertEqual(second.status, 'WAITING')
+        dispatch_task.assert_called_once_with(first.name, user_id=None)
+        # the blank rule fails but a failed task still completes
+        execute_queued_task(task_name=first.name)
+        second.refresh_from_db()
+        self.assertEqual(second.status, 'QUEUED')
+        dispatch_task.assert_called_with(second.name)
+
+    def test_waiting_task_user(self, dispatch_task):
+        self._create_rule()
+        user = User.objects.create_user('queuer')
+        first = create_and_queue_task('<data/>', 'blank')
+        second = create_and_queue_task('<data/>', 'blank', user_id=user.id,
+                                       depends_on_tasks=[first.name])
+        execute_queued_task(task_name=first.name)
+        dispatch_task.assert_called_with(second.name)
+        # the queuing user is recorded once, when the task is parked
+        self.assertEqual(list(models.TaskHistory.objects.filter(
+            task=second).values_list('user_id', flat=True)), [user.id])
+
+    def test_waiting_task_user_database_backend(self, dispatch_task):
+        self._create_rule()
+        user = User.objects.create_user('queuer')
+        first = create_and_queue_task('<data/>', 'blank')
+        second = create_and_queue_task('<data/>', 'blank', user_id=user.id,
+                                       depends_on_tasks=[first.name])
+        dispatch_task.side_effect = lambda name, user_id=None: \
+            DatabaseBackend().dispatch([name], user_id=user_id)
+        execute_queued_task(task_name=first.name)
+        self.assertEqual(models.TaskHistory.objects.filter(
+            task=second).count(), 1)
+
+    def test_rule_dependency(self, dispatch_task):
+        self._create_rule()
+        self._create_rule('other')
+        first = create_and_queue_task('<data/>', 'other')
+        second = create_and_queue_task('<data/>', 'blank',
+                                       depends_on_rules=['other'])
+        second.refresh_from_db()
+        self.assertEqual(second.status, 'WAITING')
+        execute_queued_task(task_name=first.name)
+        second.refresh_from_db()
+        self.assertEqual(second.status, 'QUEUED')
+
+    def test_completed_dependency(self, dispatch_task):
+        self._create_rule()
+        first = create_and_queue_task('<data/>', 'blank')
+        execute_queued_task(task_name=first.name)
+        second = create_and_queue_task('<data/>', 'blank',
+                                       depends_on_tasks=[first.name])
+        self.assertEqual(second.status, 'QUEUED')
+        dispatch_task.assert_called_with(second.name, user_id=None)
+
+    def test_missing_dependency(self, dispatch_task):
+        self._create_rule()
+        with self.assertRaises(TaskDependencyError):
+            create_and_queue_task('<data/>', 'blank',
+                                  depends_on_tasks=['not-a-task'])
+        self.assertEqual(models.Task.objects.count(), 0)
+
+    def test_rule_concurrency_limit(self, dispatch_task):
+        rule = self._create_rule()
+        rule.max_concurrency = 1
+        rule.save()
+        running = models.Task.objects.create(name='running', rule=rule,
+                                             status='RUNNING')
+        task = create_and_queue_task('<data/>', 'blank')
+        execute_queued_task(task_name=task.name)
+        task.refresh_from_db()
+        self.assertEqual(task.status, 'WAITING')
+        running.status = 'FINISHED'
+        running.save()
+        release_rule_slot(running)
+        task.refresh_from_db()
+        self.assertEqual(task.status, 'QUEUED')
+        dispatch_task.assert_called_with(task.name)
+
+    def test_run_immediately_at_concurrency_limit(self, dispatch_task):
+        rule = self._create_rule()
+        rule.max_concurrency = 1
+        rule.save()
+        models.Task.objects.create(name='running', rule=rule,
+                                   status='RUNNING')
+        with self.assertRaises(TaskDeferred) as context:
+            create_and_queue_task('<data/>', 'blank', run_immediately=True)
+        self.assertEqual(context.exception.task.status, 'WAITING')
+
+    @mock.patch('quartet_capture.tasks.dispatch_batch')
+    def test_requeue_tasks(self, dispatch_batch, dispatch_task):
+        rule = self._create_rule()
+        for i in range(3):
+            models.Task.objects.create(name='failed-%s' % i, rule=rule,
+                                       status='FAILED')
+        models.Task.objects.create(name='running', rule=rule,
+                                   status='RUNNING')
+        progress = []
+        task_names = models.Task.objects.values_list('name', flat=True)
+        requeued = requeue_tasks(task_names, batch_size=2, priority=3,
+                                 progress=lambda *args: progress.append(args))
+        self.assertEqual(requeued, 3)
+        self.assertEqual(dispatch_batch.call_count, 2)
+        self.assertEqual(dispatch_batch.call_args[1]['priority'], 3)
+        self.assertEqual(progress[-1], (3, 4))
+        self.assertEqual(
+            models.Task.objects.filter(status='QUEUED').count(), 3)
+        self.assertEqual(models.Task.objects.get(name='running').status,
+                         'RUNNING')
+
+    @mock.patch('quartet_capture.tasks.read_task_data')
+    def test_inline_execution(self, read_task_data, dispatch_task):
+        rule = self._create_rule()
+        models.Step.objects.create(rule=rule, name='context', order=1,
+                                   step_class='tests.test_models.ContextStep')
+        task = create_and_queue_task(b'<data/>', 'blank',
+                                     run_immediately=True)
+        read_task_data.assert_not_called()
+        dispatch_task.assert_not_called()
+        task.refresh_from_db()
+        self.assertEqual(task.status, 'FINISHED')
+        with default_storage.open(task.location) as message_file:
+            self.assertEqual(message_file.read(), b'<data/>')
+
+    @mock.patch('quartet_capture.tasks.dispatch_batch')
+    def test_sweep_tasks(self, dispatch_batch, dispatch_task):
+        rule = self._create_rule()
+        long_ago = timezone.now() - timedelta(hours=1)
+        models.Task.objects.create(name='orphaned', rule=rule,
+                                   status='QUEUED')
+        models.Task.objects.create(name='dispatched', rule=rule,
+                                   status='QUEUED', dispatched=long_ago)
+        models.Task.objects.create(name='new', rule=rule, status='QUEUED')
+        models.Task.objects.create(name='expired', rule=rule,
+                                   status='RUNNING', lease_expires=long_ago)
+        models.Task.objects.create(name='leased', rule=rule,
+                                   status='RUNNING',
+                                   lease_expires=timezone.now() + timedelta(
+                                       hours=1))
+        models.Task.objects.filter(name__in=['orphaned', 'dispatched']).update(
+            status_changed=long_ago)
+        self.assertEqual(sweep_tasks(rate=0), 2)
+        swept = dispatch_batch.call_args[0][0]
+        self.assertEqual(sorted(swept), ['expired', 'orphaned'])
+        self.assertEqual(models.Task.objects.get(name='expired').status,
+                         'QUEUED')
+        self.assertEqual(models.Task.objects.get(name='leased').status,
+                         'RUNNING')
+
+    @mock.patch('quartet_capture.tasks.dispatch_batch')
+    def test_failed_requeue_is_swept(self, dispatch_batch, dispatch_task):
+        rule = self._create_rule()
+        models.Task.objects.create(name='failed', rule=rule, status='FAILED',
+                                   dispatched=timezone.now())
+        dispatch_batch.side_effect = ConnectionError('broker down')
+        with self.assertRaises(ConnectionError):
+            requeue_tasks(['failed'])
+        task = models.Task.objects.get(name='failed')
+        self.assertEqual(task.status, 'QUEUED')
+        self.assertIsNone(task.dispatched)
+        models.Task.objects.filter(name='failed').update(
+            status_changed=timezone.now() - timedelta(hours=1))
+        dispatch_batch.side_effect = None
+        self.assertEqual(sweep_tasks(rate=0), 1)
+        self.assertEqual(dispatch_batch.call_args[0][0], ['failed'])
+
+    def test_duplicate_dispatch(self, dispatch_task):
+        rule = self._create_rule()
+        models.Task.objects.create(
+            name='running', rule=rule, status='RUNNING',
+            lease_expires=timezone.now() + timedelta(hours=1))
+        self.assertFalse(execute_queued_task(task_name='running'))
+        self.assertEqual(models.Task.objects.get(name='running').status,
+                         'RUNNING')
+        # a task loaded by two workers only runs once
+        task = create_and_queue_task('<data/>', 'blank')
+        stale = models.Task.objects.get(name=task.name)
+        self.assertTrue(execute_queued_task(task_name=task.name))
+        self.assertFalse(run_task(stale))
+
+    @mock.patch('quartet_capture.tasks.LEASE_SECONDS', 0.3)
+    def test_lease_renewal_error(self, dispatch_task):
+        rule = self._create_rule()
+        task = models.Task.objects.create(name='running', rule=rule,
+                                          status='RUNNING')
+        renewed = threading.Event()
+        calls = []
+
+        def renew_once():
+            calls.append(1)
+            if len(calls) == 1:
+                raise DatabaseError('connection lost')
+            renewed.set()
+            return True
+
+        lease = TaskLease(task)
+        with mock.patch.object(lease, '_renew_once', renew_once), \
+                self.assertLogs('quartet_capture', 'ERROR'):
+            with lease:
+                # renewal carries on after the failure
+                self.assertTrue(renewed.wait(5))
+
+    def test_broker_outage(self, dispatch_task):
+        self._create_rule()
+        dispatch_task.side_effect = ConnectionError('broker down')
+        task = create_and_queue_task('<data/>', 'blank')
+        task.refresh_from_db()
+        self.assertEqual(task.status, 'QUEUED')
+        self.assertIsNone(task.dispatched)
+
+    def _create_rule(self, name='blank'):
+        return models.Rule.objects.create(name=name,
+                                          description='unit test rule')
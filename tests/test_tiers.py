@@ -0,0 +1,74 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+# Copyright 2018 SerialLab Corp.  All rights reserved.
+import os
+import django
+
+os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
+django.setup()
+import shutil
+import tempfile
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
+from django.test import TestCase
+from django.urls import reverse
+from rest_framework.test import APIClient
+from quartet_capture import models, segments
+from quartet_capture.tasks import create_and_queue_task, read_task_data
+from quartet_capture.tiers import archive_tasks
+
+
+@mock.patch('quartet_capture.tasks.dispatch_task')
+class ArchiveTest(TestCase):
+    '''
+    Tests moving the messages of completed tasks to the archive tier.
+    '''
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        patcher = mock.patch('quartet_capture.tiers.ARCHIVE_ROOT',
+                             self.directory)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        segments.close_segment()
+        segments._writers.clear()
+        shutil.rmtree(self.directory)
+
+    def test_archive(self, dispatch_task):
+        models.Rule.objects.create(name='archive',
+                                   description='unit test rule')
+        finished = create_and_queue_task('<data/>' * 100, 'archive')
+        queued = create_and_queue_task('<data/>', 'archive')
+        models.Task.objects.filter(name=finished.name).update(
+            status='FINISHED')
+        hot_location = finished.location
+        self.assertEqual(archive_tasks(days=0, grace=0), 1)
+        finished.refresh_from_db()
+        queued.refresh_from_db()
+        self.assertTrue(finished.location.startswith('archive:'))
+        self.assertFalse(queued.location.startswith('archive:'))
+        self.assertFalse(default_storage.exists(hot_location))
+        self.assertEqual(read_task_data(finished), b'<data/>' * 100)
+        # already archived
+        self.assertEqual(archive_tasks(days=0), 0)
+        user = get_user_model().objects.create_superuser(
+            'archive', 'archive@example.com', 'archive')
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.get(reverse('task-data', args=[finished.name]))
+        self.assertEqual(response.content, b'<data/>' * 100)
+        default_storage.delete(queued.location)
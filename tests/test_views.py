@@ -17,10 +17,15 @@ import django
 
 os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
 django.setup()
-from rest_framework.test import APITestCase
+from datetime import timedelta
+from unittest import mock
+from rest_framework.test import APIClient, APITestCase
+from django.core.cache import cache
 from django.urls import reverse
+from django.utils import timezone
 from django.contrib.auth.models import Group, User
-from quartet_capture import models
+from quartet_capture import admission, idempotency, models, pagination, \
+    viewsets
 from quartet_capture.rules import clone_rule
 from quartet_capture.views import get_rules_by_filter
 from quartet_capture.management.commands.create_capture_groups import Command
@@ -280,6 +285,147 @@ class ViewTest(APITestCase):
             {'file': data},
             format='multipart')
 
+    @mock.patch.object(viewsets.TaskViewset, 'pagination_class',
+                       pagination.TaskCursorPagination)
+    def test_task_cursor_pagination(self):
+        rule = self._create_rule()
+        for i in range(3):
+            models.Task.objects.create(name='task-%s' % i, rule=rule,
+                                       status='FINISHED')
+        url = reverse('tasks-list')
+        response = self.client.get('{0}?page_size=2&count=true'.format(url))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), 2)
+        self.assertEqual(response.data['count'], 3)
+        self.assertIsNotNone(response.data['next'])
+        response = self.client.get(response.data['next'])
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertIsNone(response.data['next'])
+
+    @mock.patch('quartet_capture.tasks.requeue_tasks_task.delay')
+    def test_bulk_execute_view(self, delay):
+        rule = self._create_rule()
+        for i, task_status in enumerate(['FAILED', 'FAILED', 'FINISHED']):
+            models.Task.objects.create(name='task-%s' % i, rule=rule,
+                                       status=task_status)
+        url = reverse('execute-bulk')
+        response = self.client.post(url, {'rule': 'epcis', 'rate': '10'},
+                                    format='json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(delay.call_args[1]['rate'], 10)
+        response = self.client.post(url, {'since': 'yesterday'},
+                                    format='json')
+        self.assertEqual(response.status_code, 400)
+
+    def test_idempotency_key(self):
+        self._create_rule()
+        url = '{0}?rule=epcis&run-immediately=true'.format(
+            reverse('quartet-capture'))
+        data = self._get_test_data()
+        responses = [
+            self.client.post(url, {'file': data}, format='multipart',
+                             HTTP_IDEMPOTENCY_KEY=key)
+            for key in ['first', 'first', 'second']
+        ]
+        self.assertEqual(responses[0].data, responses[1].data)
+        self.assertNotEqual(responses[0].data, responses[2].data)
+        self.assertEqual(models.Task.objects.count(), 2)
+
+    @mock.patch('quartet_capture.tasks.dispatch_task')
+    def test_idempotency_key_abandoned(self, dispatch_task):
+        self._create_rule()
+        url = '{0}?rule=epcis'.format(reverse('quartet-capture'))
+        data = self._get_test_data()
+        self.client.post(url, {'file': data}, format='multipart',
+                         HTTP_IDEMPOTENCY_KEY='dead')
+        # the process handling the original request died after claiming
+        models.IdempotencyKey.objects.update(task=None)
+        response = self.client.post(url, {'file': data}, format='multipart',
+                                    HTTP_IDEMPOTENCY_KEY='dead')
+        self.assertEqual(response.status_code, 409)
+        models.IdempotencyKey.objects.update(
+            created=timezone.now() - timedelta(
+                seconds=idempotency.IDEMPOTENCY_LEASE + 1))
+        response = self.client.post(url, {'file': data}, format='multipart',
+                                    HTTP_IDEMPOTENCY_KEY='dead')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(models.IdempotencyKey.objects.get().task_id,
+                         response.data)
+
+    @mock.patch('quartet_capture.idempotency.IDEMPOTENCY_BODY_HASH', True)
+    def test_idempotent_body(self):
+        self._create_rule()
+        url = '{0}?rule=epcis&run-immediately=true'.format(
+            reverse('quartet-capture'))
+        data = self._get_test_data()
+        first = self.client.post(url, {'file': data}, format='multipart')
+        second = self.client.post(url, {'file': data}, format='multipart')
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(models.Task.objects.count(), 1)
+
+    @mock.patch('quartet_capture.tasks.dispatch_task')
+    @mock.patch('quartet_capture.admission.MAX_QUEUE_DEPTH', 1)
+    def test_admission_control(self, dispatch_task):
+        cache.clear()
+        rule = self._create_rule()
+        models.Task.objects.create(name='queued', rule=rule, status='QUEUED')
+        url = '{0}?rule=epcis'.format(reverse('quartet-capture'))
+        data = self._get_test_data()
+        response = self.client.post(url, {'file': data}, format='multipart')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '60')
+        rule.bypass_admission_control = True
+        rule.save()
+        response = self.client.post(url, {'file': data}, format='multipart')
+        self.assertEqual(response.status_code, 201)
+
+    def test_queue_stats_refresh(self):
+        cache.clear()
+        rule = self._create_rule()
+        models.Task.objects.create(name='queued', rule=rule, status='QUEUED')
+        self.assertEqual(admission.get_queue_stats()[rule.id][0], 1)
+        with self.assertNumQueries(0):
+            admission.get_queue_stats()
+        # stale statistics are served while another process refreshes them
+        cache.set(admission.QUEUE_STATS_CACHE_KEY,
+                  (0, cache.get(admission.QUEUE_STATS_CACHE_KEY)[1]))
+        cache.add(admission.QUEUE_STATS_LOCK_KEY, True)
+        with self.assertNumQueries(0):
+            self.assertEqual(admission.get_queue_stats()[rule.id][0], 1)
+        cache.delete(admission.QUEUE_STATS_LOCK_KEY)
+        models.Task.objects.create(name='queued 2', rule=rule,
+                                   status='QUEUED')
+        self.assertEqual(admission.get_queue_stats()[rule.id][0], 2)
+        # on a cold cache only the process holding the lock queries, the
+        # others admit messages if the statistics do not arrive in time
+        cache.clear()
+        cache.add(admission.QUEUE_STATS_LOCK_KEY, True)
+        with mock.patch('quartet_capture.admission.QUEUE_STATS_WAIT', 0.1), \
+                self.assertNumQueries(0):
+            self.assertEqual(admission.get_queue_stats(), {})
+
+    def test_metrics(self):
+        self._create_rule()
+        url = '{0}?rule=epcis&run-immediately=true'.format(
+            reverse('quartet-capture'))
+        self.client.post(url, {'file': self._get_test_data()},
+                         format='multipart')
+        # disabled by default
+        self.assertEqual(self.client.get(reverse('metrics')).status_code,
+                         404)
+        with mock.patch('quartet_capture.views.METRICS_VIEW', True):
+            response = self.client.get(reverse('metrics'))
+            self.assertIn(
+                APIClient().get(reverse('metrics')).status_code, [401, 403])
+        self.assertEqual(response.status_code, 200)
+        content = response.content.decode('utf-8')
+        self.assertIn('quartet_capture_capture_messages_total{rule="epcis"}',
+                      content)
+        self.assertIn('quartet_capture_rule_execution_seconds_count'
+                      '{rule="epcis"}', content)
+        self.assertIn('quartet_capture_task_messages_total', content)
+
     def _get_test_data(self):
         '''
         Loads the XML file and passes its data back as a string.